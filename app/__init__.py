@@ -1,4 +1,6 @@
 import os
+import time
+from datetime import datetime, timedelta
 
 import click
 from flask import Flask, render_template
@@ -14,8 +16,14 @@ from app.blueprints.admin import admin_bp
 from app.blueprints.ajax import ajax_bp
 
 from app.extensions import db, mail, moment, bootstrap, login_manager, csrf, dropzone, avatars, whooshee
+from app import sqlite, replicas, compression, assets
 from app.config import config
-from app.models import User, Permission, Role, Photo, Tag, Comment, Follow, Collect, Notification
+from app.events import make_broker
+from app.fragments import FragmentCacheExtension, make_fragment_store
+from app.pagecache import make_page_store
+from app.principals import PrincipalCache
+from app.models import User, Permission, Role, Photo, Tag, Comment, Follow, Collect, Notification, Task, \
+    OutgoingMail
 
 
 def create_app(config_name=None):
@@ -35,6 +43,11 @@ def create_app(config_name=None):
 
     app.redis = Redis.from_url(app.config["REDIS_URL"])
     app.task_queue = rq.Queue("flask-album-tasks", connection=app.redis)
+    app.broker = make_broker(app)
+    app.principal_cache = PrincipalCache(app)
+    app.page_store = make_page_store(app)
+    app.fragment_store = make_fragment_store(app)
+    app.asset_manifest = assets.load_manifest(app)
 
     return app
 
@@ -42,6 +55,8 @@ def create_app(config_name=None):
 def register_extensions(app):
     bootstrap.init_app(app)
     db.init_app(app)
+    sqlite.init_app(app)
+    replicas.init_app(app)
     moment.init_app(app)
     mail.init_app(app)
     login_manager.init_app(app)
@@ -49,6 +64,7 @@ def register_extensions(app):
     csrf.init_app(app)
     dropzone.init_app(app)
     whooshee.init_app(app)
+    compression.init_app(app)
 
 
 def register_blueprints(app):
@@ -63,10 +79,14 @@ def register_shell_context(app):
     @app.shell_context_processor
     def make_shell_context():
         return dict(db=db, User=User, Photo=Photo, Tag=Tag,
-                    Comment=Comment, Follow=Follow, Collect=Collect, Notification=Notification)
+                    Comment=Comment, Follow=Follow, Collect=Collect, Notification=Notification, Task=Task)
 
 
 def register_template_context(app):
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.add_template_global(assets.static_url)
+    app.add_template_global(assets.bundle_urls)
+
     @app.context_processor
     def make_template_context():
         if current_user.is_authenticated:
@@ -125,36 +145,173 @@ def register_commands(app):
 
         click.echo('Done')
 
+    @app.cli.command('compress-static')
+    @click.option('--min-size', default=None, type=int,
+                  help='Skip smaller files, default is ALBUM_WALL_COMPRESS_MIN_SIZE')
+    def compress_static(min_size):
+        """Write the .gz and .br of the static text files, run it when deploying"""
+        if min_size is None:
+            min_size = app.config['ALBUM_WALL_COMPRESS_MIN_SIZE']
+        click.echo('Compressed %d files' % compression.precompress(app.static_folder, min_size))
+
+    @app.cli.command('build-assets')
+    @click.option('--prune', is_flag=True, help='Remove the built files the new manifest no longer lists')
+    def build_assets(prune):
+        """Write the hashed and bundled static files and their manifest, run it when deploying"""
+        manifest = assets.build(app.static_folder, prune)
+        click.echo('Built %d files into %s' % (len(manifest['files']),
+                                               os.path.join(app.static_folder, assets.BUILD_DIR)))
+
+    @app.cli.command('sync-replicas')
+    @click.option('--watch', default=0, help='Keep copying every WATCH seconds, as a lagging replica would')
+    def sync_replicas(watch):
+        """Copy a SQLite primary onto the SQLite replicas, a stand-in for replication"""
+        while True:
+            click.echo('Copied the primary to %d replicas' % replicas.sync_replicas())
+            if not watch:
+                break
+            time.sleep(watch)
+
+    @app.cli.command('deliver-mail')
+    @click.option('--retry-dead', is_flag=True, help='Give the dead letters a fresh set of attempts first')
+    @click.option('--watch', default=0, help='Keep delivering, polling the outbox every WATCH seconds')
+    def deliver_mail(retry_dead, watch):
+        """Send the queued emails"""
+        from app.emails import deliver_queued_mail
+
+        if retry_dead:
+            count = OutgoingMail.query.filter_by(dead=True).update(
+                dict(dead=False, attempts=0, next_attempt=datetime.utcnow()), synchronize_session=False)
+            db.session.commit()
+            click.echo('Requeued %d dead letters' % count)
+        while True:
+            sent, failed = deliver_queued_mail()
+            if sent or failed or not watch:
+                click.echo('Sent %d emails, %d failed, %d dead letters' % (
+                    sent, failed, OutgoingMail.query.filter_by(dead=True).count()))
+            if not watch:
+                break
+            time.sleep(watch)
+
+    @app.cli.command('send-digests')
+    @click.option('--hours', default=24, help='Window of unread notifications, default is 24')
+    @click.option('--chunk-size', default=None, type=int, help='Recipients per transaction')
+    def send_digests(hours, chunk_size):
+        """Email the daily notification digests, run it from cron"""
+        from app.digests import send_digests
+
+        click.echo('Queued %d digests' % send_digests(timedelta(hours=hours), chunk_size))
+
+    @app.cli.command('purge-files')
+    @click.option('--orphans', is_flag=True, help='Also queue upload files no row refers to and stale partial uploads')
+    @click.option('--grace', default=24, help='Hours an orphan or a batch upload must be untouched before it is '
+                                              'given up on, default is 24')
+    def purge_files(orphans, grace):
+        """Remove files left in the deletion queue"""
+        from app.tasks import purge_deleted_files
+        from app.models import queue_file_deletions, avatar_paths, photo_paths
+        from app.uploads import chunk_path, expire_uploads, pending_upload_paths
+
+        expired = expire_uploads(datetime.utcnow() - timedelta(hours=grace))
+        db.session.commit()
+        click.echo('Expired %d batch uploads' % expired)
+
+        if orphans:
+            referenced = set(photo_paths(name for row in db.session.query(
+                Photo.filename, Photo.filename_s, Photo.filename_m) for name in row))
+            # originals waiting for the batch task
+            referenced.update(pending_upload_paths())
+            referenced.update(avatar_paths(name for row in db.session.query(
+                User.avatar_s, User.avatar_m, User.avatar_l, User.avatar_raw) for name in row))
+            deadline = time.time() - grace * 3600
+            found = []
+            directories = [app.config['ALBUM_WALL_UPLOAD_PATH'], app.config['AVATARS_SAVE_PATH']]
+            # and the part files of the uploads given up on
+            if os.path.isdir(chunk_path()):
+                directories.append(chunk_path())
+            for directory in directories:
+                for entry in os.scandir(directory):
+                    if entry.is_file() and entry.path not in referenced and entry.stat().st_mtime < deadline:
+                        found.append(entry.path)
+            queue_file_deletions(found)
+            db.session.commit()
+            click.echo('Queued %d orphaned files' % len(found))
+
+        click.echo('Removed %d files' % purge_deleted_files())
+
+    @app.cli.command('create-indexes')
+    @click.option('--dry-run', is_flag=True, help='Only print the statements')
+    @click.option('--analyze/--no-analyze', default=True, help='Refresh the planner statistics afterwards')
+    def create_indexes(dry_run, analyze):
+        """Build the declared indexes missing from the database"""
+        from app.schema import missing_indexes, index_sql, create_index, analyze as analyze_tables
+
+        indexes = missing_indexes()
+        for index in indexes:
+            if dry_run:
+                click.echo(index_sql(index, db.engine.dialect))
+                continue
+            click.echo('Creating %s on %s...' % (index.name, index.table.name), nl=False)
+            click.echo(' %.2fs' % create_index(index))
+        if analyze and indexes and not dry_run:
+            analyze_tables()
+        click.echo('%d indexes missing' % len(indexes) if dry_run else 'Created %d indexes' % len(indexes))
+
+    @app.cli.command('query-plans')
+    @click.option('--update', is_flag=True, help='Rewrite the snapshot with the current plans')
+    @click.option('--snapshot', default=None, help='Snapshot file, default is tests/query_plans/<dialect>.json')
+    def query_plans(update, snapshot):
+        """Check the plans of the hot queries"""
+        from app.queryplans import check_plans
+
+        plans, problems = check_plans(snapshot, update)
+        for name, lines in plans.items():
+            click.echo(name)
+            for line in lines:
+                click.echo('    ' + line)
+        for problem in problems:
+            click.echo(problem, err=True)
+        if update:
+            click.echo('Updated the snapshot of %d queries' % len(plans))
+        if problems:
+            raise SystemExit(1)
+
     @app.cli.command()
     @click.option('--user', default=10, help='Quantity of users, default is 10')
     @click.option('--photo', default=30, help="Quantity of photos, default is 30")
-    @click.option('--tag', default=20, help="Quantity of photos, default is 20")
-    @click.option('--comment', default=100, help='Quantity of photos, default is 200')
+    @click.option('--tag', default=20, help="Quantity of tags, default is 20")
+    @click.option('--comment', default=100, help='Quantity of comments, default is 100')
     @click.option('--collection', default=50, help="Quantity of collections, default is 50")
     @click.option("--follow", default=30, help="Quantity of follows, default is 30")
-    def forge(user, photo, tag, comment, collection, follow):
+    @click.option('--seed', default=42, help='Random seed, the same seed gives the same data, default is 42')
+    @click.option('--chunk-size', default=10000, help='Rows per insert and commit, default is 10000')
+    def forge(user, photo, tag, comment, collection, follow, seed, chunk_size):
         """generating fake data"""
         from app.fakes import fake_admin, fake_user, fake_photo, fake_tag, fake_comment, fake_collect,\
-            fake_follow
+            fake_follow, fake_search_index
+        from app import fakes
 
         db.drop_all() # Why drop and create again???
         # so that when you execute the command multiple times, there is only one copy of data
         db.create_all()
+        fakes.seed(seed)
 
         click.echo("Initializing the roles and permissions...")
         Role.init_role()
         click.echo("Generating fake administrator")
         fake_admin()
         click.echo("Generating %s fake users" % user)
-        fake_user(user)
+        fake_user(user, chunk_size)
         click.echo("Generating %s fake follows" % follow)
-        fake_follow(follow)
+        fake_follow(follow, chunk_size)
         click.echo("Generating %s fake tags" % tag)
-        fake_tag(tag)
+        fake_tag(tag, chunk_size)
         click.echo("Generating %s fake photos" % photo)
-        fake_photo(photo)
+        fake_photo(photo, chunk_size)
         click.echo("Generating %s fake comments" % comment)
-        fake_comment(comment)
+        fake_comment(comment, chunk_size)
         click.echo("Generating %s fake collections" % collection)
-        fake_collect(collection)
-        click.echo("Done")
\ No newline at end of file
+        fake_collect(collection, chunk_size)
+        click.echo("Building the search index")
+        fake_search_index(chunk_size)
+        click.echo("Done")
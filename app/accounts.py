@@ -0,0 +1,50 @@
+from flask_whooshee import INSERT_KWD
+from werkzeug.security import generate_password_hash
+
+from app.extensions import db, whooshee
+from app.models import User
+
+
+def create_user(password, **kwargs):
+    """Create a user with its self-follow and role in a single commit."""
+    user = User(**kwargs)
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def create_users(rows, password=None, batch_size=1000):
+    """Bulk version of create_user, one commit per batch_size users.
+
+    rows is an iterable of dicts of User column values. The password is hashed once and
+    shared by every row that does not bring its own password_hash. Meant for the CLI and
+    seeding scripts.
+    """
+    password_hash = generate_password_hash(password) if password is not None else None
+    count = 0
+    batch = []
+    for row in rows:
+        user = User(**row)
+        if user.password_hash is None:
+            user.password_hash = password_hash
+        db.session.add(user)
+        batch.append(user)
+        if len(batch) == batch_size:
+            count += _commit_batch(batch)
+            batch = []
+    count += _commit_batch(batch)
+    return count
+
+
+def _commit_batch(users):
+    # whooshee commits its index once per inserted row, so flush the batch with the session's
+    # indexing deferred and add the whole batch to the index with a single writer instead
+    db.session.info['defer_search_index'] = True
+    try:
+        db.session.flush()
+    finally:
+        db.session.info.pop('defer_search_index', None)
+    whooshee.on_commit([[user, INSERT_KWD] for user in users])
+    db.session.commit()
+    return len(users)
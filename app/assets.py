@@ -0,0 +1,154 @@
+"""Fingerprinted and bundled static files.
+
+`flask build-assets` copies the static files the pages use to app/static/dist, each under a name
+carrying a hash of its content: css/style.css becomes dist/css/style.3f2a9b1c0d.css. The BUNDLES
+are concatenated, and minified when the rjsmin and rcssmin packages are installed, into one file
+each, so a page loads one stylesheet and one script. url() references in stylesheets are rewritten
+to the hashed names. The hashed names go to dist/manifest.json, and the files are precompressed
+for the static view, see app.compression.
+
+A hashed file never changes, so the static view sends the files under dist/ with a max-age of
+ALBUM_WALL_ASSETS_MAX_AGE. A new build writes new names and keeps the old ones for pages still
+open in browsers, --prune removes the files the manifest no longer lists.
+
+Templates call static_url(filename) and bundle_urls(name). They resolve through the manifest named
+by ALBUM_WALL_ASSETS_MANIFEST and fall back to the plain static files when it is None or missing,
+so development needs no build.
+"""
+import hashlib
+import json
+import os
+import posixpath
+import re
+
+from flask import current_app, url_for
+
+from app import compression
+
+try:
+    import rcssmin
+    import rjsmin
+except ImportError:  # the bundles are only concatenated
+    rcssmin = rjsmin = None
+
+BUILD_DIR = 'dist'
+BUNDLES = {
+    'css/app.css': ['css/bootstrap.min.css', 'open-iconic/font/css/open-iconic-bootstrap.css', 'css/style.css'],
+    'js/app.js': ['js/jquery.min.js', 'js/popper.min.js', 'js/bootstrap.min.js', 'js/moment-with-locales.min.js',
+                  'js/script.js'],
+}
+FINGERPRINTED = ('.css', '.js', '.ico', '.jpg', '.png', '.gif', '.svg', '.eot', '.otf', '.ttf', '.woff', '.woff2')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+SOURCE_MAP = re.compile(r'^\s*(//[#@] sourceMappingURL=.*|/\*# sourceMappingURL=.*\*/)\s*$', re.MULTILINE)
+
+
+def load_manifest(app):
+    if not app.config['ALBUM_WALL_ASSETS_MANIFEST']:
+        return None
+    try:
+        with open(os.path.join(app.static_folder, app.config['ALBUM_WALL_ASSETS_MANIFEST'])) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def static_url(filename, **kwargs):
+    """url_for('static', filename=filename) for the built file when there is one."""
+    manifest = current_app.asset_manifest
+    if manifest is not None and filename in manifest['files']:
+        filename = manifest['files'][filename]
+    return url_for('static', filename=filename, **kwargs)
+
+
+def bundle_urls(name):
+    """The built bundle's URL, or the URLs of its files without a build."""
+    manifest = current_app.asset_manifest
+    if manifest is not None and name in manifest['files']:
+        return [url_for('static', filename=manifest['files'][name])]
+    return [static_url(filename) for filename in BUNDLES[name]]
+
+
+def max_age(filename):
+    if filename.startswith(BUILD_DIR + '/'):
+        return current_app.config['ALBUM_WALL_ASSETS_MAX_AGE']
+    return current_app.get_send_file_max_age(filename)
+
+
+def build(static_folder, prune=False):
+    """Write the hashed files, the bundles and the manifest, return the manifest."""
+    files = {}
+    sources = []
+    for root, dirs, names in os.walk(static_folder):
+        # not the earlier builds
+        dirs[:] = sorted(name for name in dirs
+                         if os.path.join(root, name) != os.path.join(static_folder, BUILD_DIR))
+        for name in sorted(names):
+            if name.endswith(FINGERPRINTED):
+                sources.append(os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/'))
+
+    # stylesheets last, their url()s point at the hashed names
+    for filename in sorted(sources, key=lambda filename: filename.endswith('.css')):
+        with open(os.path.join(static_folder, filename), 'rb') as f:
+            data = f.read()
+        if filename.endswith('.css'):
+            data = _rewrite_urls(data.decode('utf-8'), filename, filename, files).encode('utf-8')
+        files[filename] = _write(static_folder, filename, data)
+
+    for name, members in sorted(BUNDLES.items()):
+        parts = []
+        for filename in members:
+            with open(os.path.join(static_folder, filename), encoding='utf-8') as f:
+                text = SOURCE_MAP.sub('', f.read())
+            if name.endswith('.css'):
+                parts.append(_rewrite_urls(text, filename, name, files))
+            else:
+                # a file may end in the middle of a statement
+                parts.append(text.rstrip() + '\n;')
+        text = '\n'.join(parts)
+        if rcssmin is not None:
+            text = rcssmin.cssmin(text) if name.endswith('.css') else rjsmin.jsmin(text)
+        files[name] = _write(static_folder, name, text.encode('utf-8'))
+
+    manifest = dict(files=files)
+    with open(os.path.join(static_folder, BUILD_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    if prune:
+        _prune(static_folder, set(files.values()))
+    compression.precompress(os.path.join(static_folder, BUILD_DIR),
+                            current_app.config['ALBUM_WALL_COMPRESS_MIN_SIZE'])
+    return manifest
+
+
+def _write(static_folder, filename, data):
+    stem, ext = posixpath.splitext(filename)
+    built = '%s/%s.%s%s' % (BUILD_DIR, stem, hashlib.sha1(data).hexdigest()[:10], ext)
+    path = os.path.join(static_folder, *built.split('/'))
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    return built
+
+
+def _rewrite_urls(text, source, target, files):
+    # url()s relative to source, made relative to where target's built file goes
+    def replace(match):
+        url = match.group(2).strip()
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        query = re.search(r'[?#]', url)
+        path, rest = (url[:query.start()], url[query.start():]) if query else (url, '')
+        referenced = posixpath.normpath(posixpath.join(posixpath.dirname(source), path))
+        referenced = files.get(referenced, referenced)
+        built_dir = posixpath.dirname('%s/%s' % (BUILD_DIR, target))
+        return 'url("%s%s")' % (posixpath.relpath(referenced, built_dir), rest)
+    return CSS_URL.sub(replace, text)
+
+
+def _prune(static_folder, keep):
+    for root, dirs, names in os.walk(os.path.join(static_folder, BUILD_DIR)):
+        for name in names:
+            built = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            original = re.sub(r'\.(gz|br)$', '', built)
+            if original not in keep and name != 'manifest.json':
+                os.remove(os.path.join(root, name))
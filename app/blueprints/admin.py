@@ -1,9 +1,10 @@
 from flask import flash, render_template, Blueprint, request, current_app
 from flask_login import login_required
 
+from app import queries
 from app.decorators import permission_required, admin_required
 from app.extensions import db
-from app.models import User, Photo, Tag, Comment, Role
+from app.models import User, Photo, Tag, Comment, Role, Task
 from app.forms.admin import EditProfileAdminForm
 from app.utils import redirect_back
 
@@ -22,10 +23,11 @@ def index():
     tag_count = Tag.query.count()
     comment_count = Comment.query.count()
     reported_comment_count = Comment.query.filter(Comment.flag > 0).count()
+    account_deletions = Task.query.filter_by(name='delete_account').order_by(Task.timestamp.desc()).limit(10).all()
     return render_template('admin/index.html', user_count=user_count, locked_user_count=locked_user_count,
                            blocked_user_count=blocked_user_count, photo_count=photo_count,
                            reported_comment_count=reported_comment_count, reported_photo_count=reported_photo_count,
-                           tag_count=tag_count, comment_count=comment_count)
+                           tag_count=tag_count, comment_count=comment_count, account_deletions=account_deletions)
 
 
 @admin_bp.route('/profile/<int:user_id>', methods=["POST", "GET"])
@@ -126,20 +128,7 @@ def manage_user():
     filter_rule = request.args.get('filter', 'all') # 'all', 'locked', 'blocked', 'admin', 'moderator'
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUM_WALL_MANAGE_USER_PER_PAGE']
-    administrator = Role.query.filter_by(name="Administrator").first()
-    moderator = Role.query.filter_by(name='Moderator').first()
-
-    if filter_rule == 'locked':
-        filtered_users = User.query.filter_by(locked=True)
-    elif filter_rule == 'blocked':
-        filtered_users = User.query.filter_by(active=False)
-    elif filter_rule == 'administrator':
-        filtered_users = User.query.filter_by(role=administrator)
-    elif filter_rule == 'moderator':
-        filtered_users = User.query.filter_by(role=moderator)
-    else:
-        filtered_users = User.query
-    pagination = filtered_users.order_by(User.member_since.desc()).paginate(page, per_page)
+    pagination = queries.managed_users(filter_rule).paginate(page, per_page)
     users = pagination.items
     return render_template('admin/manage_user.html', users=users, pagination=pagination) #page=page??
 
@@ -153,10 +142,8 @@ def manage_photo(order):
     per_page = current_app.config['ALBUM_WALL_MANAGE_PHOTO_PER_PAGE']
     order_rule = 'flag'
     if order == "by_time":
-        pagination = Photo.query.order_by(Photo.timestamp.desc()).paginate(page, per_page)
         order_rule = 'time'
-    else:
-        pagination = Photo.query.order_by(Photo.flag.desc()).paginate(page, per_page)
+    pagination = queries.managed_photos(by_time=order == 'by_time').paginate(page, per_page)
     photos = pagination.items
     return render_template('admin/manage_photo.html', photos=photos, order_rule=order_rule, pagination=pagination)
 
@@ -182,8 +169,6 @@ def manage_comment(order):
     order_rule = 'flag'
     if order == 'time':
         order_rule = 'by_time'
-        pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(page, per_page)
-    else:
-        pagination = Comment.query.order_by(Comment.flag.desc()).paginate(page, per_page)
+    pagination = queries.managed_comments(by_time=order == 'time').paginate(page, per_page)
     comments = pagination.items
     return render_template('admin/manage_comment.html', order_rule=order_rule, comments=comments, pagination=pagination)
\ No newline at end of file
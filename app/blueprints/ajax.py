@@ -1,20 +1,53 @@
-from flask import render_template, Blueprint, jsonify
+from flask import render_template, Blueprint, jsonify, request, abort, current_app, Response, url_for
 from flask_login import current_user
 
-from app.models import User, Notification, Photo
+from app import queries
+from app.conditional import conditional, versions_of, viewer
+from app.events import stream, user_channel
+from app.extensions import db
+from app.models import User, Photo, Task, Upload
 from app.notifications import push_follow_notification, push_collect_notification
+from app.replicas import replica_read
+from app.tasks import launch_task
 
 ajax_bp = Blueprint('ajax', __name__)
 
 
+def profile_versions(user_id):
+    user = User.query.get(user_id)
+    return [user] + viewer() if user is not None and not user.deleted else None
+
+
 @ajax_bp.route('/profile/<int:user_id>')
+@replica_read
+@conditional(profile_versions)
 def get_profile(user_id):
     user = User.query.get_or_404(user_id)
+    if user.deleted:
+        abort(404)
     # todo render_template ??
     return render_template('main/profile_popup.html', user=user)
 
 
+@ajax_bp.route('/relationships')
+def relationships():
+    # ?photo_ids=1,2,3&user_ids=4,5 -> which of them the current user collects / follows / is followed by
+    if not current_user.is_authenticated:
+        return jsonify(message="Login required"), 403
+
+    def parse_ids(name):
+        return [int(i) for i in request.args.get(name, '').split(',') if i.strip().isdigit()]
+
+    photo_ids = parse_ids('photo_ids')
+    user_ids = parse_ids('user_ids')
+    return jsonify(collecting=sorted(current_user.collecting_ids(photo_ids)),
+                   following=sorted(current_user.following_ids(user_ids)),
+                   followers=sorted(current_user.follower_ids(user_ids)))
+
+
 @ajax_bp.route('/followers-count/<int:user_id>')
+@replica_read
+@conditional(versions_of(User))
 def followers_count(user_id):
     user = User.query.get_or_404(user_id)
     count = user.followers.count() - 1
@@ -57,13 +90,28 @@ def unfollow(username):
 
 
 @ajax_bp.route('/notifications-count/')
+@replica_read
 def notifications_count():
     if not current_user.is_authenticated:
         return jsonify(message="Login required"), 403
-    count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
+    count = queries.unread_notifications(current_user.id).count()
     return jsonify(count=count), 200  # todo ?? status is 200
 
 
+@ajax_bp.route('/notifications-stream/')
+def notifications_stream():
+    if not current_user.is_authenticated:
+        return jsonify(message="Login required"), 403
+    # subscribed before counting, so nothing published in between is missed
+    subscription = current_app.broker.subscribe(user_channel(current_user.id))
+    count = queries.unread_notifications(current_user.id).count()
+    # the body is generated after the request ends, so the stream holds no database connection
+    body = stream(subscription, dict(count=count), current_app.config['ALBUM_WALL_EVENT_HEARTBEAT'],
+                  current_app.config['ALBUM_WALL_EVENT_STREAM_TIMEOUT'])
+    return Response(body, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @ajax_bp.route('/collect_notification/<int:photo_id>/', methods=["POST"])
 def collect_notification(photo_id):
     receiver = Photo.query.get_or_404(photo_id).author
@@ -94,6 +142,8 @@ def collect(photo_id):
 
 
 @ajax_bp.route('/<int:photo_id>/followers-count')
+@replica_read
+@conditional(versions_of(Photo))
 def collectors_count(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     count = len(photo.collectors)
@@ -114,3 +164,48 @@ def uncollect(photo_id):
         push_collect_notification(current_user, photo_id, photo.author)
     return jsonify(message="Photo uncollected")
 
+
+@ajax_bp.route('/task/<task_id>')
+def task_status(task_id):
+    if not current_user.is_authenticated:
+        return jsonify(message="Login required"), 403
+
+    task = Task.query.get_or_404(task_id)
+    if task.user_id != current_user.id and not current_user.can("MODERATE"):
+        return jsonify(message="No permission"), 403
+    return jsonify(status=task.status, progress=task.progress, message=task.message)
+
+
+@ajax_bp.route('/uploads/<batch_id>', methods=['POST'])
+def process_uploads(batch_id):
+    if not current_user.is_authenticated:
+        return jsonify(message="Login required"), 403
+
+    if not current_user.confirmed:
+        return jsonify(message='Account confirmation required'), 400
+
+    if not current_user.can("UPLOAD"):
+        return jsonify(message="No permission"), 403
+
+    uploads = Upload.query.filter_by(user_id=current_user.id, batch_id=batch_id, status='uploaded')\
+        .order_by(Upload.id).all()
+    if not uploads:
+        return jsonify(message='Nothing to process'), 400
+    # claimed here, so a second request can't start another task for the same files
+    for upload in uploads:
+        upload.status = 'processing'
+    db.session.commit()
+    task = launch_task('process_upload_batch', 'Processing %d photos' % len(uploads),
+                       current_user._get_current_object(), current_user.id, [upload.id for upload in uploads])
+    return jsonify(message='Processing', task_url=url_for('.task_status', task_id=task.id))
+
+
+@ajax_bp.route('/uploads/<batch_id>')
+def upload_status(batch_id):
+    if not current_user.is_authenticated:
+        return jsonify(message="Login required"), 403
+
+    uploads = Upload.query.filter_by(user_id=current_user.id, batch_id=batch_id).order_by(Upload.id)
+    return jsonify(uploads=[dict(id=upload.id, status=upload.status, message=upload.message,
+                                 url=url_for('main.show_photo', photo_id=upload.photo_id) if upload.photo_id else None)
+                            for upload in uploads])
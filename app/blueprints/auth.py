@@ -1,8 +1,8 @@
 from flask import render_template, flash, redirect, url_for, Blueprint
 from flask_login import logout_user, login_user, login_required, current_user, login_fresh, confirm_login
 
+from app.accounts import create_user
 from app.emails import send_confirmation_email, send_reset_password_email
-from app.extensions import db
 from app.utils import redirect_back, generate_token, validate_token
 from app.forms.auth import LoginForm, RegisterForm, ForgetPasswordForm, ResetPasswordForm
 from app.config import Operations
@@ -61,10 +61,7 @@ def register():
         email = form.email.data
         username = form.username.data
         password = form.password.data
-        user = User(name=name, email=email, username=username)
-        user.set_password(password)
-        db.session.add(user)
-        db.session.commit()
+        user = create_user(password, name=name, email=email, username=username)
         token = generate_token(user=user, operation='confirm')
         send_confirmation_email(user=user, token=token)
         flash("Confirm email sent, check your inbox", 'info')
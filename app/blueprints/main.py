@@ -1,15 +1,24 @@
 import os
+from uuid import uuid4
 
 from flask import render_template, Blueprint, current_app, request, send_from_directory, \
-    abort, flash, redirect, url_for
+    abort, flash, redirect, url_for, jsonify
 
 from flask_login import login_required, current_user
 
+from app import queries
+from app.conditional import conditional, page_viewer
 from app.decorators import confirm_required, permission_required
+from app.events import publish_notification
 from app.extensions import db
-from app.models import User, Photo, Tag, Comment, Collect, Notification, Follow
+from app.identicons import is_identicon, identicon_path
+from app.models import User, Photo, Tag, Comment, Notification, without_deleted
+from app.pagecache import cache_for_anonymous
 from app.notifications import push_comment_notification, push_collect_notification
-from app.utils import rename_image, resize_image, flash_errors, redirect_back
+from app.replicas import replica_read
+from app.uploads import UploadError, write_chunk, write_file, save_photo, store_original
+from app.utils import flash_errors, redirect_back, hydrate_follow_state, \
+    hydrate_collect_state
 from app.forms.main import DescriptionForm, CommentForm, TagForm
 
 from sqlalchemy.sql.expression import func
@@ -27,20 +36,21 @@ def index():
     if current_user.is_authenticated:
         page = request.args.get('page', 1, type=int)
         per_page = current_app.config['ALBUM_WALL_PHOTO_PER_PAGE']
-        pagination = Photo.query.join(Follow, Follow.followed_id == Photo.author_id)\
-            .filter(Follow.follower_id == current_user.id)\
-            .order_by(Photo.timestamp.desc()).paginate(page, per_page)
+        pagination = queries.timeline(current_user.id).paginate(page, per_page)
         photos = pagination.items
+        hydrate_collect_state(photos)
     else:
         pagination = None
         photos = None
-    tags = Tag.query.join(Tag.photos).group_by(Tag.id).order_by(func.count(Photo.id).desc()).limit(10)
-    return render_template('main/index.html', pagination=pagination, photos=photos, tag=tags)
+    tags = queries.hot_tags()
+    return render_template('main/index.html', pagination=pagination, photos=photos, tags=tags)
 
 
 @main_bp.route('/explore')
+@cache_for_anonymous()
+@replica_read
 def explore():
-    photos = Photo.query.order_by(func.random()).limit(12)
+    photos = without_deleted(Photo.query, Photo.author).order_by(func.random()).limit(12)
     return render_template('main/explore.html', photos=photos)
 
 
@@ -51,6 +61,14 @@ def get_image(filename):
 
 @main_bp.route('/avatars/<path:filename>')
 def get_avatar(filename):
+    if is_identicon(filename):
+        path = identicon_path(filename)
+        if path is None:
+            abort(404)
+        # the picture is fully determined by its name, so it can be cached forever
+        response = send_from_directory(os.path.dirname(path), os.path.basename(path))
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
     return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], filename)
 
 
@@ -60,28 +78,49 @@ def get_avatar(filename):
 @permission_required("UPLOAD")
 def upload():
     if request.method == "POST" and 'file' in request.files:
-        f = request.args.get('file')
-        filename = rename_image(f.filename)
-        f.save(os.path.join(current_app.config['ALBUM_WALL_UPLOAD_PATH']), filename)
-        filename_s = resize_image(f, filename, current_app.config['ALBUMY_PHOTO_SIZE']['small'])
-        filename_m = resize_image(f, filename, current_app.config['ALBUMY_PHOTO_SIZE']['medium'])
-        photo = Photo(
-            filename=filename,
-            filename_m=filename_m,
-            filename_s=filename_s,
-            author=current_user._get_current_object()
-        )
-        db.session.add(photo)
-    db.session.commit()
-    return render_template('main/upload.html')
+        f = request.files['file']
+        try:
+            if 'dzuuid' in request.form:
+                path = write_chunk(current_user.id, request.form, f.stream)
+                if path is None:
+                    return jsonify(message='Chunk received')
+            else:
+                path = write_file(current_user.id, f.stream)
+            if 'batch' in request.form:
+                # resized with the rest of the batch, see ajax.process_uploads
+                upload = store_original(path, current_user, request.form['batch'])
+            else:
+                upload = None
+                save_photo(path, current_user._get_current_object())
+        except UploadError as e:
+            # Dropzone shows the text under the file
+            return str(e), 400
+        db.session.commit()
+        if upload is not None:
+            return jsonify(message='Photo received', id=upload.id)
+        return jsonify(message='Photo uploaded')
+    return render_template('main/upload.html', batch_id=uuid4().hex)
+
+
+def photo_versions(photo_id):
+    photo = Photo.query.get(photo_id)
+    if photo is None or photo.author.deleted:
+        return None
+    # the author's version also moves the previous and next links
+    return [photo, photo.author] + page_viewer()
 
 
 @main_bp.route('/photo/<int:photo_id>')
+@cache_for_anonymous()
+@replica_read
+@conditional(photo_versions)
 def show_photo(photo_id):
     photo = Photo.query.get_or_404(photo_id)
+    if photo.author.deleted:
+        abort(404)
     page = request.args.get("page", 1, type=int)
     per_page = current_app.config['ALBUM_WALL_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(photo).order_by(Comment.timestamp.desc()).paginate(page, per_page)
+    pagination = queries.photo_comments(photo.id).paginate(page, per_page)
     comments = pagination.items
 
     comment_form = CommentForm()
@@ -89,29 +128,30 @@ def show_photo(photo_id):
     tag_form = TagForm()
 
     return render_template('main/photo.html', photo=photo, pagination=pagination, comments=comments,
-                           comment_form=comment_form, description_form=description_form, tag_form=tag_form)
+                           comment_form=comment_form, description_form=description_form, tag_form=tag_form,
+                           previous_id=photo.previous_id(), next_id=photo.next_id())
 
 
 @main_bp.route("/photo/n/<int:photo_id>")
 def photo_next(photo_id):
     photo = Photo.query.get_or_404(photo_id)
-    photo_n = Photo.query.with_parent(photo.author).filter(Photo.id < photo_id).order_by(Photo.timestamp.desc()).first()
+    next_id = photo.next_id()
 
-    if photo_n is None:
+    if next_id is None:
         flash("This is already the last photo", 'warning')
         return redirect(url_for('.show_photo', photo_id=photo_id))
-    return redirect(url_for('.show_photo', photo_id=photo_n.id))
+    return redirect(url_for('.show_photo', photo_id=next_id))
 
 
 @main_bp.route('/photo/p/<int:photo_id>')
 def photo_previous(photo_id):
     photo = Photo.query.get_or_404(photo_id)
-    photo_p = Photo.query.with_parent(photo.author).filter(Photo.id>photo_id).order_by(Photo.timestamp.asc()).first()
+    previous_id = photo.previous_id()
 
-    if photo_p is None:
+    if previous_id is None:
         flash("This is already the first photo", 'warning')
         return redirect(url_for('.show_photo', photo_id=photo_id))
-    return redirect(url_for('.show_photo', photo_id=photo_p.id))
+    return redirect(url_for('.show_photo', photo_id=previous_id))
 
 
 @main_bp.route('/collect/<int:photo_id>', methods=["POST"])
@@ -145,12 +185,14 @@ def uncollect(photo_id):
 
 
 @main_bp.route('/photo/<int:photo_id>/collectors')
+@replica_read
 def show_collectors(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUM_WALL_COMMENT_PER_PAGE']
-    pagination = Collect.query.with_parent(photo).paginate(page, per_page)
+    pagination = queries.photo_collectors(photo.id).paginate(page, per_page)
     collections = pagination.items  # collection.collector will be retrieved in the template
+    hydrate_follow_state([collection.collector for collection in collections])
     return render_template('main/collectors.html', collections=collections, photo=photo, pagination=pagination)
 
 
@@ -277,17 +319,16 @@ def delete_photo(photo_id):
     if current_user != photo.author and not current_user.can("MODERATE"):
         abort(403)
 
+    # land on the photo that takes its place, the seek needs the photo's row
+    neighbour_id = photo.next_id() or photo.previous_id()
+    username = photo.author.username
     db.session.delete(photo)
     db.session.commit()
     flash("Photo deleted.", 'warning')
 
-    photo_n = Photo.query.with_parent(photo.author).filter(Photo.id<photo_id).order_by(Photo.timestamp.desc()).first()
-    if photo_n is None:
-        photo_p = Photo.query.with_parent(photo.author).filter(Photo.id>photo_id).order_by(Photo.timestamp.asc()).first()
-        if photo_p is None:
-            return redirect(url_for('user.index', username=photo.author.username))
-        return redirect(url_for('.show_photo', photo_id=photo_p.id))
-    return redirect(url_for('.show_photo', photo_id=photo_n.id))
+    if neighbour_id is None:
+        return redirect(url_for('user.index', username=username))
+    return redirect(url_for('.show_photo', photo_id=neighbour_id))
 
 
 @main_bp.route('/delete/comment/<int:comment_id>', methods=["POST", "GET"])
@@ -305,12 +346,14 @@ def delete_comment(comment_id):
 
 @main_bp.route('/tag/<int:tag_id>', defaults={'order': 'by_time'})
 @main_bp.route('/tag/<int:tag_id>/<order>')
+@cache_for_anonymous()
+@replica_read
 def show_by_tag(tag_id, order):
     tag = Tag.query.get_or_404(tag_id)
     page = request.args.get("page", 1, type=int)
     per_page = current_app.config['ALBUM_WALL_PHOTO_PER_PAGE']
     order_rule = 'time'
-    pagination = Photo.query.with_parent(tag).order_by(Photo.timestamp.desc()).paginate(page, per_page)
+    pagination = queries.tag_photos(tag.id).paginate(page, per_page)
     photos = pagination.items
 
     if order == 'by_collections':
@@ -342,12 +385,8 @@ def delete_tag(photo_id, tag_id):
 def show_notifications():
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUM_WALL_PHOTO_PER_PAGE']
-    notifications = Notification.query.with_parent(current_user)
     filter_rule = request.args.get('filter')
-    if filter_rule == 'unread':
-        notifications = notifications.filter_by(is_read=False)
-
-    pagination = notifications.order_by(Notification.timestamp.desc()).paginate(page, per_page)
+    pagination = queries.notifications(current_user.id, unread=filter_rule == 'unread').paginate(page, per_page)
     notifications = pagination.items
     return render_template('main/notifications.html', pagination=pagination, notifications=notifications)
 
@@ -361,6 +400,7 @@ def read_notification(notification_id):
 
     notification.is_read = True
     db.session.commit()
+    publish_notification(current_user._get_current_object())
     flash("Notification Archived", 'success')
     return redirect(url_for('.show_notifications'))
 
@@ -371,11 +411,14 @@ def read_all_notifications():
     for notification in current_user.notifications:
         notification.is_read = True
     db.session.commit()
+    publish_notification(current_user._get_current_object())
     flash("All notifications archived", 'success')
     return redirect(url_for('.show_notifications'))
 
 
 @main_bp.route('/search')
+@cache_for_anonymous('search')
+@replica_read
 def search():
     q = request.args.get('q', '').strip()
     if q == '':
@@ -386,10 +429,12 @@ def search():
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUM_WALL_SEARCH_RESULT_PER_PAGE']
     if category == 'user':
-        pagination = User.query.whooshee_search(q).paginate(page, per_page)
+        pagination = User.query.whooshee_search(q).filter(User.deleted.isnot(True)).paginate(page, per_page)
     elif category == 'photo':
-        pagination = Photo.query.whooshee_search(q).paginate(page, per_page)
+        pagination = without_deleted(Photo.query.whooshee_search(q), Photo.author).paginate(page, per_page)
     else:
         pagination = Tag.query.whooshee_search(q).paginate(page, per_page)
     results = pagination.items
+    if category == 'user':
+        hydrate_follow_state(results)
     return render_template('main/search.html', page=page, results=results, q=q, pagination=pagination, category=category)
\ No newline at end of file
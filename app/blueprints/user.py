@@ -1,21 +1,43 @@
-from flask import Blueprint, render_template, current_app, request, redirect, url_for, flash
+from flask import Blueprint, render_template, current_app, request, redirect, url_for, flash, abort
 from flask_login import login_required, current_user, fresh_login_required, logout_user
 
+from app import queries
+from app.conditional import conditional, page_viewer
 from app.decorators import confirm_required, permission_required
-from app.models import User, Photo, Collect
+from app.models import User, Photo, queue_file_deletions, avatar_paths
+from app.pagecache import cache_for_anonymous
 from app.notifications import push_follow_notification
-from app.utils import redirect_back, flash_errors, generate_token, validate_token, Operations
+from app.replicas import replica_read
+from app.utils import redirect_back, flash_errors, generate_token, validate_token, Operations, hydrate_follow_state
 from app.forms.user import EditProfileForm, DeleteAccountForm, CropAvatarForm, NotificationSettingForm\
     , ChangePasswordForm, UploadAvatarForm, ChangeEmailForm, PrivacySettingForm
 from app.extensions import db, avatars
 from app.emails import send_confirmation_email
+from app.tasks import launch_task
 
 user_bp = Blueprint('user', __name__)
 
 
+def user_versions(username):
+    user = queries.user_by_username(username).first()
+    if user is None or user.deleted or user == current_user and (user.locked or not user.active):
+        return None
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['ALBUM_WALL_PHOTO_PER_PAGE']
+    # the photos on the page, their cards show counts that don't move the user's version
+    photos = queries.user_photos(user.id).with_entities(Photo.id, Photo.version)\
+        .limit(per_page).offset((page - 1) * per_page).all()
+    return [user] + photos + page_viewer()
+
+
 @user_bp.route('/<username>/')
+@cache_for_anonymous()
+@replica_read
+@conditional(user_versions)
 def index(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = queries.user_by_username(username).first_or_404()
+    if user.deleted:
+        abort(404)
     if user == current_user and user.locked:
         flash("Your account is locked", "warning")
     if user == current_user and not user.active:
@@ -23,17 +45,18 @@ def index(username):
 
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUM_WALL_PHOTO_PER_PAGE']
-    pagination = Photo.query.with_parent(user).order_by(Photo.timestamp.desc()).paginate(page, per_page)
+    pagination = queries.user_photos(user.id).paginate(page, per_page)
     photos = pagination.items
     return render_template('user/index.html', user=user, photos=photos, pagination=pagination)
 
 
 @user_bp.route('/<username>/collections')
+@replica_read
 def show_collections(username):
     user = User.query.filter_by(username=username).first()
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUM_WALL_PHOTO_PER_PAGE']
-    pagination = Collect.query.with_parent(user).paginate(page, per_page)
+    pagination = queries.collections(user.id).paginate(page, per_page)
     collections = pagination.items
     return render_template('user/collections.html', user=user, pagination=pagination, collections=collections)
 
@@ -68,22 +91,30 @@ def unfollow(username):
 
 
 @user_bp.route('/<username>/followers')
+@replica_read
 def show_followers(username):
     user = User.query.filter_by(username=username).first_or_404()
+    if user.deleted:
+        abort(404)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUM_WALL_USER_PER_PAGE']
-    pagination = user.followers.paginate(page, per_page)
+    pagination = queries.followers(user.id).paginate(page, per_page)
     followers = pagination.items
+    hydrate_follow_state([follow.follower for follow in followers])
     return render_template('user/followers.html', follows=followers, user=user, pagination=pagination)
 
 
 @user_bp.route('/<username>/following')
+@replica_read
 def show_following(username):
     user = User.query.filter_by(username=username).first_or_404()
+    if user.deleted:
+        abort(404)
     page = request.args.get('page', 1, type=1)
     per_page = current_app.config['ALBUM_WALL_USER_PER_PAGE']
-    pagination = user.followed.paginate(page, per_page)
+    pagination = queries.following(user.id).paginate(page, per_page)
     followings = pagination.items
+    hydrate_follow_state([follow.followed for follow in followings])
     return render_template('user/following.html', follows=followings, pagination=pagination, user=user)
 
 
@@ -114,7 +145,9 @@ def edit_profile():
 def change_avatar():
     upload_form = UploadAvatarForm()
     crop_form = CropAvatarForm()
-    return render_template('user/settings/change_avatar.html', upload_form=upload_form, crop_form=crop_form)
+    crop_task = current_user.get_task_in_progress('crop_avatar')
+    return render_template('user/settings/change_avatar.html', upload_form=upload_form, crop_form=crop_form,
+                           crop_task=crop_task)
 
 
 @user_bp.route('/settings/avatar/upload', methods=["POST"])
@@ -125,6 +158,7 @@ def upload_avatar():
     if form.validate_on_submit():
         image = form.image.data
         filename = avatars.save_avatar(image)
+        queue_file_deletions(avatar_paths([current_user.avatar_raw]))
         current_user.avatar_raw = filename
         db.session.commit()
         flash("Image upload, please crop", 'info')
@@ -138,16 +172,17 @@ def upload_avatar():
 def crop_avatar():
     form = CropAvatarForm()
     if form.validate_on_submit():
+        if current_user.avatar_raw is None:
+            flash("Upload an image first", 'warning')
+            return redirect(url_for('.change_avatar'))
         x = form.x.data
         y = form.y.data
         w = form.w.data
         h = form.h.data
-        filenames = avatars.crop_avatar(current_user.avatar_raw, x, y, w, h)
-        current_user.avatar_s = filenames[0]
-        current_user.avatar_m = filenames[1]
-        current_user.avatar_l = filenames[2]
-        db.session.commit()
-        flash("Avatar updated", 'success')
+        # cropping runs on the task queue, change_avatar polls ajax.task_status until it is done
+        launch_task('crop_avatar', 'Cropping avatar', current_user._get_current_object(),
+                    current_user.id, current_user.avatar_raw, x, y, w, h)
+        flash("Avatar is being updated", 'info')
     flash_errors(form)
     return redirect(url_for('.change_avatar'))
 
@@ -195,12 +230,14 @@ def notification_setting():
         current_user.receive_comment_notifications = form.receive_comment_notifications.data
         current_user.receive_collect_notifications = form.receive_collect_notifications.data
         current_user.receive_follow_notifications = form.receive_follow_notifications.data
+        current_user.receive_digest_emails = form.receive_digest_emails.data
         db.session.commit()
         flash("Setting updated", 'success')
         return redirect(url_for('.index', username=current_user.username))
     form.receive_comment_notifications.data = current_user.receive_comment_notifications
     form.receive_collect_notifications.data = current_user.receive_collect_notifications
     form.receive_follow_notifications.data = current_user.receive_follow_notifications
+    form.receive_digest_emails.data = current_user.receive_digest_emails
     return render_template('user/settings/edit_notification.html', form=form)
 
 
@@ -222,8 +259,12 @@ def privacy_setting():
 def delete_account():
     form = DeleteAccountForm()
     if form.validate_on_submit():
-        db.session.delete(current_user._get_current_object())
+        # mark now, the content is purged in chunks by a background task admins can follow
+        user = current_user._get_current_object()
+        user.deleted = True
         db.session.commit()
+        logout_user()
+        launch_task('delete_account', 'Deleting account %s' % user.username, None, user.id)
         flash("Your are kicked out, goodbye!", 'danger')
         return redirect(url_for('main.index'))
     return render_template('user/settings/delete_account.html', form=form)
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""Compressed responses.
+
+compress_response gzips, or with the brotli package installed brotli-compresses, the text the
+views send: HTML, JSON, CSS, JavaScript. It only does so for bodies of at least
+ALBUM_WALL_COMPRESS_MIN_SIZE bytes, smaller ones gain less than the header costs. Files and
+streams are left alone. The compressed body keeps a weak ETag, and a strong one gets the encoding
+added, so a 304 never pairs one encoding's ETag with another's body.
+
+The files under app/static would be compressed on every request that way, so they are sent as they
+are. `flask compress-static` writes a .gz and, with brotli, a .br next to each text file once at
+build time, and send_static_file serves the smallest variant the browser accepts.
+"""
+import gzip
+import mimetypes
+import os
+
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+from app import assets
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE = ('text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                'application/json', 'image/svg+xml')
+PRECOMPRESSED = ('.css', '.js', '.map', '.json', '.svg', '.txt', '.ttf', '.otf', '.eot', '.ico')
+
+
+def init_app(app):
+    app.after_request(compress_response)
+    app.view_functions['static'] = send_static_file
+
+
+def encodings():
+    # best first
+    accepted = [('br', '.br')] if brotli is not None else []
+    # the quality, not just the name: 'gzip;q=0' refuses gzip
+    return [(encoding, suffix) for encoding, suffix in accepted + [('gzip', '.gz')]
+            if request.accept_encodings[encoding] > 0]
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+def compress_response(response):
+    if response.direct_passthrough or response.is_streamed or response.status_code in (204, 304) \
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and \
+            response.content_length < current_app.config['ALBUM_WALL_COMPRESS_MIN_SIZE']:
+        return response
+    for encoding, suffix in encodings():
+        level = current_app.config['ALBUM_WALL_COMPRESS_BROTLI_QUALITY' if encoding == 'br'
+                                   else 'ALBUM_WALL_COMPRESS_GZIP_LEVEL']
+        response.set_data(compress(response.get_data(), encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag('%s-%s' % (etag, encoding))
+        break
+    return response
+
+
+def send_static_file(filename):
+    """The static view, with the precompressed variant of filename when there is one."""
+    folder = current_app.static_folder
+    for encoding, suffix in encodings():
+        path = safe_join(folder, filename + suffix)
+        if path is not None and os.path.isfile(path):
+            response = send_from_directory(folder, filename + suffix,
+                                           mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                           cache_timeout=assets.max_age(filename))
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    response = send_from_directory(folder, filename, cache_timeout=assets.max_age(filename))
+    if filename.endswith(PRECOMPRESSED):
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def precompress(folder, min_size=0):
+    """Write the .gz and .br of every text file under folder, return how many were written."""
+    variants = [('gzip', '.gz', 9)] + ([('br', '.br', 11)] if brotli is not None else [])
+    written = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if not name.endswith(PRECOMPRESSED) or os.path.getsize(path) < min_size:
+                continue
+            with open(path, 'rb') as f:
+                data = None
+                for encoding, suffix, level in variants:
+                    target = path + suffix
+                    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                        continue
+                    if data is None:
+                        data = f.read()
+                    compressed = compress(data, encoding, level)
+                    if len(compressed) >= len(data):
+                        continue
+                    with open(target, 'wb') as out:
+                        out.write(compressed)
+                    written += 1
+    return written
@@ -0,0 +1,79 @@
+"""Conditional GET for views whose output follows from a few version stamps.
+
+A view decorated with conditional(versions) first calls versions with the view's arguments. It
+returns what the response shows: Versioned rows, which stand for their cache_key(), and any other
+values, or None to skip the check. Their hash, with the path and query string, makes a weak
+ETag. A request whose If-None-Match carries it gets an empty 304 before the view runs, otherwise
+the view's response goes out with the ETag.
+
+A response is only as fresh as its ETag's parts, so pages add viewer(), for what they show the
+current user only, and page_viewer(), which adds the unread count of the navbar. A version stamp
+moves with the counts shown with its row, see models.changed_rows, so versions rarely needs more
+than a query by primary key. Requests with flashed messages waiting always run the view.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+from app.models import Notification, Versioned
+
+
+def conditional(versions):
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return func(*args, **kwargs)
+            parts = versions(*args, **kwargs)
+            if parts is None:
+                return func(*args, **kwargs)
+            etag = make_etag(parts)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # stored, but asked about before every use
+            response.cache_control.no_cache = True
+            if current_user.is_authenticated:
+                response.cache_control.private = True
+            return response
+        return decorated_function
+    return decorator
+
+
+def versions_of(model):
+    """versions for a view showing the one row its only argument names, the count endpoints."""
+    def versions(**kwargs):
+        instance = model.query.get(*kwargs.values())
+        return [instance] if instance is not None else None
+    return versions
+
+
+def make_etag(parts):
+    key = '\n'.join([request.full_path] + [part.cache_key() if isinstance(part, Versioned) else str(part)
+                                           for part in parts])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def viewer():
+    """What a response shows differently to the current user: their follows, collects and role."""
+    parts = [current_user.cache_key() if current_user.is_authenticated else 'anonymous']
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT')
+    if limit:
+        # a cached page's forms must not outlive the CSRF token in them
+        parts.append(int(time.time() // (limit / 2)))
+    return parts
+
+
+def page_viewer():
+    """viewer() and the unread count the navbar of a full page shows."""
+    parts = viewer()
+    if current_user.is_authenticated:
+        parts.append(Notification.query.with_parent(current_user).filter_by(is_read=False).count())
+    return parts
@@ -34,34 +34,73 @@ class BaseConfig:
 
     AVATARS_SAVE_PATH = os.path.join(ALBUM_WALL_UPLOAD_PATH, 'avatars')
     AVATARS_SIZE_TUPLE = (30, 100, 200)
+    ALBUM_WALL_IDENTICON_PATH = os.path.join(AVATARS_SAVE_PATH, 'identicons')
+    ALBUM_WALL_IDENTICON_CACHE_SIZE = 64*1024*1024  # bytes
 
     BOOTSTRAP_SERVE_LOCAL = True
 
     SECRET_KEY = os.getenv("SECRET_KEY", 'longsecretstringisme')
-    MAX_CONTENT_LENGTH = 3*1024*1024
+    MAX_CONTENT_LENGTH = 3*1024*1024  # per request, larger photos come in chunks, see app/uploads.py
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # SQLite connection settings, see app/sqlite.py, None keeps SQLite's default
+    ALBUM_WALL_SQLITE_JOURNAL_MODE = 'WAL'
+    ALBUM_WALL_SQLITE_SYNCHRONOUS = 'NORMAL'
+    ALBUM_WALL_SQLITE_BUSY_TIMEOUT = 5000  # milliseconds a writer waits for the lock
+    ALBUM_WALL_SQLITE_CACHE_SIZE = -16000  # negative is in KiB, per connection
+    ALBUM_WALL_SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # bytes
+    ALBUM_WALL_SQLITE_POOL_SIZE = 5  # connections kept per process for a file database, 0 opens one per request
+    ALBUM_WALL_REPLICA_URIS = os.getenv('ALBUM_WALL_REPLICA_URIS', '').split()  # for replica_read views
+    ALBUM_WALL_PRIMARY_PIN = 10  # seconds a browser reads from the primary after writing
+    ALBUM_WALL_PAGE_CACHE = 'memory'  # pages for anonymous visitors, per process; 'redis' shares them, None is off
+    ALBUM_WALL_PAGE_CACHE_TTL = 300  # seconds
+    ALBUM_WALL_PAGE_CACHE_SIZE = 64 * 1024 * 1024  # bytes per process with the memory store
+    ALBUM_WALL_FRAGMENT_CACHE = 'memory'  # {% cache %} blocks in templates, per process; 'redis' or None
+    ALBUM_WALL_FRAGMENT_CACHE_TTL = 3600  # seconds, for blocks that don't give their own
+    ALBUM_WALL_FRAGMENT_CACHE_SIZE = 10000  # fragments per process with the memory store
+    ALBUM_WALL_COMPRESS_MIN_SIZE = 1024  # bytes, smaller responses go out uncompressed
+    ALBUM_WALL_COMPRESS_GZIP_LEVEL = 6
+    ALBUM_WALL_COMPRESS_BROTLI_QUALITY = 4  # with the brotli package, `flask compress-static` uses 11
+    ALBUM_WALL_ASSETS_MANIFEST = 'dist/manifest.json'  # under app/static, written by `flask build-assets`
+    ALBUM_WALL_ASSETS_MAX_AGE = 365 * 24 * 3600  # seconds, for the hashed files
 
     ALBUM_WALL_MAIL_SUBJECT_PREFIX = '[ALBUM Wall]'
+    ALBUM_WALL_BASE_URL = os.getenv('ALBUM_WALL_BASE_URL', 'http://localhost:5000')  # for links in emails sent by jobs
+    ALBUM_WALL_DIGEST_CHUNK_SIZE = 1000  # recipients per transaction
     MAIL_SERVER = os.getenv("MAIL_SERVER") or 'localhost'
     MAIL_PORT = 465
     MAIL_USE_SSL = True
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = ("Album wall admin", MAIL_USERNAME)
+    MAIL_MAX_EMAILS = 100  # messages per SMTP connection, Flask-Mail reconnects after that
+    ALBUM_WALL_MAIL_BATCH_SIZE = 100  # messages claimed and recorded per transaction
+    ALBUM_WALL_MAIL_MAX_ATTEMPTS = 6
+    ALBUM_WALL_MAIL_RETRY_DELAY = 60  # seconds, doubled after every failed attempt
 
     DROPZONE_ALLOWED_FILE_TYPE = 'image'
-    DROPZONE_MAX_FILE_SIZE = 3
+    DROPZONE_MAX_FILE_SIZE = 30  # MB
+    ALBUM_WALL_MAX_PHOTO_SIZE = DROPZONE_MAX_FILE_SIZE * 1024 * 1024
+    ALBUM_WALL_UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes per upload request, below MAX_CONTENT_LENGTH
+    ALBUM_WALL_UPLOAD_WORKERS = None  # processes resizing a batch of uploads, None for one per CPU
     DROPZONE_MAX_FILES = 30
     DROPZONE_ENABLE_CSRF = True
 
     REDIS_URL = os.environ.get("REDIS_URL") or 'redis://'
+    ALBUM_WALL_TASKS_INLINE = False  # run background tasks in the request instead of on the rq queue
+    ALBUM_WALL_EVENT_BROKER = 'redis'  # or 'local', live notifications for this process only
+    ALBUM_WALL_EVENT_HEARTBEAT = 15  # seconds between keep-alives on an idle notification stream
+    ALBUM_WALL_EVENT_STREAM_TIMEOUT = 300  # seconds, then the browser opens a new stream
+    ALBUM_WALL_USER_CACHE_SIZE = 1000  # logged-in users each process keeps, 0 turns the cache off
+    ALBUM_WALL_USER_CACHE_LOCAL_TTL = 10  # seconds, how late a process may see another one's changes
+    ALBUM_WALL_USER_CACHE_REDIS_TTL = 3600  # seconds, 0 keeps the cache in the process only
 
     WHOOSHEE_MIN_STRING_LEN = 1
 
 
 class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, 'data-dev.db')
+    ALBUM_WALL_ASSETS_MANIFEST = None  # the static files as they are edited
     REDIS_URL = os.environ.get("REDIS_URL") or 'redis://localhost'
 
 
@@ -70,10 +109,18 @@ class TestingConfig(BaseConfig):
     WTF_CSRF_ENABLED = False
     WHOOSHEE_MEMORY_STORAGE = True
     SQLALCHEMY_DATABASE_URI = "sqlite:///"  # in-memory database
+    ALBUM_WALL_TASKS_INLINE = True
+    ALBUM_WALL_EVENT_BROKER = 'local'
+    ALBUM_WALL_USER_CACHE_REDIS_TTL = 0
+    ALBUM_WALL_PAGE_CACHE = 'memory'
+    ALBUM_WALL_FRAGMENT_CACHE = 'memory'
+    ALBUM_WALL_ASSETS_MANIFEST = None
 
 
 class ProductionConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", prefix + os.path.join(basedir, 'data.db'))
+    ALBUM_WALL_PAGE_CACHE = 'redis'
+    ALBUM_WALL_FRAGMENT_CACHE = 'redis'
 
 
 class Operations:
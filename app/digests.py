@@ -0,0 +1,83 @@
+"""Daily email digests of unread notifications.
+
+Opted-in users are walked in keyset chunks of ALBUM_WALL_DIGEST_CHUNK_SIZE, so memory stays flat however many
+there are. Each chunk's digests go into the OutgoingMail outbox in one insert, together with the users'
+last_digest_at, and tasks.deliver_mail sends them while the next chunk is being built. Run it once a day
+with `flask send-digests`.
+"""
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app, url_for
+from markupsafe import Markup
+
+from app.extensions import db
+from app.models import User, Notification, OutgoingMail
+
+DIGEST_LIMIT = 10  # notifications listed per email, the rest are only counted
+
+
+def send_digests(window=timedelta(days=1), chunk_size=None, now=None):
+    """Queue a digest for every opted-in user with unread notifications in the window, return how many."""
+    from app.tasks import enqueue_job_once
+
+    chunk_size = chunk_size or current_app.config['ALBUM_WALL_DIGEST_CHUNK_SIZE']
+    now = now or datetime.utcnow()
+    base_url = current_app.config['ALBUM_WALL_BASE_URL']
+    # compiled once for the whole run, render_template would look them up and fire signals per message
+    text_template = current_app.jinja_env.get_template('emails/digest.txt')
+    html_template = current_app.jinja_env.get_template('emails/digest.html')
+    with current_app.test_request_context(base_url=base_url):
+        links = dict(notifications_url=url_for('main.show_notifications', filter='unread', _external=True),
+                     settings_url=url_for('user.notification_setting', _external=True))
+    subject = current_app.config['ALBUM_WALL_MAIL_SUBJECT_PREFIX'] + 'Your daily digest'
+
+    total = 0
+    last_id = 0
+    while True:
+        users = db.session.query(User.id, User.username, User.email, User.last_digest_at)\
+            .filter(User.id > last_id, User.receive_digest_emails == True, User.confirmed == True,  # noqa: E712
+                    User.active == True, User.deleted == False)\
+            .order_by(User.id).limit(chunk_size).all()
+        if not users:
+            return total
+        last_id = users[-1].id
+
+        unread = defaultdict(list)
+        for receiver_id, message, timestamp in db.session.query(
+                Notification.receiver_id, Notification.message, Notification.timestamp)\
+                .filter(Notification.receiver_id.in_([user.id for user in users]),
+                        Notification.is_read == False, Notification.timestamp > now - window,  # noqa: E712
+                        Notification.timestamp <= now)\
+                .order_by(Notification.receiver_id, Notification.timestamp.desc()):
+            unread[receiver_id].append((message, timestamp))
+
+        rows = []
+        user_ids = []
+        for user in users:
+            notifications = [(message, timestamp) for message, timestamp in unread[user.id]
+                             if user.last_digest_at is None or timestamp > user.last_digest_at]
+            if not notifications:
+                continue
+            listed = notifications[:DIGEST_LIMIT]
+            context = dict(username=user.username, count=len(notifications), **links)
+            rows.append(dict(
+                recipient=user.email, subject=subject, attempts=0, dead=False, next_attempt=now, timestamp=now,
+                body=text_template.render(notifications=[(Markup(message).striptags(), timestamp)
+                                                         for message, timestamp in listed], **context),
+                html=html_template.render(notifications=[(Markup(_absolute_links(message, base_url)), timestamp)
+                                                         for message, timestamp in listed], **context)))
+            user_ids.append(user.id)
+        if rows:
+            db.session.execute(OutgoingMail.__table__.insert(), rows)
+            db.session.execute(User.__table__.update().where(User.id.in_(user_ids)).values(last_digest_at=now))
+        db.session.commit()
+        if rows:
+            enqueue_job_once('deliver_mail')
+            total += len(rows)
+
+
+def _absolute_links(message, base_url):
+    # notifications link relative to the site, the email client needs the host
+    return re.sub(r'href=(["\'])/', lambda match: 'href=%s%s/' % (match.group(1), base_url.rstrip('/')), message)
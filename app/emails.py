@@ -1,24 +1,33 @@
-from threading import Thread
+"""Outgoing email.
+
+send_mail only writes the message to the OutgoingMail outbox and queues a tasks.deliver_mail job. Delivery
+claims due messages in batches and sends each batch over one SMTP connection. Failed messages are retried
+with exponential backoff and end up as dead letters after ALBUM_WALL_MAIL_MAX_ATTEMPTS. A message whose
+batch was sent but not recorded, because the worker died, is sent again once its claim expires.
+"""
+import smtplib
+from datetime import datetime, timedelta
+from uuid import uuid4
 
 from flask import current_app, render_template
 from flask_mail import Message
 
-from app.extensions import mail
-
+from app.extensions import db, mail
+from app.models import OutgoingMail
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+CLAIM_TIMEOUT = timedelta(minutes=10)
 
 
 def send_mail(to, subject, template, **kwargs):
-    message = Message(current_app.config['ALBUM_WALL_MAIL_SUBJECT_PREFIX'] + subject, recipients=[to])
-    message.body = render_template(template + '.txt', **kwargs)
-    message.html = render_template(template + '.html', **kwargs)
-    app = current_app._get_current_object()
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    message = OutgoingMail(recipient=to, subject=current_app.config['ALBUM_WALL_MAIL_SUBJECT_PREFIX'] + subject,
+                           body=render_template(template + '.txt', **kwargs),
+                           html=render_template(template + '.html', **kwargs))
+    db.session.add(message)
+    db.session.commit()
+
+    from app.tasks import enqueue_job_once
+    enqueue_job_once('deliver_mail')
+    return message
 
 
 def send_confirmation_email(user, token, to=None):
@@ -26,4 +35,111 @@ def send_confirmation_email(user, token, to=None):
 
 
 def send_reset_password_email(user, token):
-    send_mail(subject="Password Reset", to=user.email, template='emails/reset_password', user=user, token=token)
\ No newline at end of file
+    send_mail(subject="Password Reset", to=user.email, template='emails/reset_password', user=user, token=token)
+
+
+def deliver_queued_mail(batch_size=None):
+    """Send the due messages of the outbox and return (sent, failed).
+
+    The SMTP connection is opened for the first message and kept for the whole run.
+    """
+    batch_size = batch_size or current_app.config['ALBUM_WALL_MAIL_BATCH_SIZE']
+    sent_count = failed_count = 0
+    connection = None
+    try:
+        while True:
+            batch = _claim(batch_size)
+            if not batch:
+                break
+            if connection is None:
+                try:
+                    connection = mail.connect().__enter__()
+                except OSError as e:  # smtplib errors are OSErrors too
+                    sent, failed, unsent = [], [(batch[0], e)], batch[1:]
+                else:
+                    sent, failed, unsent = _send_batch(connection, batch)
+            else:
+                sent, failed, unsent = _send_batch(connection, batch)
+            _record(sent, failed, unsent)
+            sent_count += len(sent)
+            failed_count += len(failed)
+            if unsent:  # the server is unreachable, try again later
+                break
+    finally:
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+    return sent_count, failed_count
+
+
+def _claim(batch_size):
+    now = datetime.utcnow()
+    free = db.or_(OutgoingMail.claimed_by == None, OutgoingMail.claimed_at < now - CLAIM_TIMEOUT)  # noqa: E711
+    ids = [row[0] for row in db.session.query(OutgoingMail.id)
+           .filter(OutgoingMail.dead == False, OutgoingMail.next_attempt <= now, free)  # noqa: E712
+           .order_by(OutgoingMail.id).limit(batch_size)]
+    if not ids:
+        return []
+    # a concurrent run may have taken some of them meanwhile, the update only claims what is still free
+    token = uuid4().hex
+    OutgoingMail.query.filter(OutgoingMail.id.in_(ids), free)\
+        .update(dict(claimed_by=token, claimed_at=now), synchronize_session=False)
+    db.session.commit()
+    return OutgoingMail.query.filter_by(claimed_by=token).order_by(OutgoingMail.id).all()
+
+
+def _send_batch(connection, batch):
+    sent, failed = [], []
+    for i, outgoing in enumerate(batch):
+        message = Message(outgoing.subject, recipients=[outgoing.recipient], body=outgoing.body, html=outgoing.html)
+        try:
+            _send(connection, message)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError) as e:
+            failed.append((outgoing, e))
+            return sent, failed, batch[i + 1:]
+        except smtplib.SMTPException as e:  # this message was refused
+            failed.append((outgoing, e))
+            continue
+        except OSError as e:
+            # the connection is gone, the rest of the batch waits for the server to come back
+            failed.append((outgoing, e))
+            return sent, failed, batch[i + 1:]
+        sent.append(outgoing)
+    return sent, failed, []
+
+
+def _send(connection, message):
+    try:
+        connection.send(message)
+    except smtplib.SMTPServerDisconnected:
+        # servers drop idle connections, retry once on a fresh one
+        connection.host = connection.configure_host()
+        connection.num_emails = 0
+        connection.send(message)
+
+
+def _permanent(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def _record(sent, failed, unsent):
+    if sent:
+        OutgoingMail.query.filter(OutgoingMail.id.in_([outgoing.id for outgoing in sent]))\
+            .delete(synchronize_session=False)
+    max_attempts = current_app.config['ALBUM_WALL_MAIL_MAX_ATTEMPTS']
+    delay = current_app.config['ALBUM_WALL_MAIL_RETRY_DELAY']
+    now = datetime.utcnow()
+    for outgoing, error in failed:
+        outgoing.attempts += 1
+        outgoing.last_error = ('%s: %s' % (type(error).__name__, error))[:255]
+        outgoing.dead = _permanent(error) or outgoing.attempts >= max_attempts
+        outgoing.next_attempt = now + timedelta(seconds=delay * 2 ** (outgoing.attempts - 1))
+        current_app.logger.warning('Could not send mail %d to %s: %s', outgoing.id, outgoing.recipient,
+                                   outgoing.last_error)
+    for outgoing in [outgoing for outgoing, _ in failed] + unsent:
+        outgoing.claimed_by = outgoing.claimed_at = None
+    db.session.commit()
@@ -0,0 +1,152 @@
+"""Live notification events, pushed to the browser over Server-Sent Events.
+
+push_*_notification publishes the receiver's new unread count on the receiver's channel, and
+ajax.notifications_stream relays the events of the current user's channel to the page. The stream
+counts the unread notifications once when it opens and then only waits on the channel, so an idle
+user costs no queries.
+
+With ALBUM_WALL_EVENT_BROKER = 'redis' events go through Redis pub/sub and every web process gets
+them; each process listens on one Redis connection and hands the events to its own streams. 'local'
+keeps them in this process, which is what the tests and a single development server need.
+
+Every open stream holds a worker, so the web server needs threaded or gevent workers. Streams end
+after ALBUM_WALL_EVENT_STREAM_TIMEOUT and the browser reconnects by itself.
+"""
+import json
+import time
+from collections import defaultdict
+from queue import Queue, Empty
+from threading import Lock, Thread
+
+from flask import current_app
+from markupsafe import Markup
+
+from app.models import Notification
+
+CHANNEL_PREFIX = 'flask-album:events:'
+RETRY = 3000  # milliseconds the browser waits before reconnecting
+
+
+class LocalBroker:
+    """Channels of this process."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._queues = defaultdict(set)
+
+    def publish(self, channel, event):
+        self._deliver(channel, event)
+
+    def subscribe(self, channel):
+        return Subscription(self, channel)
+
+    def _deliver(self, channel, event):
+        with self._lock:
+            queues = list(self._queues.get(channel, ()))
+        for queue in queues:
+            queue.put(event)
+
+    def _add(self, channel, queue):
+        with self._lock:
+            self._queues[channel].add(queue)
+
+    def _remove(self, channel, queue):
+        with self._lock:
+            self._queues[channel].discard(queue)
+            if not self._queues[channel]:
+                del self._queues[channel]
+
+
+class RedisBroker(LocalBroker):
+    """Channels shared by all processes through Redis pub/sub."""
+
+    def __init__(self, redis, logger):
+        super().__init__()
+        self.redis = redis
+        self.logger = logger
+        self._listener = None
+
+    def publish(self, channel, event):
+        self.redis.publish(CHANNEL_PREFIX + channel, json.dumps(event))
+
+    def subscribe(self, channel):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = Thread(target=self._listen, name='event-listener', daemon=True)
+                self._listener.start()
+        return super().subscribe(channel)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(CHANNEL_PREFIX + '*')
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        channel = message['channel'].decode()[len(CHANNEL_PREFIX):]
+                        self._deliver(channel, json.loads(message['data']))
+            except Exception:
+                # events published meanwhile are lost, the next one carries the current count again
+                self.logger.exception('Lost the event subscription, reconnecting')
+                time.sleep(1)
+
+
+class Subscription:
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = Queue()
+        broker._add(channel, self.queue)
+
+    def get(self, timeout):
+        """Wait up to timeout seconds for the next event, None if there was none."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.broker._remove(self.channel, self.queue)
+
+
+def make_broker(app):
+    if app.config['ALBUM_WALL_EVENT_BROKER'] == 'redis':
+        return RedisBroker(app.redis, app.logger)
+    return LocalBroker()
+
+
+def user_channel(user_id):
+    return 'user:%d' % user_id
+
+
+def publish_notification(receiver, notification=None):
+    """Send receiver's unread count, and the new notification if there is one, to their open pages."""
+    event = dict(count=Notification.query.with_parent(receiver).filter_by(is_read=False).count())
+    if notification is not None:
+        event['message'] = Markup(notification.message).striptags()
+    try:
+        current_app.broker.publish(user_channel(receiver.id), event)
+    except Exception:
+        # the page still shows the right count on the next load
+        current_app.logger.exception('Could not publish a notification event for user %d', receiver.id)
+
+
+def stream(subscription, first_event, heartbeat, timeout):
+    """Yield first_event and then the subscription's events as an SSE body, closing it at the end."""
+    deadline = time.monotonic() + timeout
+    try:
+        yield 'retry: %d\n' % RETRY + _format(first_event)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            event = subscription.get(min(heartbeat, remaining))
+            # the comment keeps proxies from closing an idle connection
+            yield _format(event) if event is not None else ': keep-alive\n\n'
+    finally:
+        subscription.close()
+
+
+def _format(event):
+    return 'data: %s\n\n' % json.dumps(event)
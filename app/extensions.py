@@ -1,5 +1,5 @@
 from flask_bootstrap import Bootstrap
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 from flask_moment import Moment
 from flask_mail import Mail
 from flask_login import LoginManager, AnonymousUserMixin
@@ -7,24 +7,55 @@ from flask_wtf.csrf import CSRFProtect
 from flask_dropzone import Dropzone
 from flask_avatars import Avatars
 from flask_whooshee import Whooshee
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import SelectBase
+
+
+class RoutingSession(SignallingSession):
+    """Sends the reads of a replica_read view to the replica bind in info['replica'], see app.replicas."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None:
+            if not self._flushing and isinstance(clause, SelectBase):
+                return get_state(self.app).db.get_engine(self.app, bind=replica)
+            # the request writes, it reads its own writes from here on
+            del self.info['replica']
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class SessionWhooshee(Whooshee):
+    """Leaves out the rows a session inserts while its info has defer_search_index set, the caller
+    adds them to the index itself, see accounts.create_users."""
+
+    def after_insert(self, mapper, connection, target):
+        session = orm.object_session(target)
+        if session is not None and session.info.get('defer_search_index'):
+            return
+        super(SessionWhooshee, self).after_insert(mapper, connection, target)
 
 
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 moment = Moment()
 mail = Mail()
 login_manager = LoginManager()
 csrf = CSRFProtect()
 dropzone = Dropzone()
 avatars = Avatars()
-whooshee = Whooshee()
+whooshee = SessionWhooshee()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    from app.models import User
-    user = User.query.get(int(user_id))
-    return user
+    from app.principals import load_user
+    return load_user(user_id)
 
 
 login_manager.login_view = 'auth.login'
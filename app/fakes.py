@@ -1,15 +1,86 @@
+"""Synthetic data for `flask forge`.
+
+Rows are written with core insert() in chunks and explicit ids, the social graph follows a
+power law (a few users, photos and tags get most of the follows, collects, comments and
+taggings), photo files are hard links into a small pool of placeholder images, and everything
+is reproducible from the seed.
+"""
 import os
 import random
+import shutil
+from datetime import datetime, timedelta
+from itertools import accumulate
 
 from PIL import Image
 from faker import Faker
-from sqlalchemy.exc import IntegrityError
-
-from app.extensions import db
-from app.models import User, Photo, Tag, Comment, Notification
 from flask import current_app
+from sqlalchemy import func
+from werkzeug.security import generate_password_hash
+
+from app.extensions import db, whooshee
+from app.identicons import identicon_filenames
+from app.models import User, Photo, Tag, Comment, Collect, Follow, Notification, Role, tagging
 
 fake = Faker()
+rng = random.Random()
+
+BASE_TIME = datetime(2019, 1, 1)
+PLACEHOLDER_COUNT = 8
+
+
+def seed(value):
+    rng.seed(value)
+    fake.seed_instance(value)
+
+
+def _timestamp(days=365):
+    return BASE_TIME + timedelta(seconds=rng.randint(0, days * 24 * 3600))
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _insert(table, rows, chunk_size):
+    """Insert an iterable of row dicts, one executemany and commit per chunk."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+
+
+def _power_law(ids, exponent=1.1):
+    """Return pick(k), drawing k ids with Zipf-like popularity shuffled over the ids."""
+    ids = list(ids)
+    rng.shuffle(ids)
+    cum_weights = list(accumulate(1.0 / rank ** exponent for rank in range(1, len(ids) + 1)))
+
+    def pick(k=1):
+        return rng.choices(ids, cum_weights=cum_weights, k=k)
+    return pick
+
+
+def _unique_pairs(count, first, second, exclude_equal=False):
+    # stops early when the graph is too small to hold count distinct pairs
+    pairs = set()
+    attempts = 0
+    while len(pairs) < count and attempts < count * 10:
+        attempts += 1
+        pair = (first(), second())
+        if exclude_equal and pair[0] == pair[1]:
+            continue
+        pairs.add(pair)
+    return sorted(pairs)
+
+
+def _ids(model):
+    return [row[0] for row in db.session.query(model.id).order_by(model.id)]
 
 
 def fake_admin():
@@ -28,85 +99,129 @@ def fake_admin():
     db.session.commit()
 
 
-def fake_user(count=10):
-    for c in range(count):
-        user = User(
-            name=fake.name(),
-            username=fake.user_name(),
-            email=fake.email(),
-            bio=fake.sentence(),
-            location=fake.city(),
-            website=fake.url(),
-            member_since=fake.date_this_decade(),
-            confirmed=True
-        )
-        user.set_password('123456789')
-        db.session.add(user)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
-
-
-def fake_photo(count=30):
-    # photo
+def fake_user(count=10, chunk_size=10000):
+    start = _next_id(User)
+    role_id = Role.by_name('User').id
+    password_hash = generate_password_hash('123456789')
+
+    def rows():
+        for user_id in range(start, start + count):
+            # the id suffix keeps usernames unique and within the 10 characters of the column
+            suffix = str(user_id)
+            username = fake.user_name().replace('.', '')[:10 - len(suffix)] + suffix
+            avatar_s, avatar_m, avatar_l = identicon_filenames(username)
+            yield dict(id=user_id, username=username, email=username + '@example.com',
+                       password_hash=password_hash, name=fake.name()[:20], bio=fake.sentence()[:120],
+                       location=fake.city()[:50], website=fake.url(), member_since=_timestamp(365 * 3),
+                       confirmed=True, locked=False, active=True, deleted=False, role_id=role_id,
+                       avatar_s=avatar_s, avatar_m=avatar_m, avatar_l=avatar_l, public_collections=True,
+                       receive_collect_notifications=True, receive_comment_notifications=True,
+                       receive_follow_notifications=True)
+
+    _insert(User.__table__, rows(), chunk_size)
+    # everyone follows themselves, see User.__init__
+    _insert(Follow.__table__, (dict(follower_id=user_id, followed_id=user_id, timestamp=BASE_TIME)
+                               for user_id in range(start, start + count)), chunk_size)
+
+
+def fake_follow(count=30, chunk_size=10000):
+    user_ids = _ids(User)
+    followed = _power_law(user_ids)
+    existing = set(db.session.query(Follow.follower_id, Follow.followed_id))
+    pairs = _unique_pairs(count, lambda: rng.choice(user_ids), lambda: followed()[0], exclude_equal=True)
+    _insert(Follow.__table__, (dict(follower_id=a, followed_id=b, timestamp=_timestamp())
+                               for a, b in pairs if (a, b) not in existing), chunk_size)
+
+
+def fake_tag(count=20, chunk_size=10000):
+    start = _next_id(Tag)
+    names = set(row[0] for row in db.session.query(Tag.name))
+
+    def rows():
+        for tag_id in range(start, start + count):
+            name = fake.word()
+            if name in names:
+                name += str(tag_id)
+            names.add(name)
+            yield dict(id=tag_id, name=name)
+
+    _insert(Tag.__table__, rows(), chunk_size)
+
+
+def _placeholders():
+    # a handful of real images that every fake photo is hard linked to
+    path = os.path.join(current_app.config['ALBUM_WALL_UPLOAD_PATH'], '.placeholders')
+    if not os.path.exists(path):
+        os.makedirs(path)
+    filenames = []
+    for i in range(PLACEHOLDER_COUNT):
+        filename = os.path.join(path, 'placeholder_%d.jpg' % i)
+        if not os.path.exists(filename):
+            color = tuple(random.Random(i).randint(128, 255) for _ in range(3))
+            Image.new(mode="RGB", size=(800, 800), color=color).save(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def _link(source, target):
+    # every photo owns its own directory entry, so deleting one never touches the others
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def fake_photo(count=30, chunk_size=10000):
     upload_path = current_app.config['ALBUM_WALL_UPLOAD_PATH']
-    for i in range(count):
-        print i
-        filename = "random_%d.jpg" % i
-        r = lambda: random.randint(128, 255)
-        img = Image.new(mode="RGB", size=(800, 800), color=(r(), r(), r()))
-        img.save(os.path.join(upload_path, filename))
-
-        photo = Photo(
-            description=fake.text(),
-            filename=filename,
-            filename_m=filename,
-            filename_s=filename,
-            author=User.query.get(random.randint(1, User.query.count())),
-            timestamp=fake.date_time_this_year()
-        )
-        # tag
-        for j in range(random.randint(1, 5)):
-            tag = Tag.query.get(random.randint(1, Tag.query.count()))
-            if tag not in photo.tags:
-                photo.tags.append(tag)
-
-        db.session.add(photo)
-    db.session.commit()
-
-
-def fake_follow(count=30):
-    for i in range(count):
-        user = User.query.get(random.randint(1, User.query.count()))
-        user.follow(User.query.get(random.randint(1, User.query.count())))
-        db.session.commit()
-
-
-def fake_tag(count=20):
-    for i in range(count):
-        tag = Tag(name=fake.word())
-        db.session.add(tag)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
-
-
-def fake_collect(count=50):
-    for i in range(count):
-        user = User.query.get(random.randint(1, User.query.count()))
-        user.collect(Photo.query.get(random.randint(1, User.query.count())))
-    db.session.commit()
-
-
-def fake_comment(count=100):
-    for i in range(count):
-        comment = Comment(
-            body=fake.sentence(),
-            author=User.query.get(random.randint(1, User.query.count())),
-            timestamp=fake.date_time_this_year(),
-            photo=Photo.query.get(random.randint(1, Photo.query.count()))
-        )
-        db.session.add(comment)
-    db.session.commit()
+    placeholders = _placeholders()
+    start = _next_id(Photo)
+    author = _power_law(_ids(User))
+    tag_ids = _ids(Tag)
+    tag = _power_law(tag_ids) if tag_ids else None
+    photo_tags = []
+
+    def rows():
+        for photo_id in range(start, start + count):
+            filename = 'fake_%d.jpg' % photo_id
+            _link(placeholders[photo_id % len(placeholders)], os.path.join(upload_path, filename))
+            if tag is not None:
+                for tag_id in set(tag(rng.randint(1, 5))):
+                    photo_tags.append(dict(photo_id=photo_id, tag_id=tag_id))
+            yield dict(id=photo_id, description=fake.text()[:500], filename=filename, filename_s=filename,
+                       filename_m=filename, author_id=author()[0], timestamp=_timestamp(), comment_allowed=True,
+                       flag=0)
+
+    _insert(Photo.__table__, rows(), chunk_size)
+    _insert(tagging, photo_tags, chunk_size)
+
+
+def fake_collect(count=50, chunk_size=10000):
+    user_ids = _ids(User)
+    photo = _power_law(_ids(Photo))
+    existing = set(db.session.query(Collect.collector_id, Collect.collected_id))
+    pairs = _unique_pairs(count, lambda: rng.choice(user_ids), lambda: photo()[0])
+    _insert(Collect.__table__, (dict(collector_id=a, collected_id=b, timestamp=_timestamp())
+                                for a, b in pairs if (a, b) not in existing), chunk_size)
+
+
+def fake_comment(count=100, chunk_size=10000):
+    start = _next_id(Comment)
+    author = _power_law(_ids(User))
+    photo = _power_law(_ids(Photo))
+    _insert(Comment.__table__, (dict(id=comment_id, body=fake.sentence(), author_id=author()[0],
+                                     photo_id=photo()[0], timestamp=_timestamp(), flag=0)
+                                for comment_id in range(start, start + count)), chunk_size)
+
+
+def fake_search_index(chunk_size=10000):
+    """Rebuild the whooshee indexes, core inserts bypass its hooks."""
+    for wh in whooshee.whoosheers:
+        index = type(whooshee).get_or_create_index(current_app, wh)
+        writer = index.writer(timeout=current_app.extensions['whooshee']['writer_timeout'])
+        for model in wh.models:
+            update = getattr(wh, 'update_' + model.__name__.lower())
+            for item in model.query.order_by(model.id).yield_per(chunk_size):
+                update(writer, item)
+        writer.commit()
@@ -50,6 +50,7 @@ class NotificationSettingForm(FlaskForm):
     receive_comment_notifications = BooleanField("New comment")
     receive_collect_notifications = BooleanField("New collect")
     receive_follow_notifications = BooleanField("New follower")
+    receive_digest_emails = BooleanField("Daily email digest of unread notifications")
     submit = SubmitField()
 
 
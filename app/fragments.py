@@ -0,0 +1,124 @@
+"""Cache for the parts of a template that cost queries to render.
+
+The FragmentCacheExtension adds a cache tag to the app's Jinja environment:
+
+    {% cache ('photo-card', photo), 3600 %}
+        ... {{ photo.comments|length }} ...
+    {% endcache %}
+
+The key is a string or a tuple, the TTL in seconds defaults to ALBUM_WALL_FRAGMENT_CACHE_TTL. A
+User, Photo, Tag or Comment in the key stands for its cache_key(), which changes with the row and
+with the comments, collects, follows and taggings counted on it, so the entry is rebuilt as soon
+as one of them does. A fragment must not depend on who is looking: keep the current_user parts
+outside the cache tag.
+
+ALBUM_WALL_FRAGMENT_CACHE picks the store, 'memory' keeps ALBUM_WALL_FRAGMENT_CACHE_SIZE fragments
+in each process, 'redis' shares them between processes and None turns the cache off. Only
+ProductionConfig uses 'redis'.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app.models import Versioned
+
+KEY_PREFIX = 'flask-album:fragments:'
+
+
+class MemoryFragmentStore:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (fragment, expires)
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, fragment, ttl):
+        with self._lock:
+            self._data[key] = (fragment, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class RedisFragmentStore:
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def get(self, key):
+        data = self.redis.get(KEY_PREFIX + key)
+        return data.decode() if data is not None else None
+
+    def set(self, key, fragment, ttl):
+        self.redis.set(KEY_PREFIX + key, fragment.encode(), ex=ttl)
+
+
+def make_fragment_store(app):
+    store = app.config['ALBUM_WALL_FRAGMENT_CACHE']
+    if store == 'redis':
+        return RedisFragmentStore(app.redis)
+    if store == 'memory':
+        return MemoryFragmentStore(app.config['ALBUM_WALL_FRAGMENT_CACHE_SIZE'])
+    return None
+
+
+def fragment_key(key):
+    parts = key if isinstance(key, (tuple, list)) else (key,)
+    return ':'.join(_key_part(part) for part in parts)
+
+
+def _key_part(part):
+    if isinstance(part, Versioned):
+        return part.cache_key()
+    return str(part)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, key, ttl, caller):
+        store = current_app.fragment_store
+        if store is None:
+            return caller()
+        key = fragment_key(key)
+        try:
+            fragment = store.get(key)
+        except Exception:
+            current_app.logger.exception('Could not read %s from the fragment cache', key)
+            return caller()
+        if fragment is not None:
+            # rendered and escaped before it was stored
+            return Markup(fragment)
+
+        fragment = caller()
+        try:
+            store.set(key, str(fragment), ttl or current_app.config['ALBUM_WALL_FRAGMENT_CACHE_TTL'])
+        except Exception:
+            current_app.logger.exception('Could not write %s to the fragment cache', key)
+        return fragment
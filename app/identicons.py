@@ -0,0 +1,106 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from flask import current_app
+from flask_avatars import Identicon
+
+# default avatars are named after a hash of the username and only drawn when first requested
+PREFIX = 'identicons/'
+SUFFIXES = ('s', 'm', 'l')
+FILENAME_RE = re.compile(r'^[0-9a-f]{32}_([sml])\.png$')
+
+# bytes held by each cache directory as far as this process knows, see _evict
+_cache_sizes = {}
+
+
+def identicon_filenames(username):
+    """Return the avatar_s/m/l values for a user's default avatar, no image I/O involved."""
+    digest = hashlib.md5(username.encode('utf-8')).hexdigest()
+    return ['%s%s_%s.png' % (PREFIX, digest, suffix) for suffix in SUFFIXES]
+
+
+def is_identicon(filename):
+    return filename is not None and filename.startswith(PREFIX)
+
+
+def identicon_path(filename):
+    """Return the cached file for an identicon filename, drawing it first if needed.
+
+    Returns None when filename is not a valid identicon name.
+    """
+    name = filename[len(PREFIX):]
+    match = FILENAME_RE.match(name)
+    if match is None:
+        return None
+
+    cache_dir = current_app.config['ALBUM_WALL_IDENTICON_PATH']
+    path = os.path.join(cache_dir, name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        _render(name, match.group(1), cache_dir, path)
+    else:
+        # mtime doubles as the LRU clock, bump it at most once an hour to keep hits cheap
+        if time.time() - stat.st_mtime > 3600:
+            os.utime(path, None)
+    return path
+
+
+def _render(name, suffix, cache_dir, path):
+    digest = name.split('_')[0]
+    size = current_app.config['AVATARS_SIZE_TUPLE'][SUFFIXES.index(suffix)]
+    # colours come from the hash too, so every worker draws the same picture
+    raw = bytes.fromhex(digest)
+    identicon = Identicon(bg_color=tuple(80 + b % 128 for b in raw[3:6]))
+    identicon.fg_colour = tuple(127 + b % 128 for b in raw[0:3])
+    data = identicon.get_image(string=digest, width=size, height=size, pad=int(size * 0.1))
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)  # concurrent renders of the same name are harmless
+    _evict(cache_dir, len(data))
+
+
+def _evict(cache_dir, added):
+    # the directory is only scanned when this process thinks it went over the limit,
+    # then the least recently used files are removed down to 90% of it
+    limit = current_app.config['ALBUM_WALL_IDENTICON_CACHE_SIZE']
+    if cache_dir not in _cache_sizes:
+        _cache_sizes[cache_dir] = _scan(cache_dir)[1]
+    else:
+        _cache_sizes[cache_dir] += added
+    if _cache_sizes[cache_dir] <= limit:
+        return
+
+    entries, total = _scan(cache_dir)
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= limit * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    _cache_sizes[cache_dir] = total
+
+
+def _scan(cache_dir):
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.png'):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+    return entries, total
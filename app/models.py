@@ -1,12 +1,45 @@
 import os
 from datetime import datetime
 
-from flask import current_app
-from flask_avatars import Identicon
+from flask import current_app, _request_ctx_stack
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from app.extensions import db, whooshee
+from app.identicons import identicon_filenames, is_identicon
+
+
+def _request_cache(name, owner_id):
+    # per-request memo so one page asks the database about a relationship only once
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return {}
+    if not hasattr(ctx, 'album_wall_cache'):
+        ctx.album_wall_cache = {}
+    return ctx.album_wall_cache.setdefault((name, owner_id), {})
+
+
+def _lookup_ids(cache, ids, query):
+    # fill cache for the ids not seen yet with a single IN query, return the matching subset
+    ids = [i for i in ids if i is not None]
+    missing = [i for i in set(ids) if i not in cache]
+    if missing:
+        for i in missing:
+            cache[i] = False
+        for row in query(missing):
+            cache[row[0]] = True
+    return set(i for i in ids if cache[i])
+
+
+class Versioned:
+    """Rows the caches key on. version goes up with every change to the row or to a count shown
+    with it, see bump_version and touch_parents."""
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def cache_key(self):
+        """'photo:12:3' for version 3 of photo 12, the key every cache of the row is built on."""
+        return '%s:%d:%d' % (self.__tablename__, self.id, self.version)
 
 
 # relationship table
@@ -28,6 +61,18 @@ class Role(db.Model):
     users = db.relationship("User", back_populates="role")
     permissions = db.relationship('Permission', secondary=roles_permissions, back_populates='roles')
 
+    @staticmethod
+    def by_name(name):
+        # roles are seeded once and almost never change, so remember their ids for the life of the
+        # session; get() answers from the identity map while the role is loaded
+        cache = db.session.info.setdefault('role_ids_by_name', {})
+        role = Role.query.get(cache[name]) if name in cache else None
+        if role is None or role.name != name:
+            role = Role.query.filter_by(name=name).first()
+            if role is not None:
+                cache[name] = role.id
+        return role
+
     @staticmethod
     def init_role():
         roles_permissions_map = {
@@ -50,10 +95,14 @@ class Role(db.Model):
                     db.session.add(permission)
                 role.permissions.append(permission)
         db.session.commit()
+        db.session.info.pop('role_ids_by_name', None)
 
 
 # relationship object
 class Follow(db.Model):
+    # the primary key serves the following side, this one the followers side
+    __table_args__ = (db.Index('ix_follow_followed_follower', 'followed_id', 'follower_id'),)
+
     follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -64,6 +113,9 @@ class Follow(db.Model):
 
 # relationsip object
 class Collect(db.Model):
+    __table_args__ = (db.Index('ix_collect_collected_collector', 'collected_id', 'collector_id'),
+                      db.Index('ix_collect_collector_timestamp', 'collector_id', 'timestamp'))
+
     collector_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     collected_id = db.Column(db.Integer, db.ForeignKey('photo.id'), primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -72,7 +124,7 @@ class Collect(db.Model):
 
 
 @whooshee.register_model('name', 'username')
-class User(db.Model, UserMixin):
+class User(db.Model, Versioned, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(10), unique=True, index=True)
     email = db.Column(db.String(250), unique=True, index=True)
@@ -81,11 +133,12 @@ class User(db.Model, UserMixin):
     website = db.Column(db.String(250))
     bio = db.Column(db.String(120))
     location = db.Column(db.String(50))
-    member_since = db.Column(db.DateTime, default=datetime.utcnow)
+    member_since = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     confirmed = db.Column(db.Boolean, default=False)
     locked = db.Column(db.Boolean, default=False)
     active = db.Column(db.Boolean, default=True)
+    deleted = db.Column(db.Boolean, default=False)  # content is being purged by tasks.delete_account
 
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
 
@@ -102,6 +155,8 @@ class User(db.Model, UserMixin):
     receive_collect_notifications = db.Column(db.Boolean, default=True)
     receive_comment_notifications = db.Column(db.Boolean, default=True)
     receive_follow_notifications = db.Column(db.Boolean, default=True)
+    receive_digest_emails = db.Column(db.Boolean, default=False)
+    last_digest_at = db.Column(db.DateTime)  # notifications up to here went out in a digest
 
     collections = db.relationship("Collect", back_populates='collector', cascade='all')
 
@@ -111,12 +166,15 @@ class User(db.Model, UserMixin):
                                 lazy='dynamic', cascade='all')
     # todo ?? need to indicate foreign key for notification ?
     notifications = db.relationship("Notification", back_populates='receiver', cascade='all')
+    tasks = db.relationship("Task", back_populates='user', lazy='dynamic', cascade='all')
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        self.generate_avatar()
-        self.follow(self)
+        # nothing here commits or touches the disk: the self-follow and the role go out with
+        # the caller's commit, and the identicons are drawn when first requested
+        Follow(follower=self, followed=self)
         self.set_role()
+        self.generate_avatar()
 
     def set_role(self, role_id=None):
         if role_id:
@@ -124,10 +182,9 @@ class User(db.Model, UserMixin):
             self.role = role if role else None
         if self.role is None:
             if self.email == current_app.config['ALBUM_WALL_ADMIN_EMAIL']:
-                self.role = Role.query.filter_by(name="Administrator").first()
+                self.role = Role.by_name("Administrator")
             else:
-                self.role = Role.query.filter_by(name="User").first()
-            db.session.commit()
+                self.role = Role.by_name("User")
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -140,20 +197,40 @@ class User(db.Model, UserMixin):
             follow = Follow(follower=self, followed=user)
             db.session.add(follow)
             db.session.commit()
+            _request_cache('following', self.id)[user.id] = True
+            _request_cache('followers', user.id)[self.id] = True
 
     def unfollow(self, user):
         follow = self.followed.filter_by(followed_id=user.id).first()
         if follow:
             db.session.delete(follow)
             db.session.commit()
+            _request_cache('following', self.id)[user.id] = False
+            _request_cache('followers', user.id)[self.id] = False
+
+    def following_ids(self, user_ids):
+        """Return the ids in user_ids that this user follows, with one query per request."""
+        if self.id is None:
+            return set()
+        return _lookup_ids(_request_cache('following', self.id), user_ids,
+                           lambda ids: db.session.query(Follow.followed_id).filter(
+                               Follow.follower_id == self.id, Follow.followed_id.in_(ids)))
+
+    def follower_ids(self, user_ids):
+        """Return the ids in user_ids that follow this user, with one query per request."""
+        if self.id is None:
+            return set()
+        return _lookup_ids(_request_cache('followers', self.id), user_ids,
+                           lambda ids: db.session.query(Follow.follower_id).filter(
+                               Follow.followed_id == self.id, Follow.follower_id.in_(ids)))
 
     def is_following(self, user):
         if user.id is None: # when following self, user.id is none
             return False
-        return self.followed.filter_by(followed_id=user.id).first() is not None
+        return user.id in self.following_ids([user.id])
 
     def is_followed_by(self, user):
-        return self.followers.filter_by(follower_id=user.id).first() is not None
+        return user.id in self.follower_ids([user.id])
 
     @property
     def followed_photos(self):
@@ -164,24 +241,34 @@ class User(db.Model, UserMixin):
             collect = Collect(collector=self, collected=photo)
             db.session.add(collect)
             db.session.commit()
+            _request_cache('collecting', self.id)[photo.id] = True
 
     def uncollect(self, photo):
         collect = Collect.query.with_parent(self).filter_by(collected_id=photo.id).first()
         if collect:
             db.session.delete(collect)
             db.session.commit()
+            _request_cache('collecting', self.id)[photo.id] = False
+
+    def collecting_ids(self, photo_ids):
+        """Return the ids in photo_ids collected by this user, with one query per request."""
+        if self.id is None:
+            return set()
+        return _lookup_ids(_request_cache('collecting', self.id), photo_ids,
+                           lambda ids: db.session.query(Collect.collected_id).filter(
+                               Collect.collector_id == self.id, Collect.collected_id.in_(ids)))
 
     def is_collecting(self, photo):
-        return Collect.query.with_parent(self).filter_by(collected_id=photo.id).first() is not None
+        return photo.id in self.collecting_ids([photo.id])
 
     def lock(self):
         self.locked = True
-        self.role = Role.query.filter_by(name='Locked').first()
+        self.role = Role.by_name('Locked')
         db.session.commit()
 
     def unlock(self):
         self.locked = False
-        self.role = Role.query.filter_by(name="User").first()
+        self.role = Role.by_name("User")
         db.session.commit()
 
     def block(self):
@@ -194,34 +281,39 @@ class User(db.Model, UserMixin):
 
     @property
     def is_active(self):
-        return self.active
+        return self.active and not self.deleted
 
     @property
     def is_admin(self):
         return self.role == "Administrator"
 
     def can(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and self.role is not None and permission in self.role.permissions
+        # by name, so a cached role answers without a query
+        return self.role is not None and any(permission.name == permission_name
+                                             for permission in self.role.permissions)
     # Why check self.role existing
     # in case role was not specified ?
 
+    def get_task_in_progress(self, name):
+        return self.tasks.filter(Task.name == name, Task.status.in_(['queued', 'running'])).first()
+
     def generate_avatar(self):
-        avatar = Identicon()
-        filenames = avatar.generate(text=self.username)
-        self.avatar_s = filenames[0]
-        self.avatar_m = filenames[1]
-        self.avatar_l = filenames[2]
-        db.session.commit()
+        # main.get_avatar draws these on demand
+        self.avatar_s, self.avatar_m, self.avatar_l = identicon_filenames(self.username)
 
 
 tagging = db.Table('tagging',
                    db.Column('photo_id', db.Integer, db.ForeignKey('photo.id')),
-                   db.Column("tag_id", db.Integer, db.ForeignKey('tag.id')))
+                   db.Column("tag_id", db.Integer, db.ForeignKey('tag.id')),
+                   db.Index('ix_tagging_tag_photo', 'tag_id', 'photo_id'),
+                   db.Index('ix_tagging_photo_tag', 'photo_id', 'tag_id'))
 
 
 @whooshee.register_model('description')
-class Photo(db.Model):
+class Photo(db.Model, Versioned):
+    # user.index order, id breaks ties between photos with the same timestamp
+    __table_args__ = (db.Index('ix_photo_author_timestamp_id', 'author_id', 'timestamp', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(500))
     filename = db.Column(db.String(64))
@@ -230,7 +322,7 @@ class Photo(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow(), index=True)
 
     comment_allowed = db.Column(db.Boolean, default=True)
-    flag = db.Column(db.Integer, default=0)
+    flag = db.Column(db.Integer, default=0, index=True)
 
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     author = db.relationship('User', back_populates='photos')
@@ -239,33 +331,59 @@ class Photo(db.Model):
     comments = db.relationship("Comment", back_populates='photo', cascade='all')
     collectors = db.relationship("Collect", back_populates='collected', cascade="all")
 
+    def next_id(self):
+        """Id of the author's photo after this one on their page (the older one), or None."""
+        return self._seek(older=True).scalar()
+
+    def previous_id(self):
+        """Id of the author's photo before this one on their page (the newer one), or None."""
+        return self._seek(older=False).scalar()
+
+    def _seek(self, older):
+        # keyset seek along ix_photo_author_timestamp_id, a single index probe whatever the page
+        query = db.session.query(Photo.id).filter(Photo.author_id == self.author_id)
+        if older:
+            query = query.filter(db.or_(Photo.timestamp < self.timestamp,
+                                        db.and_(Photo.timestamp == self.timestamp, Photo.id < self.id)))\
+                .order_by(Photo.timestamp.desc(), Photo.id.desc())
+        else:
+            query = query.filter(db.or_(Photo.timestamp > self.timestamp,
+                                        db.and_(Photo.timestamp == self.timestamp, Photo.id > self.id)))\
+                .order_by(Photo.timestamp.asc(), Photo.id.asc())
+        return query.limit(1)
+
 
 @whooshee.register_model('name')
-class Tag(db.Model):
+class Tag(db.Model, Versioned):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)
 
     photos = db.relationship("Photo", secondary='tagging', back_populates='tags')
 
 
-class Comment(db.Model):
+class Comment(db.Model, Versioned):
+    __table_args__ = (db.Index('ix_comment_photo_timestamp', 'photo_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow(), index=True)
-    flag = db.Column(db.Integer, default=0)
+    flag = db.Column(db.Integer, default=0, index=True)
 
-    author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     author = db.relationship("User", back_populates='comments')
 
     photo_id = db.Column(db.Integer, db.ForeignKey('photo.id'))
     photo = db.relationship("Photo", back_populates='comments')
 
-    replying_to_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    replying_to_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
     replying_to = db.relationship("Comment", back_populates='replied_by', remote_side=[id])
     replied_by = db.relationship("Comment", back_populates='replying_to', cascade='all')
 
 
 class Notification(db.Model):
+    __table_args__ = (db.Index('ix_notification_receiver_timestamp', 'receiver_id', 'timestamp'),
+                      db.Index('ix_notification_receiver_read_timestamp', 'receiver_id', 'is_read', 'timestamp'))
+
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(db.Text, nullable=False)
     is_read = db.Column(db.Boolean, default=False)
@@ -276,20 +394,202 @@ class Notification(db.Model):
     receiver = db.relationship('User', back_populates='notifications')
 
 
+class Task(db.Model):
+    # a background job on the rq queue, see app/tasks.py
+    id = db.Column(db.String(36), primary_key=True)
+    name = db.Column(db.String(128), index=True)
+    description = db.Column(db.String(128))
+    status = db.Column(db.String(16), default='queued')  # queued, running, finished, failed
+    progress = db.Column(db.Integer, default=0)
+    message = db.Column(db.String(250))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user = db.relationship('User', back_populates='tasks')
+
+
+class Upload(db.Model):
+    # an original uploaded as part of a batch, waiting for its smaller sizes and its Photo,
+    # see uploads.process_uploads
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.String(32), index=True)
+    filename = db.Column(db.String(64))
+    status = db.Column(db.String(16), default='uploaded')  # uploaded, processing, ready, done, failed
+    message = db.Column(db.String(250))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    photo_id = db.Column(db.Integer)  # no foreign key, the photo may be deleted before the row goes
+
+
+class FileDeletion(db.Model):
+    # outbox of files to unlink once the transaction that orphaned them has committed,
+    # emptied by tasks.purge_deleted_files
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(512), nullable=False)
+    attempts = db.Column(db.Integer, default=0)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class OutgoingMail(db.Model):
+    # outbox of emails, delivered in batches by emails.deliver_queued_mail; rows that keep failing
+    # stay behind with dead set, the dead letters `flask deliver-mail --retry-dead` sends again
+    __table_args__ = (db.Index('ix_outgoing_mail_due', 'dead', 'next_attempt'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(254), nullable=False)
+    subject = db.Column(db.String(255))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32), index=True)  # the delivery run sending it right now
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(255))
+    dead = db.Column(db.Boolean, default=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+def without_deleted(query, user):
+    """Join query to the User the relationship user points at, leaving out the accounts
+    tasks.delete_account is purging."""
+    return query.join(user).filter(User.deleted.isnot(True))
+
+
+def queue_file_deletions(paths, connection=None):
+    """Record paths for removal as part of the current transaction.
+
+    Pass connection from inside flush events, where the session itself can't be used.
+    """
+    rows = [dict(path=path, attempts=0, timestamp=datetime.utcnow()) for path in sorted(set(paths))]
+    if not rows:
+        return
+    (connection or db.session).execute(FileDeletion.__table__.insert(), rows)
+    db.session.info['files_deleted'] = True
+
+
+def avatar_paths(filenames):
+    # avatar_raw may be none, identicons are a shared cache
+    return [os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename) for filename in filenames
+            if filename is not None and not is_identicon(filename)]
+
+
+def photo_paths(filenames):
+    return [os.path.join(current_app.config['ALBUM_WALL_UPLOAD_PATH'], filename) for filename in filenames
+            if filename is not None]
+
+
 @db.event.listens_for(User, 'after_delete', named=True)
 def delete_avatar(**kwargs):
     target = kwargs['target']
-    for filename in [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw]:
-        if filename is not None: # avatar_raw may be none
-            path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename)
-            if os.path.exists(path):
-                os.remove(path)
+    queue_file_deletions(avatar_paths([target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw]),
+                         connection=kwargs['connection'])
 
 
 @db.event.listens_for(Photo, 'after_delete', named=True)
 def delete_photo(**kwargs):
     target = kwargs['target']
-    for filename in [target.filename, target.filename_s, target.filename_m]:
-        path = os.path.join(current_app.config['ALBUM_WALL_UPLOAD_PATH'], filename)
-        if os.path.exists(path):
-            os.remove(path)
\ No newline at end of file
+    queue_file_deletions(photo_paths([target.filename, target.filename_s, target.filename_m]),
+                         connection=kwargs['connection'])
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def start_file_purge(session):
+    if session.info.pop('files_deleted', False):
+        from app.tasks import enqueue_job
+        enqueue_job('purge_deleted_files')
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def forget_deleted_files(session):
+    session.info.pop('files_deleted', None)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def note_principal_changes(session, flush_context):
+    # load_user caches users and roles, see app.principals
+    from app.principals import USER_COLUMNS
+    user_ids, role_ids = session.info.setdefault('principals_changed', (set(), set()))
+    for instance in session.deleted:
+        if isinstance(instance, User):
+            user_ids.add(instance.id)
+        elif isinstance(instance, Role):
+            role_ids.add(instance.id)
+    for instance in session.dirty:
+        if isinstance(instance, User):
+            attrs = db.inspect(instance).attrs
+            if any(attrs[key].history.has_changes() for key in USER_COLUMNS + ('role',)):
+                user_ids.add(instance.id)
+        elif isinstance(instance, Role) and session.is_modified(instance):
+            role_ids.add(instance.id)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_principals(session):
+    user_ids, role_ids = session.info.pop('principals_changed', ((), ()))
+    if user_ids or role_ids:
+        from app.principals import invalidate
+        invalidate(user_ids, role_ids)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def forget_principal_changes(session):
+    session.info.pop('principals_changed', None)
+
+
+def _counted_on(instance, added, deleted):
+    # the rows showing a count that instance joins or leaves
+    if isinstance(instance, Comment):
+        return [(Photo, instance.photo_id)]
+    if isinstance(instance, Collect):
+        return [(Photo, instance.collected_id), (User, instance.collector_id)]
+    if isinstance(instance, Follow):
+        return [(User, instance.follower_id), (User, instance.followed_id)]
+    if isinstance(instance, Photo):
+        history = db.inspect(instance).attrs.tags.history
+        tags = history.sum() if added or deleted else list(history.added or ()) + list(history.deleted or ())
+        rows = [(Tag, tag.id) for tag in tags]
+        if added or deleted:
+            rows.append((User, instance.author_id))
+        return rows
+    return []
+
+
+def changed_rows(session):
+    """Return the (model, id) of the Versioned rows the flush changes, by themselves or through a
+    count shown with them. Call it from an after_flush listener."""
+    rows = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        added, deleted = instance in session.new, instance in session.deleted
+        if isinstance(instance, Versioned) and (added or deleted or session.is_modified(instance)):
+            rows.add((type(instance), instance.id))
+        rows.update(_counted_on(instance, added, deleted))
+    return set((model, id) for model, id in rows if id is not None)
+
+
+@db.event.listens_for(Versioned, 'before_update', propagate=True)
+def bump_version(mapper, connection, target):
+    # also called for rows dirty only through a collection, the photo a tag was added to
+    if db.inspect(target).session.is_modified(target):
+        target.version = mapper.class_.version + 1
+        target.updated_at = datetime.utcnow()
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def touch_parents(session, flush_context):
+    # a comment, collect, follow or tagging changes a count shown with its parent rows
+    added = set((type(instance), instance.id) for instance in session.new if isinstance(instance, Versioned))
+    touched = {}
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        for model, id in _counted_on(instance, instance in session.new, instance in session.deleted):
+            # rows inserted by this flush start at version 1 with their counts
+            if id is not None and (model, id) not in added:
+                touched.setdefault(model, set()).add(id)
+    for model, ids in touched.items():
+        bump_versions(model, ids, session)
+
+
+def bump_versions(model, ids, session=None):
+    """Move the version of model's rows ids on, for counts changed by statements the flush doesn't see."""
+    (session or db.session).execute(model.__table__.update().where(model.id.in_(ids))
+                                    .values(version=model.version + 1, updated_at=datetime.utcnow()))
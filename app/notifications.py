@@ -1,5 +1,6 @@
 from flask import url_for
 
+from app.events import publish_notification
 from app.extensions import db
 from app.models import Notification
 
@@ -10,6 +11,7 @@ def push_follow_notification(follower, receiver):
     notification = Notification(message=message, receiver=receiver)
     db.session.add(notification)
     db.session.commit()
+    publish_notification(receiver, notification)
 
 
 def push_comment_notification(photo_id, receiver, page=1):
@@ -18,6 +20,7 @@ def push_comment_notification(photo_id, receiver, page=1):
     notification = Notification(message=message, receiver=receiver)
     db.session.add(notification)
     db.session.commit()
+    publish_notification(receiver, notification)
 
 
 def push_collect_notification(collector, photo_id, receiver):
@@ -27,3 +30,4 @@ def push_collect_notification(collector, photo_id, receiver):
     notification = Notification(message=message, receiver=receiver)
     db.session.add(notification)
     db.session.commit()
+    publish_notification(receiver, notification)
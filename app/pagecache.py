@@ -0,0 +1,216 @@
+"""Whole-page cache for logged-out visitors.
+
+Views decorated with cache_for_anonymous answer anonymous GET requests from the cache, keyed by
+host, path and query string. While a page renders, every Photo, User, Tag and Comment loaded for
+it tags the entry with photo:<id>, user:<id> and so on. The rows a commit changes are those of
+models.changed_rows, which counts a comment, collect, follow or tagging as a change to the rows
+showing it, the same changes that move their cache_key(). The entries carrying their tags are
+purged. Search pages also carry the search tag, purged when anything searchable changes.
+
+ALBUM_WALL_PAGE_CACHE picks the store:
+
+* 'memory' keeps up to ALBUM_WALL_PAGE_CACHE_SIZE bytes of pages in each process, least recently
+  used first out. A purge only reaches the process that made the change, the others serve their
+  copy until ALBUM_WALL_PAGE_CACHE_TTL runs out.
+* 'redis' shares the pages between processes. Entries expire after the TTL and Redis' maxmemory
+  policy bounds the size. ProductionConfig uses it, the other configs keep 'memory' so they run
+  without a Redis server.
+* None turns the cache off.
+
+Pages carry the visitor's CSRF token, so it is swapped for a placeholder when a page is stored and
+for the next visitor's own token when it is served. Requests with flashed messages waiting are
+never served from or stored in the cache.
+"""
+import pickle
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, request, session, g, has_request_context
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from werkzeug.urls import url_encode
+
+from app.extensions import db
+from app.models import User, Photo, Tag, Versioned, changed_rows
+
+CSRF_PLACEHOLDER = b'\x00csrf-token\x00'
+KEY_PREFIX = 'flask-album:pages:'
+
+
+class MemoryPageStore:
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (page, tags, expires)
+        self._tags = {}  # tag -> keys
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, page, tags):
+        if len(page['body']) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (page, tags, time.monotonic() + self.ttl)
+            self.size += len(page['body'])
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def purge(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0]['body'])
+        for tag in entry[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisPageStore:
+
+    def __init__(self, redis, ttl):
+        self.redis = redis
+        self.ttl = ttl
+
+    def get(self, key):
+        data = self.redis.get(KEY_PREFIX + 'page:' + key)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, page, tags):
+        pipe = self.redis.pipeline()
+        pipe.set(KEY_PREFIX + 'page:' + key, pickle.dumps(page), ex=self.ttl)
+        for tag in tags:
+            pipe.sadd(KEY_PREFIX + 'tag:' + tag, key)
+            pipe.expire(KEY_PREFIX + 'tag:' + tag, self.ttl)
+        pipe.execute()
+
+    def purge(self, tags):
+        for tag in tags:
+            keys = self.redis.smembers(KEY_PREFIX + 'tag:' + tag)
+            pipe = self.redis.pipeline()
+            for key in keys:
+                pipe.delete(KEY_PREFIX + 'page:' + key.decode())
+            pipe.delete(KEY_PREFIX + 'tag:' + tag)
+            pipe.execute()
+
+
+def make_page_store(app):
+    store = app.config['ALBUM_WALL_PAGE_CACHE']
+    if store == 'redis':
+        return RedisPageStore(app.redis, app.config['ALBUM_WALL_PAGE_CACHE_TTL'])
+    if store == 'memory':
+        return MemoryPageStore(app.config['ALBUM_WALL_PAGE_CACHE_SIZE'], app.config['ALBUM_WALL_PAGE_CACHE_TTL'])
+    return None
+
+
+def cache_for_anonymous(*tags):
+    """Serve the view's anonymous GET requests from the page cache, tags are added to every entry."""
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            store = current_app.page_store
+            if store is None or request.method != 'GET' or current_user.is_authenticated \
+                    or session.get('_flashes'):
+                return func(*args, **kwargs)
+            key = request.host_url + request.path + '?' + url_encode(sorted(request.args.items(multi=True)))
+            try:
+                page = store.get(key)
+            except Exception:
+                current_app.logger.exception('Could not read the page cache')
+                return func(*args, **kwargs)
+            if page is not None:
+                body = page['body'].replace(CSRF_PLACEHOLDER, generate_csrf().encode())
+                response = current_app.response_class(body, status=page['status'], headers=page['headers'])
+                response.headers['X-Cache'] = 'HIT'
+                # the stored page carries the ETag of a conditional view
+                return response.make_conditional(request)
+
+            g.page_cache_tags = set(tags)
+            try:
+                response = current_app.make_response(func(*args, **kwargs))
+            finally:
+                page_tags = g.pop('page_cache_tags')
+            if response.status_code == 200 and not response.direct_passthrough:
+                _store(store, key, response, page_tags)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return decorated_function
+    return decorator
+
+
+def _store(store, key, response, tags):
+    body = response.get_data()
+    token = g.get('csrf_token')
+    if token:
+        body = body.replace(token.encode(), CSRF_PLACEHOLDER)
+    # the length changes with the token, and the cookie belongs to this visitor
+    headers = [(name, value) for name, value in response.headers
+               if name.lower() not in ('set-cookie', 'content-length')]
+    try:
+        store.set(key, dict(status=response.status_code, headers=headers, body=body), sorted(tags))
+    except Exception:
+        current_app.logger.exception('Could not write to the page cache')
+
+
+def purge(tags):
+    store = current_app.page_store
+    if store is None or not tags:
+        return
+    try:
+        store.purge(sorted(tags))
+    except Exception:
+        # the stale pages go when their TTL runs out
+        current_app.logger.exception('Could not purge %s from the page cache', ', '.join(sorted(tags)))
+
+
+@db.event.listens_for(db.Model, 'load', propagate=True)
+@db.event.listens_for(db.Model, 'refresh', propagate=True)
+def note_dependency(instance, context, attrs=None):
+    if has_request_context() and 'page_cache_tags' in g and isinstance(instance, Versioned):
+        g.page_cache_tags.add('%s:%d' % (instance.__tablename__, instance.id))
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def note_changes(session, flush_context):
+    tags = session.info.setdefault('page_cache_purge', set())
+    for model, id in changed_rows(session):
+        tags.add('%s:%d' % (model.__tablename__, id))
+        if model in (Photo, User, Tag):
+            tags.add('search')
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def purge_changes(session):
+    tags = session.info.pop('page_cache_purge', None)
+    if tags:
+        purge(tags)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('page_cache_purge', None)
@@ -0,0 +1,169 @@
+"""Cache of the logged-in user for Flask-Login's user loader.
+
+Every authenticated request used to load its User and then, from the templates, the role and its
+permissions. load_user keeps a small snapshot of each user instead: the id, name, flags, avatar
+names and role id, plus a snapshot of each role with its permission names. They are held in a
+per-process LRU and, with ALBUM_WALL_USER_CACHE_REDIS_TTL set, in Redis for the other processes.
+A hit is put back together as a persistent User with merge(load=False), which costs no query, and
+the columns left out of the snapshot load on first access like expired attributes.
+
+The models' flush hooks drop a user's entry once a change to their snapshot columns or role
+commits, and the role entries when a role changes. Another process may use its own copy for up to
+ALBUM_WALL_USER_CACHE_LOCAL_TTL seconds after that.
+"""
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+from app.extensions import db
+from app.models import User, Role, Permission
+from app.replicas import primary
+
+USER_COLUMNS = ('id', 'username', 'name', 'confirmed', 'locked', 'active', 'deleted', 'role_id',
+                'avatar_s', 'avatar_m', 'avatar_l', 'avatar_raw')
+KEY_PREFIX = 'flask-album:principals:v1:'
+
+
+class LRUCache:
+    """A dict limited to maxsize entries that forgets entries older than ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class PrincipalCache:
+
+    def __init__(self, app):
+        self.local = LRUCache(app.config['ALBUM_WALL_USER_CACHE_SIZE'], app.config['ALBUM_WALL_USER_CACHE_LOCAL_TTL'])
+        self.redis = app.redis if app.config['ALBUM_WALL_USER_CACHE_REDIS_TTL'] else None
+        self.redis_ttl = app.config['ALBUM_WALL_USER_CACHE_REDIS_TTL']
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.redis is not None:
+            try:
+                data = self.redis.get(KEY_PREFIX + key)
+            except Exception:
+                current_app.logger.exception('Could not read %s from the user cache', key)
+                return None
+            if data is not None:
+                value = json.loads(data)
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.redis is not None:
+            try:
+                self.redis.set(KEY_PREFIX + key, json.dumps(value), ex=self.redis_ttl)
+            except Exception:
+                current_app.logger.exception('Could not write %s to the user cache', key)
+
+    def delete(self, keys):
+        for key in keys:
+            self.local.delete(key)
+        if self.redis is not None and keys:
+            try:
+                self.redis.delete(*[KEY_PREFIX + key for key in keys])
+            except Exception:
+                # the Redis entry outlives the change until it expires
+                current_app.logger.exception('Could not drop %s from the user cache', ', '.join(keys))
+
+
+def load_user(user_id):
+    """Return the User for the session's user_id, None for an unknown or deleted user."""
+    user_id = int(user_id)
+    if not current_app.config['ALBUM_WALL_USER_CACHE_SIZE']:
+        user = User.query.get(user_id)
+        return None if user is None or user.deleted else user
+
+    cache = current_app.principal_cache
+    snapshot = cache.get('user:%d' % user_id)
+    if snapshot is None:
+        # a replica behind a lock or a block would have it cached for a long time
+        with primary():
+            user = User.query.options(joinedload(User.role).joinedload(Role.permissions)).get(user_id)
+        if user is None:
+            return None
+        cache.set('user:%d' % user_id, dict((column, getattr(user, column)) for column in USER_COLUMNS))
+        if user.role is not None:
+            cache.set('role:%d' % user.role.id, _role_snapshot(user.role))
+        return None if user.deleted else user
+    if snapshot['deleted']:
+        return None
+
+    # already loaded in this session, by the tests or an earlier loader call
+    user = db.session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        return user
+    user = _restore(User, snapshot)
+    if snapshot['role_id'] is not None:
+        role = _load_role(cache, snapshot['role_id'])
+        set_committed_value(user, 'role', role)
+    return db.session.merge(user, load=False)
+
+
+def _load_role(cache, role_id):
+    snapshot = cache.get('role:%d' % role_id)
+    if snapshot is None:
+        with primary():
+            role = Role.query.options(joinedload(Role.permissions)).get(role_id)
+        if role is None:
+            return None
+        snapshot = _role_snapshot(role)
+        cache.set('role:%d' % role_id, snapshot)
+    role = _restore(Role, dict(id=snapshot['id'], name=snapshot['name']))
+    set_committed_value(role, 'permissions', [_restore(Permission, dict(id=permission_id, name=name))
+                                              for permission_id, name in snapshot['permissions']])
+    return role
+
+
+def _role_snapshot(role):
+    return dict(id=role.id, name=role.name,
+                permissions=[[permission.id, permission.name] for permission in role.permissions])
+
+
+def _restore(model, values):
+    # a detached instance as if loaded with these columns only, the others load on first access
+    instance = model.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(instance, key, value)
+    make_transient_to_detached(instance)
+    return instance
+
+
+def invalidate(user_ids=(), role_ids=()):
+    cache = current_app.principal_cache
+    cache.delete(['user:%d' % user_id for user_id in user_ids] + ['role:%d' % role_id for role_id in role_ids])
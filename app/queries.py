@@ -0,0 +1,87 @@
+"""The queries behind the list pages, shared by the views and app.queryplans.
+
+Each returns the query unpaginated, the view pages it and queryplans.HOT_QUERIES explains it,
+so the plan the snapshot checks is the plan of the query the page runs.
+"""
+from app.extensions import db
+from app.models import User, Role, Photo, Tag, Comment, Collect, Follow, Notification, tagging, \
+    without_deleted
+
+
+def timeline(user_id):
+    """Photos of the users user_id follows, newest first."""
+    return without_deleted(Photo.query, Photo.author).join(Follow, Follow.followed_id == Photo.author_id)\
+        .filter(Follow.follower_id == user_id).order_by(Photo.timestamp.desc())
+
+
+def hot_tags():
+    return Tag.query.join(Tag.photos).group_by(Tag.id).order_by(db.func.count(Photo.id).desc()).limit(10)
+
+
+def photo_comments(photo_id):
+    return without_deleted(Comment.query.filter(Comment.photo_id == photo_id), Comment.author)\
+        .order_by(Comment.timestamp.desc())
+
+
+def photo_collectors(photo_id):
+    return Collect.query.filter(Collect.collected_id == photo_id)
+
+
+def tag_photos(tag_id):
+    return without_deleted(Photo.query, Photo.author).join(tagging, tagging.c.photo_id == Photo.id)\
+        .filter(tagging.c.tag_id == tag_id).order_by(Photo.timestamp.desc(), Photo.id.desc())
+
+
+def notifications(receiver_id, unread=False):
+    query = Notification.query.filter_by(receiver_id=receiver_id)
+    if unread:
+        query = query.filter_by(is_read=False)
+    return query.order_by(Notification.timestamp.desc())
+
+
+def unread_notifications(receiver_id):
+    """Unordered, for counting."""
+    return Notification.query.filter_by(receiver_id=receiver_id, is_read=False)
+
+
+def user_by_username(username):
+    return User.query.filter(User.username == username)
+
+
+def user_photos(user_id):
+    """The user's page, newest first with the id breaking ties as Photo._seek does."""
+    return Photo.query.filter(Photo.author_id == user_id).order_by(Photo.timestamp.desc(), Photo.id.desc())
+
+
+def followers(user_id):
+    return without_deleted(Follow.query.filter(Follow.followed_id == user_id), Follow.follower)
+
+
+def following(user_id):
+    return without_deleted(Follow.query.filter(Follow.follower_id == user_id), Follow.followed)
+
+
+def collections(user_id):
+    return Collect.query.filter(Collect.collector_id == user_id).order_by(Collect.timestamp.desc())
+
+
+def managed_photos(by_time=False):
+    return Photo.query.order_by(Photo.timestamp.desc() if by_time else Photo.flag.desc())
+
+
+def managed_comments(by_time=False):
+    return Comment.query.order_by(Comment.timestamp.desc() if by_time else Comment.flag.desc())
+
+
+def managed_users(filter_rule='all'):
+    """Users for admin.manage_user, newest members first. filter_rule is one of
+    'all', 'locked', 'blocked', 'administrator' and 'moderator'."""
+    if filter_rule == 'locked':
+        users = User.query.filter_by(locked=True)
+    elif filter_rule == 'blocked':
+        users = User.query.filter_by(active=False)
+    elif filter_rule in ('administrator', 'moderator'):
+        users = User.query.filter_by(role=Role.query.filter_by(name=filter_rule.capitalize()).first())
+    else:
+        users = User.query
+    return users.order_by(User.member_since.desc())
@@ -0,0 +1,210 @@
+"""Query plans of the hot queries, checked against the indexes they are expected to use.
+
+Every query the blueprints run on a hot path is registered here with hot_query, built by the app.queries
+function the view calls, so a change to a view's query shows up here. `flask query-plans` prints their plans,
+fails when a query no longer uses one of its expected indexes, and diffs the plans against the snapshot of the
+database dialect (`--update` rewrites it). tests/test_query_plans.py runs the same checks on SQLite.
+
+Index names are the declared ones; primary keys are called <table>_pkey whatever the dialect names them.
+"""
+import json
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime
+
+from app import queries
+from app.extensions import db
+from app.models import Photo
+
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'query_plans')
+
+HOT_QUERIES = OrderedDict()
+
+
+class HotQuery:
+    def __init__(self, name, build, uses):
+        self.name = name
+        self.build = build
+        self.uses = tuple(uses)
+
+
+def hot_query(name, uses=()):
+    """Register the query returned by the decorated function, expected to use the indexes in uses."""
+    def decorator(build):
+        HOT_QUERIES[name] = HotQuery(name, build, uses)
+        return build
+    return decorator
+
+
+# the ids don't need to exist, the plan only depends on the shape of the query; the limits are the pages'
+
+@hot_query('main.index timeline', uses=['follow_pkey', 'ix_photo_author_timestamp_id'])
+def timeline():
+    return queries.timeline(1).limit(12)
+
+
+@hot_query('main.index hot tags')
+def hot_tags():
+    return queries.hot_tags()
+
+
+@hot_query('main.show_photo comments', uses=['ix_comment_photo_timestamp'])
+def photo_comments():
+    return queries.photo_comments(1).limit(15)
+
+
+@hot_query('main.show_photo next', uses=['ix_photo_author_timestamp_id'])
+def photo_next():
+    return Photo(id=1, author_id=1, timestamp=datetime(2019, 1, 1))._seek(older=True)
+
+
+@hot_query('main.show_collectors', uses=['ix_collect_collected_collector'])
+def photo_collectors():
+    return queries.photo_collectors(1).limit(15)
+
+
+@hot_query('main.show_by_tag', uses=['ix_tagging_tag_photo'])
+def tag_photos():
+    return queries.tag_photos(1).limit(12)
+
+
+@hot_query('main.show_notifications unread', uses=['ix_notification_receiver_read_timestamp'])
+def unread_notifications():
+    return queries.notifications(1, unread=True).limit(12)
+
+
+@hot_query('ajax.notifications_count', uses=['ix_notification_receiver_read_timestamp'])
+def unread_notification_count():
+    # what Query.count() runs
+    return queries.unread_notifications(1).from_self(db.func.count(db.literal_column('*')))
+
+
+@hot_query('user.index photos', uses=['ix_photo_author_timestamp_id'])
+def user_photos():
+    return queries.user_photos(1).limit(12)
+
+
+@hot_query('user.index by username', uses=['ix_user_username'])
+def user_by_username():
+    return queries.user_by_username('n.wang').limit(1)
+
+
+@hot_query('user.show_followers', uses=['ix_follow_followed_follower'])
+def user_followers():
+    return queries.followers(1).limit(20)
+
+
+@hot_query('user.show_following', uses=['follow_pkey'])
+def user_following():
+    return queries.following(1).limit(20)
+
+
+@hot_query('user.collections', uses=['ix_collect_collector_timestamp'])
+def user_collections():
+    return queries.collections(1).limit(12)
+
+
+@hot_query('admin.manage_photo by flag', uses=['ix_photo_flag'])
+def photos_by_flag():
+    return queries.managed_photos().limit(20)
+
+
+@hot_query('admin.manage_comment by flag', uses=['ix_comment_flag'])
+def comments_by_flag():
+    return queries.managed_comments().limit(30)
+
+
+@hot_query('admin.manage_user', uses=['ix_user_member_since'])
+def users_by_member_since():
+    return queries.managed_users().limit(30)
+
+
+def explain(query):
+    """Return the plan of query on the session's database as a list of lines."""
+    connection = db.session.connection()
+    compiled = query.statement.compile(dialect=connection.dialect)
+    if compiled.positional:
+        params = [compiled.params[name] for name in compiled.positiontup]
+    else:
+        params = compiled.params
+    cursor = connection.connection.cursor()
+    try:
+        if connection.dialect.name == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+            return _sqlite_lines(cursor.fetchall())
+        cursor.execute('EXPLAIN ' + str(compiled), params)
+        # costs and row estimates move with the data, the shape of the plan is what matters
+        return [re.sub(r'\s*\(cost=[^)]*\)', '', row[0]) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def _sqlite_lines(rows):
+    # rows are (id, parent, notused, detail), indent each step under its parent
+    depth = {0: -1}
+    lines = []
+    for row in rows:
+        depth[row[0]] = depth.get(row[1], -1) + 1
+        # SQLite before 3.36 says "SCAN TABLE photo"
+        detail = re.sub(r'^(SCAN|SEARCH) TABLE ', r'\1 ', row[3])
+        lines.append('  ' * depth[row[0]] + detail)
+    return lines
+
+
+def used_indexes(lines):
+    """Names of the indexes a plan reads, primary keys as <table>_pkey."""
+    names = set()
+    for line in lines:
+        line = line.strip()
+        match = re.match(r'^(?:SCAN|SEARCH) (\w+)(?: AS \w+)? USING (?:COVERING )?INDEX (\w+)', line)
+        if match:
+            names.add(re.sub(r'^sqlite_autoindex_(\w+)_\d+$', r'\1_pkey', match.group(2)))
+            continue
+        match = re.match(r'^(?:SCAN|SEARCH) (\w+)(?: AS \w+)? USING INTEGER PRIMARY KEY', line)
+        if match:
+            # eager loads read through aliases such as user_1
+            names.add(re.sub(r'_\d+$', '', match.group(1)) + '_pkey')
+            continue
+        match = re.search(r'Index (?:Only )?Scan (?:Backward )?using (\w+)', line)
+        if match:
+            names.add(match.group(1))
+    return names
+
+
+def check_plans(snapshot_path=None, update=False):
+    """Explain every hot query and return (plans, problems).
+
+    problems lists the queries missing an expected index and, unless update is set, the plans that differ
+    from the snapshot. With update the snapshot is rewritten instead.
+    """
+    dialect = db.session.connection().dialect.name
+    if snapshot_path is None:
+        snapshot_path = os.path.join(SNAPSHOT_PATH, dialect + '.json')
+
+    plans = OrderedDict()
+    problems = []
+    for name, hot in HOT_QUERIES.items():
+        lines = explain(hot.build())
+        plans[name] = lines
+        missing = set(hot.uses) - used_indexes(lines)
+        if missing:
+            problems.append('%s does not use %s' % (name, ', '.join(sorted(missing))))
+
+    if update:
+        with open(snapshot_path, 'w') as f:
+            json.dump(plans, f, indent=2)
+            f.write('\n')
+        return plans, problems
+
+    snapshot = {}
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+    for name, lines in plans.items():
+        if name not in snapshot:
+            problems.append('%s has no snapshot' % name)
+        elif snapshot[name] != lines:
+            problems.append('%s changed plan:\n    was: %s\n    now: %s' % (
+                name, '\n         '.join(snapshot[name]), '\n         '.join(lines)))
+    return plans, problems
@@ -0,0 +1,100 @@
+"""Read replicas for the views that only read.
+
+Views decorated with replica_read run their GET requests against one of the databases in
+ALBUM_WALL_REPLICA_URIS, picked at random per request. They are registered as the SQLAlchemy binds
+replica-0, replica-1 and so on, and extensions.RoutingSession sends the request's SELECTs to the
+picked one. Everything else goes to SQLALCHEMY_DATABASE_URI, the primary:
+
+* requests to other views, and anything but GET;
+* the rest of a request once it flushed a write;
+* for ALBUM_WALL_PRIMARY_PIN seconds after a request that wrote, every request from the same
+  browser, so the writer doesn't see a replica that hasn't caught up with their change yet.
+
+Replication itself is the database's business. For development and the tests, sync_replicas
+stands in for it by copying a SQLite primary onto SQLite replicas, see `flask sync-replicas`.
+"""
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, request, session, g, has_request_context
+from sqlalchemy.engine.url import make_url
+
+from app.extensions import db
+
+
+def init_app(app):
+    """Register the replicas as binds, call again after changing ALBUM_WALL_REPLICA_URIS."""
+    binds = dict((name, uri) for name, uri in (app.config.get('SQLALCHEMY_BINDS') or {}).items()
+                 if not name.startswith('replica-'))
+    for i, uri in enumerate(app.config['ALBUM_WALL_REPLICA_URIS']):
+        binds['replica-%d' % i] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    if pin_writer not in app.after_request_funcs.get(None, []):
+        app.after_request(pin_writer)
+
+
+def replica_names():
+    return ['replica-%d' % i for i in range(len(current_app.config['ALBUM_WALL_REPLICA_URIS']))]
+
+
+def replica_read(func):
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        names = replica_names()
+        if not names or request.method != 'GET' or session.get('primary_until', 0) > time.time():
+            return func(*args, **kwargs)
+        db.session.info['replica'] = random.choice(names)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db.session.info.pop('replica', None)
+    return decorated_function
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside the block, for data that must not be stale."""
+    replica = db.session.info.pop('replica', None)
+    try:
+        yield
+    finally:
+        if replica is not None:
+            db.session.info['replica'] = replica
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def note_write(session, flush_context):
+    if has_request_context():
+        g.database_written = True
+
+
+def pin_writer(response):
+    if g.get('database_written') and current_app.config['ALBUM_WALL_REPLICA_URIS']:
+        session['primary_until'] = time.time() + current_app.config['ALBUM_WALL_PRIMARY_PIN']
+    return response
+
+
+def sync_replicas():
+    """Copy a SQLite primary onto the SQLite replicas, return how many were copied."""
+    primary_path = _sqlite_path(current_app.config['SQLALCHEMY_DATABASE_URI'])
+    source = sqlite3.connect(primary_path)
+    try:
+        for uri in current_app.config['ALBUM_WALL_REPLICA_URIS']:
+            target = sqlite3.connect(_sqlite_path(uri))
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+    finally:
+        source.close()
+    return len(current_app.config['ALBUM_WALL_REPLICA_URIS'])
+
+
+def _sqlite_path(uri):
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        raise ValueError('%s is not a SQLite file, replicate it with the database\'s own tools' % uri)
+    return url.database
@@ -0,0 +1,80 @@
+"""Bring the indexes of an existing database in line with the ones declared on the models.
+
+db.create_all() only creates missing tables, so indexes added to existing tables are built here,
+one at a time and without blocking writes where the database allows it:
+
+* Postgres builds them with CREATE INDEX CONCURRENTLY. A build that failed halfway leaves an
+  invalid index behind, which is dropped and built again.
+* MySQL builds them with ALGORITHM=INPLACE, LOCK=NONE.
+* SQLite has no online index build. Each index is built in a transaction of its own, so writers
+  wait for one index at a time and readers carry on in WAL mode.
+"""
+import re
+import time
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
+
+from app.extensions import db
+
+
+def missing_indexes(engine=None):
+    """Return the declared indexes the database doesn't have, for tables that exist."""
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        # a half built index counts as missing, create_index builds it again
+        existing = set(index['name'] for index in inspector.get_indexes(table.name)) - \
+            _invalid_indexes(engine, table.name)
+        missing.extend(index for index in sorted(table.indexes, key=lambda index: index.name)
+                       if index.name not in existing)
+    return missing
+
+
+def _invalid_indexes(engine, table_name):
+    if engine.dialect.name != 'postgresql':
+        return set()
+    rows = engine.execute("SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                          "JOIN pg_class t ON t.oid = i.indrelid WHERE t.relname = %s AND NOT i.indisvalid",
+                          (table_name,))
+    return set(row[0] for row in rows)
+
+
+def index_sql(index, dialect):
+    """The statement create_index runs for index on dialect."""
+    sql = str(CreateIndex(index).compile(dialect=dialect))
+    if dialect.name == 'postgresql':
+        return re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX CONCURRENTLY IF NOT EXISTS ', sql)
+    if dialect.name == 'mysql':
+        return sql + ' ALGORITHM=INPLACE LOCK=NONE'
+    if dialect.name == 'sqlite':
+        return re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX IF NOT EXISTS ', sql)
+    return sql
+
+
+def create_index(index, engine=None):
+    """Build index and return the seconds it took."""
+    engine = engine or db.engine
+    start = time.perf_counter()
+    if engine.dialect.name == 'postgresql':
+        # CONCURRENTLY refuses to run inside a transaction block
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if index.name in _invalid_indexes(engine, index.table.name):
+                connection.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % index.name)
+            connection.execute(index_sql(index, engine.dialect))
+    else:
+        with engine.begin() as connection:
+            connection.execute(index_sql(index, engine.dialect))
+    return time.perf_counter() - start
+
+
+def analyze(engine=None):
+    """Refresh the planner statistics so the new indexes get picked."""
+    engine = engine or db.engine
+    if engine.dialect.name in ('sqlite', 'postgresql'):
+        with engine.begin() as connection:
+            connection.execute('ANALYZE')
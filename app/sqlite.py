@@ -0,0 +1,63 @@
+"""Settings for SQLite databases, applied to every new connection.
+
+With SQLite's defaults every commit rewrites the rollback journal and syncs it, readers wait for
+writers, and a writer that finds the database locked gives up. Several web workers then serialize
+on the many small commits of follow, collect and the notifications, and requests fail with
+"database is locked". Each connection is set up with:
+
+* journal_mode=WAL: readers don't block the writer and the writer doesn't block readers.
+* synchronous=NORMAL: in WAL mode a commit no longer waits for the disk. A power cut may lose
+  the last commits but never corrupts the database.
+* busy_timeout: a writer waits for the lock this many milliseconds before giving up.
+* cache_size and mmap_size: pages kept in memory, per connection and shared through the OS.
+
+Each value comes from an ALBUM_WALL_SQLITE_* config key, None leaves SQLite's default. A file
+database also gets a pool of ALBUM_WALL_SQLITE_POOL_SIZE connections, SQLAlchemy would open a
+new one, with the pragmas and an empty cache, for every request.
+"""
+import sqlite3
+
+from flask import current_app, has_app_context
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from app.extensions import db
+
+PRAGMAS = (
+    # busy_timeout first, switching to WAL needs the lock
+    ('busy_timeout', 'ALBUM_WALL_SQLITE_BUSY_TIMEOUT'),
+    ('journal_mode', 'ALBUM_WALL_SQLITE_JOURNAL_MODE'),
+    ('synchronous', 'ALBUM_WALL_SQLITE_SYNCHRONOUS'),
+    ('cache_size', 'ALBUM_WALL_SQLITE_CACHE_SIZE'),
+    ('mmap_size', 'ALBUM_WALL_SQLITE_MMAP_SIZE'),
+)
+
+
+def init_app(app):
+    """Pool the connections of a file database, call again after changing SQLALCHEMY_DATABASE_URI."""
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:') \
+            and app.config['ALBUM_WALL_SQLITE_POOL_SIZE']:
+        # a connection is only ever used by the thread that checked it out
+        options.update(poolclass=QueuePool, pool_size=app.config['ALBUM_WALL_SQLITE_POOL_SIZE'],
+                       connect_args=dict(check_same_thread=False))
+    elif options.get('poolclass') is QueuePool:
+        for key in ('poolclass', 'pool_size', 'connect_args'):
+            options.pop(key, None)
+
+
+def pragmas(config):
+    return [(name, config[key]) for name, key in PRAGMAS if config.get(key) is not None]
+
+
+@db.event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # connections are opened by the session and db.engine, which both need an app context
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not has_app_context():
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas(current_app.config):
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
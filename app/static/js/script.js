@@ -113,22 +113,42 @@ $(function () {
         });
     }
 
-    function update_notifications_count() {
+    function show_notifications_count(count) {
         var $el = $('#notification-badge');
+        if (count === 0) {
+            $el.hide();
+        } else {
+            $el.show();
+            $el.text(count)
+        }
+    }
+
+    function update_notifications_count() {
         $.ajax({
             type: 'GET',
-            url: $el.data('href'),
+            url: $('#notification-badge').data('href'),
             success: function (data) {
-                if (data.count === 0) {
-                    $('#notification-badge').hide();
-                } else {
-                    $el.show();
-                    $el.text(data.count)
-                }
+                show_notifications_count(data.count);
             }
         });
     }
 
+    function listen_notifications() {
+        // the server pushes the count when it changes, older browsers keep polling
+        if (!window.EventSource) {
+            setInterval(update_notifications_count, 30000);
+            return;
+        }
+        var source = new EventSource($('#notification-badge').data('stream'));
+        source.onmessage = function (e) {
+            var data = JSON.parse(e.data);
+            show_notifications_count(data.count);
+            if (data.message) {
+                toast(data.message);
+            }
+        };
+    }
+
     function follow(e) {
         var $el = $(e.target);
         var id = $el.data('id');
@@ -222,9 +242,45 @@ $(function () {
     });
 
     if (is_authenticated) {
-        setInterval(update_notifications_count, 30000);
+        listen_notifications();
     }
 
+    // poll a background task until it is done, then reload to show the result
+    $('.task-status').each(function () {
+        var $el = $(this);
+        var timer = setInterval(function () {
+            $.ajax({
+                type: 'GET',
+                url: $el.data('href'),
+                success: function (data) {
+                    if (data.status === 'finished' || data.status === 'failed') {
+                        clearInterval(timer);
+                        location.reload();
+                    }
+                }
+            });
+        }, 2000);
+    });
+
+    // keep progress figures of running tasks current
+    $('.task-progress').each(function () {
+        var $el = $(this);
+        var timer = setInterval(function () {
+            $.ajax({
+                type: 'GET',
+                url: $el.data('href'),
+                success: function (data) {
+                    $el.find('.task-percent').text(data.progress);
+                    $el.find('.badge').text(data.status);
+                    $el.find('.text-muted').text(data.message || '');
+                    if (data.status === 'finished' || data.status === 'failed') {
+                        clearInterval(timer);
+                    }
+                }
+            });
+        }, 2000);
+    });
+
     $("[data-toggle='tooltip']").tooltip({title: moment($(this).data('timestamp')).format('lll')})
 
 });
@@ -0,0 +1,309 @@
+"""Background jobs.
+
+Jobs are queued on the ``flask-album-tasks`` rq queue and run by a worker started with::
+
+    rq worker flask-album-tasks
+
+Jobs started with launch_task get a Task row the browser can poll through ``ajax.task_status``.
+With ALBUM_WALL_TASKS_INLINE set (the testing config does) jobs run inside the request instead.
+"""
+import os
+import sys
+from datetime import timedelta
+from functools import wraps
+from uuid import uuid4
+
+from flask import current_app, has_app_context
+from sqlalchemy import select, and_, or_, func
+
+from app import digests, pagecache, principals
+from app.emails import deliver_queued_mail
+from app.extensions import db
+from app.models import Task, User, Photo, Tag, Comment, Collect, Follow, Notification, FileDeletion, Upload, \
+    tagging, queue_file_deletions, avatar_paths, photo_paths, bump_versions
+from app.uploads import process_uploads
+from app.utils import crop_avatar_files
+
+_app = None
+
+
+def enqueue_job(name, *args):
+    """Queue the job ``name`` defined in this module, without a Task row."""
+    if current_app.config['ALBUM_WALL_TASKS_INLINE']:
+        return getattr(sys.modules[__name__], name)(*args)
+    try:
+        current_app.task_queue.enqueue('app.tasks.' + name, *args)
+    except Exception:
+        # the work is recorded in the database, `flask purge-files` picks up what is left behind
+        current_app.logger.exception('Could not queue %s', name)
+
+
+def enqueue_job_once(name, *args):
+    """Like enqueue_job, but skipped while an earlier one is still waiting in the queue.
+
+    For jobs that work through a backlog, such as deliver_mail, where a burst of triggers needs only one run.
+    The job calls job_started first thing, so triggers arriving while it runs queue the next one.
+    """
+    if not current_app.config['ALBUM_WALL_TASKS_INLINE']:
+        try:
+            if not current_app.redis.set(_pending_key(name), 1, nx=True, ex=600):
+                return None
+        except Exception:
+            current_app.logger.exception('Could not check for a pending %s', name)
+    return enqueue_job(name, *args)
+
+
+def job_started(name):
+    if not current_app.config['ALBUM_WALL_TASKS_INLINE']:
+        current_app.redis.delete(_pending_key(name))
+
+
+def _pending_key(name):
+    return 'flask-album-tasks:pending:' + name
+
+
+def launch_task(name, description, user, *args):
+    """Queue the job ``name`` defined in this module and return its Task."""
+    task = Task(id=uuid4().hex, name=name, description=description, user=user)
+    db.session.add(task)
+    db.session.commit()
+    if current_app.config['ALBUM_WALL_TASKS_INLINE']:
+        getattr(sys.modules[__name__], name)(task.id, *args)
+    else:
+        current_app.task_queue.enqueue('app.tasks.' + name, task.id, *args, job_id=task.id)
+    return task
+
+
+def set_task_progress(task_id, progress, message=None):
+    task = Task.query.get(task_id)
+    task.progress = progress
+    if message is not None:
+        task.message = message
+    db.session.commit()
+
+
+def job(func):
+    """Give func an app context when it runs on a worker."""
+    @wraps(func)
+    def wrapper(*args):
+        if has_app_context():  # inline
+            return func(*args)
+
+        global _app
+        if _app is None:
+            from app import create_app
+            _app = create_app()
+        with _app.app_context():
+            try:
+                return func(*args)
+            finally:
+                db.session.remove()
+    return wrapper
+
+
+def task(func):
+    """A job that keeps its Task row's status current."""
+    @job
+    @wraps(func)
+    def wrapper(task_id, *args):
+        _set_status(task_id, 'running')
+        try:
+            result = func(task_id, *args)
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception('Task %s failed', task_id)
+            _set_status(task_id, 'failed', str(e)[:250])
+            if not current_app.config['ALBUM_WALL_TASKS_INLINE']:  # so rq keeps the job in its failed registry
+                raise
+            return None
+        _set_status(task_id, 'finished', progress=100)
+        return result
+    return wrapper
+
+
+def _set_status(task_id, status, message=None, progress=None):
+    task = Task.query.get(task_id)
+    task.status = status
+    if message is not None:
+        task.message = message
+    if progress is not None:
+        task.progress = progress
+    db.session.commit()
+
+
+@task
+def crop_avatar(task_id, user_id, raw_filename, x, y, w, h):
+    # the crop was chosen on raw_filename, an image uploaded since gets its own crop
+    user = User.query.get(user_id)
+    if user.avatar_raw != raw_filename:
+        set_task_progress(task_id, 100, 'Skipped, a newer image was uploaded')
+        return
+    filenames = crop_avatar_files(raw_filename, x, y, w, h)
+    db.session.refresh(user)
+    if user.avatar_raw != raw_filename:
+        queue_file_deletions(avatar_paths(filenames))
+        set_task_progress(task_id, 100, 'Skipped, a newer image was uploaded')
+        return
+    old_filenames = [user.avatar_s, user.avatar_m, user.avatar_l]
+    user.avatar_s, user.avatar_m, user.avatar_l = filenames
+    # the replaced files go away only once nothing points at them any more
+    queue_file_deletions(avatar_paths(old_filenames))
+    db.session.commit()
+
+
+@task
+def process_upload_batch(task_id, user_id, upload_ids):
+    """Resize a batch of uploaded photos and add them, see uploads.process_uploads."""
+    uploads = Upload.query.filter(Upload.id.in_(upload_ids)).order_by(Upload.id).all()
+
+    def progress(done, total):
+        set_task_progress(task_id, int(done * 95 / total), 'Processed %d of %d photos' % (done, total))
+    try:
+        process_uploads(uploads, User.query.get(user_id), progress)
+    except Exception:
+        # so the upload page stops waiting for them; the files left behind go with purge-files --orphans
+        db.session.rollback()
+        Upload.query.filter(Upload.id.in_(upload_ids), Upload.status.in_(['processing', 'ready']))\
+            .update(dict(status='failed', message='Could not process the image'), synchronize_session=False)
+        db.session.commit()
+        raise
+
+
+@job
+def purge_deleted_files(batch_size=500):
+    """Unlink the files recorded in the FileDeletion outbox, batch_size rows per transaction.
+
+    Rows whose file can't be removed stay behind with their attempts bumped. Returns the
+    number of files handled.
+    """
+    # plain connections, this also runs from the session's after_commit hook
+    table = FileDeletion.__table__
+    last_id = 0
+    done_count = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(select([table.c.id, table.c.path]).where(table.c.id > last_id)
+                                      .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return done_count
+            done, failed = [], []
+            for row in rows:
+                try:
+                    os.remove(row.path)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    current_app.logger.warning('Could not remove %s', row.path)
+                    failed.append(row.id)
+                    continue
+                done.append(row.id)
+            if done:
+                connection.execute(table.delete().where(table.c.id.in_(done)))
+            if failed:
+                connection.execute(table.update().where(table.c.id.in_(failed))
+                                   .values(attempts=table.c.attempts + 1))
+            done_count += len(done)
+            last_id = rows[-1].id
+
+
+@job
+def send_digests(hours=24):
+    """Queue the daily notification digests, see app/digests.py."""
+    return digests.send_digests(timedelta(hours=hours))
+
+
+@job
+def deliver_mail(batch_size=None):
+    """Send what is due in the OutgoingMail outbox, see emails.deliver_queued_mail."""
+    job_started('deliver_mail')
+    return deliver_queued_mail(batch_size)
+
+
+def _delete_chunked(key, where, batch_size):
+    # select a chunk of keys matching where, delete exactly those, repeat; no ORM cascades involved
+    while True:
+        keys = [row[0] for row in db.session.execute(select([key]).where(where).limit(batch_size))]
+        if not keys:
+            return
+        db.session.execute(key.table.delete().where(and_(where, key.in_(keys))))
+        db.session.commit()
+
+
+@task
+def delete_account(task_id, user_id, batch_size=1000):
+    """Purge a user marked as deleted and everything hanging off the account."""
+    user = User.query.get(user_id)
+    photo_total = db.session.query(func.count(Photo.id)).filter(Photo.author_id == user_id).scalar()
+    photo_done = 0
+    counted_on = _counted_on_account(user_id)
+
+    # the user's photos and what hangs off them, one chunk of photos per transaction
+    last_id = 0
+    while True:
+        photos = db.session.query(Photo.id, Photo.filename, Photo.filename_s, Photo.filename_m)\
+            .filter(Photo.author_id == user_id, Photo.id > last_id).order_by(Photo.id).limit(batch_size).all()
+        if not photos:
+            break
+        photo_ids = [photo.id for photo in photos]
+        db.session.execute(Collect.__table__.delete().where(Collect.collected_id.in_(photo_ids)))
+        db.session.execute(tagging.delete().where(tagging.c.photo_id.in_(photo_ids)))
+        db.session.execute(Comment.__table__.delete().where(Comment.photo_id.in_(photo_ids)))
+        queue_file_deletions(photo_paths(name for photo in photos for name in photo[1:]))
+        db.session.execute(Photo.__table__.delete().where(Photo.id.in_(photo_ids)))
+        photo_done += len(photo_ids)
+        last_id = photo_ids[-1]
+        set_task_progress(task_id, int(photo_done * 80 / photo_total),
+                          'Deleted %d of %d photos' % (photo_done, photo_total))
+        pagecache.purge(['photo:%d' % photo_id for photo_id in photo_ids])
+
+    # comments left on other people's photos, with the replies underneath them
+    comment_ids = set(row[0] for row in db.session.query(Comment.id).filter(Comment.author_id == user_id))
+    pending = list(comment_ids)
+    while pending:
+        chunk, pending = pending[:batch_size], pending[batch_size:]
+        replies = set(row[0] for row in db.session.query(Comment.id).filter(Comment.replying_to_id.in_(chunk)))
+        pending.extend(replies - comment_ids)
+        comment_ids |= replies
+    comment_ids = sorted(comment_ids)
+    for i in range(0, len(comment_ids), batch_size):
+        chunk = comment_ids[i:i + batch_size]
+        # replies in later chunks would still point at these, they go next anyway
+        db.session.execute(Comment.__table__.update().where(Comment.replying_to_id.in_(chunk))
+                           .values(replying_to_id=None))
+        db.session.execute(Comment.__table__.delete().where(Comment.id.in_(chunk)))
+        db.session.commit()
+    set_task_progress(task_id, 85, 'Deleted comments')
+
+    _delete_chunked(Collect.collected_id, Collect.collector_id == user_id, batch_size)
+    _delete_chunked(Follow.followed_id, Follow.follower_id == user_id, batch_size)
+    _delete_chunked(Follow.follower_id, Follow.followed_id == user_id, batch_size)
+    _delete_chunked(Notification.id, Notification.receiver_id == user_id, batch_size)
+    _delete_chunked(Task.id, Task.user_id == user_id, batch_size)
+    _delete_chunked(Upload.id, Upload.user_id == user_id, batch_size)
+    set_task_progress(task_id, 95, 'Deleted collections, follows and notifications')
+
+    queue_file_deletions(avatar_paths([user.avatar_s, user.avatar_m, user.avatar_l, user.avatar_raw]))
+    db.session.execute(User.__table__.delete().where(User.id == user_id))
+    # the rows went without a flush, so the flush hooks didn't see them
+    for model, ids in counted_on.items():
+        for i in range(0, len(ids), batch_size):
+            bump_versions(model, ids[i:i + batch_size])
+    db.session.commit()
+    principals.invalidate([user_id])
+    pagecache.purge(['user:%d' % user_id, 'search'] +
+                    ['%s:%d' % (model.__tablename__, id) for model, ids in counted_on.items() for id in ids])
+
+
+def _counted_on_account(user_id):
+    # the other rows showing counts the account's follows, collects, comments and photos are part of
+    photo_ids = select([Photo.id]).where(Photo.author_id == user_id)
+    users = db.session.query(Follow.followed_id).filter(Follow.follower_id == user_id)\
+        .union(db.session.query(Follow.follower_id).filter(Follow.followed_id == user_id),
+               db.session.query(Collect.collector_id).filter(Collect.collected_id.in_(photo_ids)))
+    photos = db.session.query(Photo.id).filter(Photo.author_id != user_id, or_(
+        Photo.id.in_(select([Collect.collected_id]).where(Collect.collector_id == user_id)),
+        Photo.id.in_(select([Comment.photo_id]).where(Comment.author_id == user_id))))
+    tags = db.session.query(tagging.c.tag_id).filter(tagging.c.photo_id.in_(photo_ids)).distinct()
+    return {User: sorted(row[0] for row in users if row[0] != user_id),
+            Photo: sorted(row[0] for row in photos),
+            Tag: sorted(row[0] for row in tags)}
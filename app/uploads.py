@@ -0,0 +1,208 @@
+"""Photo uploads, sent whole or in chunks.
+
+The upload page has Dropzone cut every file into chunks of ALBUM_WALL_UPLOAD_CHUNK_SIZE bytes,
+each a request of its own well under MAX_CONTENT_LENGTH, so a photo of up to
+ALBUM_WALL_MAX_PHOTO_SIZE bytes never sits whole in a worker's memory. write_chunk copies each
+chunk to its offset in a part file under the chunks directory of ALBUM_WALL_UPLOAD_PATH. Writing
+at the offset makes a chunk Dropzone retries after a failure harmless, and the part file waits
+for the retry. The last chunk checks that the file is complete, and save_photo then checks that
+it is an image, moves it into place, writes the small and medium sizes and adds the Photo.
+
+A drop of several files is sent as a batch: the upload page adds a batch id to every file, and
+store_original only checks and moves each image into place with an Upload row. Once the queue is
+empty the page asks ajax.process_uploads to start the process_upload_batch task, which has
+process_uploads write the smaller sizes across ALBUM_WALL_UPLOAD_WORKERS processes, one per CPU by
+default, and add all the Photos in one transaction. Each Upload row records how its file went, the
+page polls them through ajax.upload_status.
+
+Part files of uploads that were given up on are removed by `flask purge-files --orphans`. The
+same command expires Upload rows older than its grace period, with the originals of those that
+never became a Photo.
+"""
+import os
+import re
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from flask import current_app
+from PIL import Image
+
+from app.extensions import db
+from app.models import Photo, Upload, queue_file_deletions, photo_paths
+
+UPLOAD_ID = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+BATCH_ID = re.compile(r'^[0-9a-f]{32}$')
+# Upload statuses whose file no Photo points at yet
+PENDING = ('uploaded', 'processing', 'ready')
+# the extension comes from the content, never from the name the browser sent
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp'}
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    """An upload that is refused, the message is shown to the user."""
+
+
+def chunk_path():
+    return os.path.join(current_app.config['ALBUM_WALL_UPLOAD_PATH'], 'chunks')
+
+
+def write_chunk(user_id, form, stream):
+    """Write a chunk of a Dropzone upload, return the part file once the last chunk is in."""
+    try:
+        index, count = int(form['dzchunkindex']), int(form['dztotalchunkcount'])
+        offset, total = int(form['dzchunkbyteoffset']), int(form['dztotalfilesize'])
+    except (KeyError, ValueError):
+        raise UploadError('Invalid chunk')
+    upload_id = form.get('dzuuid', '')
+    if not UPLOAD_ID.match(upload_id) or not 0 <= index < count or not 0 <= offset < total:
+        raise UploadError('Invalid chunk')
+    if total > current_app.config['ALBUM_WALL_MAX_PHOTO_SIZE']:
+        raise UploadError('File is too large')
+
+    os.makedirs(chunk_path(), exist_ok=True)
+    # per user, nobody can add to another user's upload
+    path = os.path.join(chunk_path(), '%d-%s.part' % (user_id, upload_id))
+    with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as f:
+        f.seek(offset)
+        _copy(stream, f, total - offset)
+    if index < count - 1:
+        return None
+    if os.path.getsize(path) != total:
+        os.remove(path)
+        raise UploadError('Upload incomplete, please try again')
+    return path
+
+
+def write_file(user_id, stream):
+    """Write a file sent whole, return its part file."""
+    os.makedirs(chunk_path(), exist_ok=True)
+    path = os.path.join(chunk_path(), '%d-%s.part' % (user_id, uuid.uuid4()))
+    with open(path, 'wb') as f:
+        _copy(stream, f, current_app.config['ALBUM_WALL_MAX_PHOTO_SIZE'])
+    return path
+
+
+def _copy(stream, f, limit):
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        if not block:
+            return
+        limit -= len(block)
+        if limit < 0:
+            raise UploadError('File is too large')
+        f.write(block)
+
+
+def save_photo(path, author):
+    """Move the uploaded image at path into place with its smaller sizes, return its new Photo."""
+    filename = place_image(path)
+    filename_s, filename_m = make_sizes(current_app.config['ALBUM_WALL_UPLOAD_PATH'], filename, _widths())
+    photo = Photo(filename=filename, filename_s=filename_s, filename_m=filename_m, author=author)
+    db.session.add(photo)
+    return photo
+
+
+def store_original(path, user, batch_id):
+    """Move the uploaded image at path into place for its batch, return its new Upload."""
+    if not BATCH_ID.match(batch_id):
+        os.remove(path)
+        raise UploadError('Invalid batch')
+    upload = Upload(batch_id=batch_id, filename=place_image(path), user_id=user.id)
+    db.session.add(upload)
+    return upload
+
+
+def place_image(path):
+    """Check that the file at path is an image and move it to the upload folder, return its filename."""
+    try:
+        with Image.open(path) as img:
+            image_format = img.format
+            img.verify()
+    except Exception:
+        os.remove(path)
+        raise UploadError('Not an image')
+    if image_format not in EXTENSIONS:
+        os.remove(path)
+        raise UploadError('Upload a JPEG, PNG, GIF or WebP image')
+
+    filename = uuid.uuid4().hex + EXTENSIONS[image_format]
+    shutil.move(path, os.path.join(current_app.config['ALBUM_WALL_UPLOAD_PATH'], filename))
+    return filename
+
+
+def make_sizes(folder, filename, widths):
+    """Write the image filename in folder at each (width, suffix) of widths, return their filenames.
+
+    An image no wider than a width is used as it is. Runs in process_uploads' worker processes, so
+    it takes no app context.
+    """
+    stem, ext = os.path.splitext(filename)
+    filenames = []
+    with Image.open(os.path.join(folder, filename)) as img:
+        for width, suffix in widths:
+            if img.size[0] <= width:
+                filenames.append(filename)
+                continue
+            height = int(img.size[1] * width / img.size[0])
+            img.resize((width, height), Image.LANCZOS).save(os.path.join(folder, stem + suffix + ext))
+            filenames.append(stem + suffix + ext)
+    return filenames
+
+
+def _widths():
+    sizes = current_app.config['ALBUM_WALL_PHOTO_SIZE']
+    return [(sizes[name], current_app.config['ALBUM_WALL_PHOTO_SUFFIX'][sizes[name]]) for name in ('small', 'medium')]
+
+
+def process_uploads(uploads, author, progress=None):
+    """Write the smaller sizes of the uploads' images, then add their Photos, return the Photos.
+
+    The images are resized in parallel, each Upload's status is committed as it finishes and
+    progress(done, total) called. The Photos of the uploads that made it are added in one
+    transaction at the end, in upload order.
+    """
+    folder = current_app.config['ALBUM_WALL_UPLOAD_PATH']
+    widths = _widths()
+    workers = min(len(uploads), current_app.config['ALBUM_WALL_UPLOAD_WORKERS'] or os.cpu_count() or 1)
+    sizes = {}
+    # one worker resizes in a thread of this process, there is nothing to gain from forking
+    with (ProcessPoolExecutor if workers > 1 else ThreadPoolExecutor)(max(workers, 1)) as executor:
+        futures = {executor.submit(make_sizes, folder, upload.filename, widths): upload for upload in uploads}
+        for done, future in enumerate(as_completed(futures), 1):
+            upload = futures[future]
+            try:
+                sizes[upload.id] = future.result()
+            except Exception:
+                current_app.logger.exception('Could not resize %s', upload.filename)
+                upload.status, upload.message = 'failed', 'Could not process the image'
+                queue_file_deletions(photo_paths([upload.filename]))
+            else:
+                upload.status = 'ready'
+            db.session.commit()
+            if progress is not None:
+                progress(done, len(uploads))
+
+    ready = [upload for upload in uploads if upload.id in sizes]
+    photos = [Photo(filename=upload.filename, filename_s=sizes[upload.id][0], filename_m=sizes[upload.id][1],
+                    author=author) for upload in ready]
+    db.session.add_all(photos)
+    db.session.flush()
+    for upload, photo in zip(ready, photos):
+        upload.status, upload.photo_id = 'done', photo.id
+    db.session.commit()
+    return photos
+
+
+def pending_upload_paths():
+    """The originals of the uploads still waiting for their Photo."""
+    return photo_paths(row[0] for row in db.session.query(Upload.filename).filter(Upload.status.in_(PENDING)))
+
+
+def expire_uploads(before):
+    """Delete the Upload rows from before, and the originals of the pending ones, return how many went."""
+    query = Upload.query.filter(Upload.timestamp < before)
+    queue_file_deletions(photo_paths(row[0] for row in query.filter(Upload.status.in_(PENDING))
+                                     .with_entities(Upload.filename)))
+    return query.delete(synchronize_session=False)
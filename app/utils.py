@@ -1,4 +1,5 @@
 import os
+import tempfile
 import uuid
 
 try:
@@ -6,14 +7,14 @@ try:
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
-import PIL
 from PIL import Image
 
 from flask import request, url_for, flash, redirect, current_app
+from flask_login import current_user
 from itsdangerous import BadSignature, SignatureExpired
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 
-from app.extensions import db
+from app.extensions import db, avatars
 from app.models import User
 from app.config import Operations
 
@@ -76,21 +77,56 @@ def flash_errors(form):
             flash(u'Error in the %s field - %s' % (getattr(form, field).label.text, error))
 
 
+def hydrate_follow_state(users):
+    # one IN query each for is_following/is_followed_by over a whole page of user cards
+    if current_user.is_authenticated:
+        user_ids = [user.id for user in users]
+        current_user.following_ids(user_ids)
+        current_user.follower_ids(user_ids)
+
+
+def hydrate_collect_state(photos):
+    # one IN query for is_collecting over a whole page of photos
+    if current_user.is_authenticated:
+        current_user.collecting_ids([photo.id for photo in photos])
+
+
 def rename_image(old_filename):
     ext = os.path.splitext(old_filename)[1]
     new_filename = uuid.uuid4().hex + ext
     return new_filename
 
 
-def resize_image(image, filename, base_width):
-    filename, ext = os.path.splitext(filename)
-    img = Image.open(image)
-    if img.size[0] <= base_width:
-        return filename + ext
-    w_percentage = (base_width/float(img.size[0]))
-    h_size = int(float(img.size[1])*float(w_percentage))
-    img = img.resize((base_width, h_size), PIL.Image.ANTIALIAS)
-
-    filename += current_app.config["ALBUM_WALL_PHOTO_SUFFIX"][base_width] + ext
-    img.save(os.path.join(current_app.config['ALBUM_WALL_PHOTO_PATH'], filename))
-    return filename
\ No newline at end of file
+def _save_atomic(img, path, **kwargs):
+    # readers see either no file or the complete one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, format='PNG', **kwargs)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def crop_avatar_files(filename, x, y, w, h):
+    """Crop the raw avatar into the three avatar sizes, return [filename_s, filename_m, filename_l].
+
+    Same result as avatars.crop_avatar, but every file is written atomically.
+    """
+    x, y, w, h = int(x), int(y), int(w), int(h)
+    path = current_app.config['AVATARS_SAVE_PATH']
+    raw_img = Image.open(os.path.join(path, filename))
+
+    base_width = current_app.config['AVATARS_CROP_BASE_WIDTH']
+    if raw_img.size[0] >= base_width:
+        raw_img = avatars.resize_avatar(raw_img, base_width=base_width)
+    cropped_img = raw_img.crop((x, y, x + w, y + h))
+
+    name = uuid.uuid4().hex
+    filenames = []
+    for size, suffix in zip(current_app.config['AVATARS_SIZE_TUPLE'], ['_s', '_m', '_l']):
+        img = avatars.resize_avatar(cropped_img, base_width=size)
+        filenames.append(name + suffix + '.png')
+        _save_atomic(img, os.path.join(path, filenames[-1]), optimize=True)
+    return filenames
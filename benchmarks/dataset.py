@@ -0,0 +1,95 @@
+"""A large generated dataset in a directory of its own, shared by the benchmarks.
+
+The first run generates it with the forge fakes; later runs with the same scale and seed reuse the directory.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func  # noqa: E402
+
+from app import create_app  # noqa: E402
+from app import fakes  # noqa: E402
+from app import sqlite  # noqa: E402
+from app.extensions import db  # noqa: E402
+from app.models import Role, User, Photo, Tag, Follow, Collect, tagging  # noqa: E402
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dataset')
+
+# rows per unit of --scale
+SIZES = dict(user=1000, follow=20000, tag=200, photo=5000, comment=20000, collection=20000)
+ADMIN_FOLLOWS = 100
+
+
+def bench_app(path=DEFAULT_PATH, config_name='testing'):
+    """Return an app whose database, uploads and search index live under path."""
+    app = create_app(config_name)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(path, 'bench.db')
+    sqlite.init_app(app)
+    app.config['ALBUM_WALL_UPLOAD_PATH'] = os.path.join(path, 'uploads')
+    app.config['AVATARS_SAVE_PATH'] = os.path.join(path, 'uploads', 'avatars')
+    app.config['ALBUM_WALL_IDENTICON_PATH'] = os.path.join(path, 'uploads', 'avatars', 'identicons')
+    # the testing config keeps the index in memory, a dataset this size should only be indexed once
+    whooshee_config = app.extensions['whooshee']
+    whooshee_config['memory_storage'] = False
+    whooshee_config['index_path_root'] = os.path.join(path, 'whooshee')
+    for directory in [app.config['AVATARS_SAVE_PATH'], whooshee_config['index_path_root']]:
+        os.makedirs(directory, exist_ok=True)
+    return app
+
+
+def ensure_dataset(app, path=DEFAULT_PATH, scale=1, seed=42, echo=print):
+    """Generate the dataset under path unless one with the same scale and seed is there already."""
+    meta_path = os.path.join(path, 'meta.json')
+    meta = dict(scale=scale, seed=seed)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    with app.app_context():
+        echo('Generating the benchmark dataset in %s (scale %s, seed %s)' % (path, scale, seed))
+        db.drop_all()
+        db.create_all()
+        fakes.seed(seed)
+        Role.init_role()
+        fakes.fake_admin()
+        fakes.fake_user(int(SIZES['user'] * scale))
+        fakes.fake_follow(int(SIZES['follow'] * scale))
+        fakes.fake_tag(int(SIZES['tag'] * scale))
+        fakes.fake_photo(int(SIZES['photo'] * scale))
+        fakes.fake_comment(int(SIZES['comment'] * scale))
+        fakes.fake_collect(int(SIZES['collection'] * scale))
+        _follow_popular(ADMIN_FOLLOWS)
+        fakes.fake_search_index()
+        db.session.remove()
+
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+def _follow_popular(count):
+    # the admin logs in for the benchmarks, give it a home timeline like an active user's
+    admin = User.query.filter_by(username='n.wang').one()
+    followed = set(row[0] for row in db.session.query(Follow.followed_id).filter(Follow.follower_id == admin.id))
+    popular = [row[0] for row in db.session.query(Follow.followed_id).group_by(Follow.followed_id)
+               .order_by(func.count().desc(), Follow.followed_id).limit(count + 1)]
+    db.session.execute(Follow.__table__.insert(), [dict(follower_id=admin.id, followed_id=user_id)
+                                                   for user_id in popular if user_id not in followed][:count])
+    db.session.commit()
+
+
+def hot_targets():
+    """The most followed user, most collected photo and most used tag, the pages that get the traffic."""
+    user = User.query.get(db.session.query(Follow.followed_id).filter(Follow.follower_id != Follow.followed_id)
+                          .group_by(Follow.followed_id).order_by(func.count().desc(), Follow.followed_id)
+                          .limit(1).scalar())
+    photo = Photo.query.get(db.session.query(Collect.collected_id).group_by(Collect.collected_id)
+                            .order_by(func.count().desc(), Collect.collected_id).limit(1).scalar())
+    tag = Tag.query.get(db.session.query(tagging.c.tag_id).group_by(tagging.c.tag_id)
+                        .order_by(func.count().desc(), tagging.c.tag_id).limit(1).scalar())
+    return dict(user=user, photo=photo, tag=tag)
@@ -0,0 +1,79 @@
+"""Building the notification digests for a large number of recipients.
+
+    python benchmarks/digests.py --users 100000
+
+Generates opted-in users with a few unread notifications each in a throwaway SQLite file, then times
+digests.send_digests and reports the peak memory allocated while it ran. Delivery is left to the
+workers: the outbox is filled but nothing is sent.
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from app.digests import send_digests  # noqa: E402
+from app.extensions import db  # noqa: E402
+from app.models import Role, User, Notification, OutgoingMail  # noqa: E402
+
+
+def insert_chunked(table, rows, chunk_size=10000):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+    db.session.commit()
+
+
+@click.command()
+@click.option('--users', default=100000, help='Opted-in recipients, default is 100000')
+@click.option('--notifications', default=3, help='Unread notifications per user, default is 3')
+@click.option('--chunk-size', default=1000, help='Recipients per transaction, default is 1000')
+def main(users, notifications, chunk_size):
+    workdir = tempfile.mkdtemp(prefix='album-wall-bench-')
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    # no worker in this run, the deliver_mail jobs can't be queued and that's fine
+    app.config['ALBUM_WALL_TASKS_INLINE'] = False
+    app.logger.setLevel(logging.CRITICAL)
+    try:
+        with app.app_context():
+            db.create_all()
+            Role.init_role()
+            now = datetime.utcnow()
+            insert_chunked(User.__table__, (dict(id=i, username='u%d' % i, email='u%d@example.com' % i, confirmed=True,
+                                                 active=True, deleted=False, receive_digest_emails=True)
+                                            for i in range(1, users + 1)))
+            insert_chunked(Notification.__table__, (
+                dict(receiver_id=i, message='User <a href="/user/u%d/">u%d</a> followed you.' % (n, n), is_read=False,
+                     timestamp=now - timedelta(minutes=n * 7))
+                for i in range(1, users + 1) for n in range(notifications)))
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            count = send_digests(chunk_size=chunk_size, now=now)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert OutgoingMail.query.count() == count == users
+            click.echo('%d digests in %.2fs, %.0f digests/s, peak memory %.1f MB' % (
+                count, elapsed, count / elapsed, peak / 1024 / 1024))
+            db.session.remove()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Latency and query counts of the hot routes against a large generated dataset.
+
+    python benchmarks/endpoints.py
+    python benchmarks/endpoints.py --output after.json --baseline benchmarks/baseline/endpoints.json
+
+Each route is requested --iterations times through the test client after a warm-up, logged in as the administrator
+whose timeline follows the most popular users. The results are written as JSON; with --baseline the run fails
+when a route issues more queries than the baseline.
+
+Latencies only compare between runs on the same machine with the same interpreter and dependencies: the
+checked-in baseline was recorded on one machine, and its timings say nothing about another. A p90 more than
+--tolerance slower than the baseline is reported, and fails the run only with --timing, which is meant for
+a baseline recorded on the machine running the comparison. Query counts hold anywhere and are always checked.
+"""
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+
+import click
+from flask import url_for
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dataset import DEFAULT_PATH, bench_app, ensure_dataset, hot_targets  # noqa: E402
+from app.extensions import db  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline', 'endpoints.json')
+
+
+def routes(targets):
+    """(name, url) of every route measured, built inside a request context."""
+    user, photo, tag = targets['user'], targets['photo'], targets['tag']
+    return [
+        ('main.index', url_for('main.index')),
+        ('main.explore', url_for('main.explore')),
+        ('main.show_photo', url_for('main.show_photo', photo_id=photo.id)),
+        ('main.show_by_tag', url_for('main.show_by_tag', tag_id=tag.id)),
+        ('main.search photo', url_for('main.search', q=tag.name, category='photo')),
+        ('main.search user', url_for('main.search', q=user.username, category='user')),
+        ('user.index', url_for('user.index', username=user.username)),
+        ('user.show_followers', url_for('user.show_followers', username=user.username)),
+        ('ajax.followers_count', url_for('ajax.followers_count', user_id=user.id)),
+        ('ajax.collectors_count', url_for('ajax.collectors_count', photo_id=photo.id)),
+        ('ajax.notifications_count', url_for('ajax.notifications_count')),
+        ('admin.index', url_for('admin.index')),
+    ]
+
+
+@contextmanager
+def count_queries(engine, counter):
+    def before_cursor_execute(*args):
+        counter[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def percentile(values, p):
+    # nearest rank on sorted values
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def measure(client, engine, url, iterations, warmup):
+    for _ in range(warmup):
+        client.get(url)
+    timings = []
+    queries = []
+    status = None
+    for _ in range(iterations):
+        counter = [0]
+        with count_queries(engine, counter):
+            start = time.perf_counter()
+            response = client.get(url)
+            timings.append((time.perf_counter() - start) * 1000)
+        queries.append(counter[0])
+        status = response.status_code
+    return dict(url=url, status=status, queries=sorted(queries)[len(queries) // 2],
+                p50_ms=round(percentile(timings, 50), 2), p90_ms=round(percentile(timings, 90), 2),
+                p99_ms=round(percentile(timings, 99), 2), mean_ms=round(sum(timings) / len(timings), 2))
+
+
+def compare(results, baseline, tolerance):
+    """Return (query regressions, slowdowns) against baseline as lists of messages."""
+    regressions = []
+    slowdowns = []
+    for name, before in baseline['routes'].items():
+        after = results['routes'].get(name)
+        if after is None:
+            continue
+        if after['queries'] > before['queries']:
+            regressions.append('%s: %d queries, baseline %d' % (name, after['queries'], before['queries']))
+        if after['p90_ms'] > before['p90_ms'] * (1 + tolerance):
+            slowdowns.append('%s: p90 %.2fms, baseline %.2fms' % (name, after['p90_ms'], before['p90_ms']))
+    return regressions, slowdowns
+
+
+@click.command()
+@click.option('--dataset', default=DEFAULT_PATH, help='Directory of the generated dataset, reused across runs')
+@click.option('--scale', default=1.0, help='Dataset size, 1 is 1000 users and 5000 photos, default is 1')
+@click.option('--seed', default=42, help='Random seed of the dataset, default is 42')
+@click.option('--iterations', default=50, help='Timed requests per route, default is 50')
+@click.option('--warmup', default=5, help='Untimed requests per route first, default is 5')
+@click.option('--output', default=None, help='Write the results as JSON to this file')
+@click.option('--baseline', default=None, help='Compare against these results, e.g. ' + os.path.relpath(BASELINE_PATH))
+@click.option('--tolerance', default=0.25, help='Allowed p90 slowdown against the baseline, default is 0.25')
+@click.option('--timing', is_flag=True, help='Also fail on p90 slowdowns, for a baseline recorded on this machine')
+def main(dataset, scale, seed, iterations, warmup, output, baseline, tolerance, timing):
+    app = bench_app(dataset)
+    ensure_dataset(app, dataset, scale, seed, echo=click.echo)
+
+    results = dict(meta=dict(scale=scale, seed=seed, iterations=iterations, python=platform.python_version(),
+                             platform=platform.platform(), cpus=os.cpu_count(),
+                             timestamp=time.strftime('%Y-%m-%dT%H:%M:%S')), routes={})
+    with app.test_request_context():
+        login_url = url_for('auth.login')
+        urls = routes(hot_targets())
+        engine = db.engine
+        db.session.remove()
+
+    # requests run outside of any context, so every one gets a fresh session like in production
+    client = app.test_client()
+    client.post(login_url, data=dict(email='n.wang.travel@gmail.com', password='derigel'))
+    for name, url in urls:
+        result = measure(client, engine, url, iterations, warmup)
+        results['routes'][name] = result
+        click.echo('%-26s %3d  %4d queries  p50 %8.2fms  p90 %8.2fms  p99 %8.2fms' % (
+            name, result['status'], result['queries'], result['p50_ms'], result['p90_ms'], result['p99_ms']))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if baseline:
+        with open(baseline) as f:
+            regressions, slowdowns = compare(results, json.load(f), tolerance)
+        if timing:
+            regressions += slowdowns
+        else:
+            for message in slowdowns:
+                click.echo('SLOWER ' + message + ' (only meaningful on the machine of the baseline)', err=True)
+        for message in regressions:
+            click.echo('REGRESSION ' + message, err=True)
+        if regressions:
+            sys.exit(1)
+        click.echo('No regressions against %s' % baseline)
+
+
+if __name__ == '__main__':
+    main()
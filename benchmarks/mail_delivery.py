@@ -0,0 +1,97 @@
+"""Throughput of email delivery against a local aiosmtpd server.
+
+    python benchmarks/mail_delivery.py --count 2000
+
+Compares the outbox delivery (emails.deliver_queued_mail, one SMTP connection for the run) with the old
+send_mail, which started a thread and opened a connection per message. Needs aiosmtpd.
+"""
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import click
+from aiosmtpd.controller import Controller
+from flask_mail import Message
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from app.emails import deliver_queued_mail  # noqa: E402
+from app.extensions import db, mail  # noqa: E402
+from app.models import OutgoingMail  # noqa: E402
+
+
+class CountingHandler:
+    def __init__(self):
+        self.count = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.count += 1
+        return '250 Message accepted'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def thread_per_message(app, count):
+    def send(message):
+        with app.app_context():
+            mail.send(message)
+
+    threads = [Thread(target=send, args=[Message('Hello', recipients=['user%d@example.com' % i], body='Hello')])
+               for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@click.command()
+@click.option('--count', default=2000, help='Messages per run, default is 2000')
+@click.option('--batch-size', default=100, help='Messages per claim, default is 100')
+def main(count, batch_size):
+    handler = CountingHandler()
+    port = free_port()
+    controller = Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    workdir = tempfile.mkdtemp(prefix='album-wall-bench-')
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    state = app.extensions['mail']
+    state.suppress = False
+    state.server, state.port, state.use_ssl = '127.0.0.1', port, False
+    state.default_sender = 'noreply@example.com'
+    try:
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            thread_per_message(app, count)
+            elapsed = time.perf_counter() - start
+            click.echo('thread per message: %5d sent in %6.2fs  %8.1f msgs/s' % (handler.count, elapsed,
+                                                                                 handler.count / elapsed))
+
+            handler.count = 0
+            db.session.execute(OutgoingMail.__table__.insert(), [
+                dict(recipient='user%d@example.com' % i, subject='Hello', body='Hello', attempts=0, dead=False)
+                for i in range(count)])
+            db.session.commit()
+            start = time.perf_counter()
+            sent, failed = deliver_queued_mail(batch_size)
+            elapsed = time.perf_counter() - start
+            click.echo('pooled outbox:      %5d sent in %6.2fs  %8.1f msgs/s  (%d failed)' % (
+                handler.count, elapsed, handler.count / elapsed, failed))
+            db.session.remove()
+    finally:
+        controller.stop()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
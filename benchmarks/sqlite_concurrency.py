@@ -0,0 +1,115 @@
+"""Small commits from several worker processes sharing one SQLite file.
+
+    python benchmarks/sqlite_concurrency.py --workers 8 --operations 300
+
+Each worker process stands in for a web worker: it follows and unfollows users, pushes a
+notification and reads an unread count, committing after every write like the views do. The run
+is made once with SQLite's defaults and once with the ALBUM_WALL_SQLITE_* settings of app/sqlite.py,
+and reports the operations per second, the latency percentiles and the "database is locked" errors.
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from app import create_app, sqlite  # noqa: E402
+from app.extensions import db  # noqa: E402
+from app.models import Role, User, Notification  # noqa: E402
+from app.notifications import push_follow_notification  # noqa: E402
+
+USERS = 200
+DEFAULTS = dict(ALBUM_WALL_SQLITE_JOURNAL_MODE=None, ALBUM_WALL_SQLITE_SYNCHRONOUS=None,
+                ALBUM_WALL_SQLITE_BUSY_TIMEOUT=None, ALBUM_WALL_SQLITE_CACHE_SIZE=None,
+                ALBUM_WALL_SQLITE_MMAP_SIZE=None, ALBUM_WALL_SQLITE_POOL_SIZE=0)
+
+
+def make_app(path, tuned):
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    # the search index is beside the point here
+    app.extensions['whooshee']['enable_indexing'] = False
+    if not tuned:
+        app.config.update(DEFAULTS)
+    sqlite.init_app(app)
+    return app
+
+
+def worker(args):
+    path, tuned, operations, seed = args
+    app = make_app(path, tuned)
+    rng = random.Random(seed)
+    latencies = []
+    locked = 0
+    with app.test_request_context():
+        for _ in range(operations):
+            follower, followed = rng.sample(range(1, USERS + 1), 2)
+            start = time.perf_counter()
+            try:
+                user, other = User.query.get(follower), User.query.get(followed)
+                user.follow(other)
+                push_follow_notification(follower=user, receiver=other)
+                Notification.query.with_parent(other).filter_by(is_read=False).count()
+                user.unfollow(other)
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                db.session.rollback()
+                locked += 1
+                continue
+            finally:
+                db.session.remove()
+            latencies.append(time.perf_counter() - start)
+    return latencies, locked
+
+
+def run(path, tuned, workers, operations):
+    app = make_app(path, tuned)
+    with app.app_context():
+        db.create_all()
+        Role.init_role()
+        db.session.add_all(User(username='user%d' % i, email='user%d@example.com' % i, confirmed=True)
+                           for i in range(USERS))
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+    start = time.perf_counter()
+    with Pool(workers) as pool:
+        results = pool.map(worker, [(path, tuned, operations, seed) for seed in range(workers)])
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for result in results for latency in result[0])
+    locked = sum(result[1] for result in results)
+    return elapsed, latencies, locked
+
+
+@click.command()
+@click.option('--workers', default=8, help='Worker processes, default is 8')
+@click.option('--operations', default=300, help='Operations per worker, default is 300')
+def main(workers, operations):
+    workdir = tempfile.mkdtemp(prefix='album-wall-bench-')
+    try:
+        for tuned in (False, True):
+            path = os.path.join(workdir, 'tuned.db' if tuned else 'default.db')
+            elapsed, latencies, locked = run(path, tuned, workers, operations)
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+            click.echo('%-8s %6d ok in %6.2fs  %7.1f ops/s  p50 %6.1fms  p99 %7.1fms  %4d locked' % (
+                'tuned' if tuned else 'default', len(latencies), elapsed, len(latencies) / elapsed,
+                percentile(0.5), percentile(0.99), locked))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Throughput of user creation.
+
+    python benchmarks/user_creation.py --count 10000
+
+Users are written to a throwaway SQLite file, so commits really hit the disk. The bulk path (accounts.create_users)
+is timed for --count users, the one-commit-per-user registration path for --single.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from app.accounts import create_user, create_users  # noqa: E402
+from app.extensions import db  # noqa: E402
+from app.models import Role, User, Follow  # noqa: E402
+
+
+def user_rows(count, prefix):
+    for i in range(count):
+        yield dict(name='User %d' % i, username='%s%d' % (prefix, i), email='%s%d@example.com' % (prefix, i),
+                   confirmed=True)
+
+
+@click.command()
+@click.option('--count', default=10000, help='Users created through the bulk path, default is 10000')
+@click.option('--single', default=200, help='Users created one commit at a time, default is 200')
+@click.option('--batch-size', default=1000, help='Users per commit on the bulk path, default is 1000')
+def main(count, single, batch_size):
+    workdir = tempfile.mkdtemp(prefix='album-wall-bench-')
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    app.config['AVATARS_SAVE_PATH'] = os.path.join(workdir, 'avatars')
+    os.makedirs(app.config['AVATARS_SAVE_PATH'])
+    try:
+        with app.test_request_context():
+            db.create_all()
+            Role.init_role()
+
+            start = time.perf_counter()
+            create_users(user_rows(count, 'bulk'), password='123456789', batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            click.echo('bulk:   %6d users in %7.2fs  %8.1f users/s' % (count, elapsed, count / elapsed))
+
+            start = time.perf_counter()
+            for row in user_rows(single, 'single'):
+                create_user('123456789', **row)
+            elapsed = time.perf_counter() - start
+            click.echo('single: %6d users in %7.2fs  %8.1f users/s' % (single, elapsed, single / elapsed))
+
+            assert User.query.count() == count + single
+            assert Follow.query.filter(Follow.follower_id == Follow.followed_id).count() == count + single
+            db.session.remove()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
-from flask import url_for
+import json
+
+from flask import url_for, current_app
 
 from tests.base import BaseTestCase
+from app.events import user_channel
 from app.models import User, Photo
+from app.notifications import push_follow_notification
 
 
 class AjaxTestCase(BaseTestCase):
@@ -46,6 +50,25 @@ class AjaxTestCase(BaseTestCase):
         self.assertEqual(400, res.status_code)
         self.assertEqual("Already followed", data['message'])
 
+    def test_relationships(self):
+        # login protection
+        res = self.client.get(url_for('ajax.relationships', photo_ids='1,2', user_ids='1,2'))
+        self.assertEqual(403, res.status_code)
+
+        admin = User.query.get(1)
+        common = User.query.get(2)
+        common.collect(Photo.query.get(1))
+        common.follow(admin)
+        admin.follow(common)
+
+        self.login()
+        res = self.client.get(url_for('ajax.relationships', photo_ids='1,2', user_ids='1,3,x'))
+        data = res.get_json()
+        self.assertEqual(200, res.status_code)
+        self.assertEqual([1], data['collecting'])
+        self.assertEqual([1], data['following'])
+        self.assertEqual([1], data['followers'])
+
     def test_followers_count(self):
         res = self.client.get(url_for('ajax.followers_count', user_id=1))
         data = res.get_json()
@@ -60,6 +83,19 @@ class AjaxTestCase(BaseTestCase):
         self.assertEqual(200, res.status_code)
         self.assertEqual(1, data['count'])
 
+    def test_followers_count_etag(self):
+        url = url_for('ajax.followers_count', user_id=1)
+        etag = self.client.get(url).headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        res = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.data)
+
+        User.query.get(2).follow(User.query.get(1))
+        res = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, res.get_json()['count'])
+
     def test_unfollow(self):
         # login protection
         res = self.client.post(url_for('ajax.unfollow', username='admin'))
@@ -98,6 +134,29 @@ class AjaxTestCase(BaseTestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(1, data['count'])
 
+    def test_notifications_stream(self):
+        res = self.client.get(url_for('ajax.notifications_stream'))
+        self.assertEqual(res.status_code, 403)
+
+        current_app.config['ALBUM_WALL_EVENT_HEARTBEAT'] = 0.05
+        self.login()
+        res = self.client.get(url_for('ajax.notifications_stream'), buffered=False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        events = iter(res.response)
+        first = next(events).decode()
+        self.assertTrue(first.startswith('retry: '))
+        self.assertEqual(json.loads(first.split('data: ')[1]), dict(count=0))
+        self.assertEqual(next(events).decode(), ': keep-alive\n\n')
+
+        push_follow_notification(follower=User.query.get(1), receiver=User.query.get(2))
+        event = next(events).decode()
+        self.assertTrue(event.startswith('data: '))
+        self.assertEqual(json.loads(event[len('data: '):]), dict(count=1, message='User admin followed you.'))
+
+        res.close()
+        self.assertNotIn(user_channel(2), current_app.broker._queues)
+
     def test_collect_notification(self):
         self.login('admin@test.com', '123456')
         res = self.client.post(url_for('ajax.collect_notification', photo_id=2))
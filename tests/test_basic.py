@@ -1,5 +1,13 @@
-from flask import current_app
+import gzip
+import os
+import shutil
+import tempfile
 
+from flask import current_app, url_for
+from sqlalchemy.pool import QueuePool
+
+from app import create_app, sqlite, assets
+from app.extensions import db
 from tests.base import BaseTestCase
 
 
@@ -17,3 +25,82 @@ class BasicTestBase(BaseTestCase):
         self.assertTrue(res.status_code, 404)
         self.assertIn('404 Error', data)
 
+
+    def test_sqlite_file_settings(self):
+        workdir = tempfile.mkdtemp()
+        app = create_app('testing')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'test.db')
+        sqlite.init_app(app)
+        try:
+            with app.app_context():
+                self.assertIsInstance(db.engine.pool, QueuePool)
+                self.assertEqual('wal', db.engine.execute('PRAGMA journal_mode').scalar())
+                self.assertEqual(1, db.engine.execute('PRAGMA synchronous').scalar())  # NORMAL
+                self.assertEqual(5000, db.engine.execute('PRAGMA busy_timeout').scalar())
+                db.engine.dispose()
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_compression(self):
+        res = self.client.get(url_for('main.index'), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertIn(b'Join Now', gzip.decompress(res.data))
+        self.assertNotIn('Content-Encoding', self.client.get(url_for('main.index')).headers)
+        res = self.client.get(url_for('main.index'), headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        # too small to be worth it
+        res = self.client.get(url_for('ajax.followers_count', user_id=1), headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_precompressed_static_files(self):
+        workdir = tempfile.mkdtemp()
+        current_app.static_folder = workdir
+        try:
+            with open(os.path.join(workdir, 'style.css'), 'w') as f:
+                f.write('body { margin: 0; }\n' * 200)
+            result = self.runner.invoke(args=['compress-static'])
+            self.assertIn('Compressed', result.output)
+            self.assertTrue(os.path.exists(os.path.join(workdir, 'style.css.gz')))
+
+            url = url_for('static', filename='style.css')
+            res = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual('gzip', res.headers['Content-Encoding'])
+            self.assertEqual('text/css', res.mimetype)
+            self.assertEqual(b'body { margin: 0; }\n' * 200, gzip.decompress(res.data))
+            res.close()
+            res = self.client.get(url)
+            self.assertNotIn('Content-Encoding', res.headers)
+            res.close()
+            res = self.client.get(url, headers={'Accept-Encoding': 'gzip;q=0'})
+            self.assertNotIn('Content-Encoding', res.headers)
+            res.close()
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_build_assets(self):
+        workdir = tempfile.mkdtemp()
+        static = os.path.join(workdir, 'static')
+        shutil.copytree(current_app.static_folder, static)
+        current_app.static_folder = static
+        try:
+            self.assertEqual('/static/css/style.css', assets.static_url('css/style.css'))
+            self.assertEqual(5, len(assets.bundle_urls('js/app.js')))
+
+            result = self.runner.invoke(args=['build-assets'])
+            self.assertIn('Built', result.output)
+            current_app.config['ALBUM_WALL_ASSETS_MANIFEST'] = 'dist/manifest.json'
+            current_app.asset_manifest = assets.load_manifest(current_app)
+            url = assets.static_url('css/style.css')
+            self.assertRegex(url, r'^/static/dist/css/style\.[0-9a-f]{10}\.css$')
+            [url] = assets.bundle_urls('css/app.css')
+            self.assertIn(url, self.client.get(url_for('main.index')).get_data(as_text=True))
+
+            res = self.client.get(url)
+            self.assertEqual(current_app.config['ALBUM_WALL_ASSETS_MAX_AGE'], res.cache_control.max_age)
+            # the icon font is referenced by its hashed name
+            font = assets.static_url('open-iconic/font/fonts/open-iconic.woff').replace('/static/dist/', '../')
+            self.assertIn(font, res.get_data(as_text=True))
+            res.close()
+        finally:
+            shutil.rmtree(workdir)
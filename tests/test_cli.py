@@ -1,7 +1,15 @@
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
 from tests.base import BaseTestCase
 
 from app.extensions import db
-from app.models import User, Photo, Comment, Tag, Role
+from app.models import User, Photo, Comment, Tag, Role, Upload
 
 
 class CLITestCase(BaseTestCase):
@@ -26,11 +34,82 @@ class CLITestCase(BaseTestCase):
         self.assertIn("Done", result.output)
         self.assertEqual(4, Role.query.count())
 
+    def test_create_indexes_command(self):
+        db.create_all()
+        db.session.execute('DROP INDEX ix_photo_author_timestamp_id')
+        db.session.execute('DROP INDEX ix_follow_followed_follower')
+        db.session.commit()
+        result = self.runner.invoke(args=['create-indexes', '--dry-run'])
+        self.assertIn('CREATE INDEX IF NOT EXISTS ix_photo_author_timestamp_id ON photo (author_id, timestamp, id)',
+                      result.output)
+        self.assertIn('2 indexes missing', result.output)
+        result = self.runner.invoke(args=['create-indexes'])
+        self.assertIn('Creating ix_follow_followed_follower on follow', result.output)
+        self.assertIn('Created 2 indexes', result.output)
+        result = self.runner.invoke(args=['create-indexes'])
+        self.assertIn('Created 0 indexes', result.output)
+
+    def test_query_plans_command(self):
+        db.create_all()
+        result = self.runner.invoke(args=['query-plans'])
+        self.assertEqual(0, result.exit_code)
+        self.assertIn('main.index timeline', result.output)
+        self.assertIn('USING INDEX ix_photo_author_timestamp_id', result.output)
+
+    def test_purge_files_command(self):
+        db.create_all()
+        upload_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_path)
+        current_app.config['ALBUM_WALL_UPLOAD_PATH'] = upload_path
+        current_app.config['AVATARS_SAVE_PATH'] = os.path.join(upload_path, 'avatars')
+        os.mkdir(current_app.config['AVATARS_SAVE_PATH'])
+        for filename in ['kept.jpg', 'orphan.jpg', 'avatars/orphan_m.png']:
+            open(os.path.join(upload_path, filename), 'w').close()
+        db.session.add(Photo(filename='kept.jpg', filename_s='kept.jpg', filename_m='kept.jpg'))
+        db.session.commit()
+
+        result = self.runner.invoke(args=['purge-files'])
+        self.assertIn('Removed 0 files', result.output)
+
+        result = self.runner.invoke(args=['purge-files', '--orphans', '--grace', '0'])
+        self.assertIn('Queued 2 orphaned files', result.output)
+        self.assertEqual(['avatars', 'kept.jpg'], sorted(os.listdir(upload_path)))
+        self.assertEqual([], os.listdir(current_app.config['AVATARS_SAVE_PATH']))
+
+    def test_purge_files_expires_uploads(self):
+        db.create_all()
+        upload_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_path)
+        current_app.config['ALBUM_WALL_UPLOAD_PATH'] = upload_path
+        current_app.config['AVATARS_SAVE_PATH'] = os.path.join(upload_path, 'avatars')
+        os.mkdir(current_app.config['AVATARS_SAVE_PATH'])
+        two_hours_ago = datetime.utcnow() - timedelta(hours=2)
+        for filename in ['pending.jpg', 'stale.jpg', 'done.jpg']:
+            path = os.path.join(upload_path, filename)
+            open(path, 'w').close()
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+        db.session.add_all([
+            Upload(filename='pending.jpg', status='uploaded'),
+            Upload(filename='stale.jpg', status='uploaded', timestamp=two_hours_ago),
+            Upload(filename='done.jpg', status='done', timestamp=two_hours_ago),
+            Photo(filename='done.jpg', filename_s='done.jpg', filename_m='done.jpg')])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['purge-files', '--orphans', '--grace', '1'])
+        self.assertIn('Expired 2 batch uploads', result.output)
+        # the pending original is not an orphan
+        self.assertEqual(['avatars', 'done.jpg', 'pending.jpg'], sorted(os.listdir(upload_path)))
+        self.assertEqual(['pending.jpg'], [upload.filename for upload in Upload.query])
+
     def test_forge_command(self):
         # to be added
         pass
 
     def test_forge_command_with_count(self):
+        upload_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_path)
+        current_app.config['ALBUM_WALL_UPLOAD_PATH'] = upload_path
+        current_app.config['AVATARS_SAVE_PATH'] = os.path.join(upload_path, 'avatars')
         result = self.runner.invoke(args=['forge', '--user', '5', '--follow', '10',
                                           '--photo', '10', '--tag', '10', '--collection', '10',
                                           '--comment', '10'])
@@ -52,4 +131,4 @@ class CLITestCase(BaseTestCase):
         self.assertIn('Generating 10 fake comments', result.output)
         self.assertEqual(10, Comment.query.count())
 
-        self.assertIn('Done', result.output)
\ No newline at end of file
+        self.assertIn('Done', result.output)
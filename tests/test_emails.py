@@ -0,0 +1,151 @@
+import socket
+from datetime import datetime, timedelta
+
+from aiosmtpd.controller import Controller
+from flask import current_app
+
+from tests.base import BaseTestCase
+
+from app.digests import send_digests
+from app.emails import send_confirmation_email, deliver_queued_mail
+from app.extensions import db, mail
+from app.models import User, Notification, OutgoingMail
+
+
+class RecordingHandler:
+    """A stand-in SMTP server that refuses or defers some recipients."""
+
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+        self.refused = set()
+        self.deferred = set()
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        self.connections += 1
+        return responses
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.refused:
+            return '550 No such user'
+        if address in self.deferred:
+            return '451 Try again later'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 Message accepted'
+
+
+class EmailTestCase(BaseTestCase):
+
+    def start_smtp_server(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        handler = RecordingHandler()
+        controller = Controller(handler, hostname='127.0.0.1', port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+        state = current_app.extensions['mail']
+        state.suppress = False
+        state.server, state.port = '127.0.0.1', port
+        state.use_ssl = False
+        state.default_sender = 'noreply@test.com'
+        return handler
+
+    def queue(self, *recipients):
+        for recipient in recipients:
+            db.session.add(OutgoingMail(recipient=recipient, subject='Hello', body='Hello', html='<p>Hello</p>'))
+        db.session.commit()
+
+    def test_send_mail(self):
+        with mail.record_messages() as outbox:
+            send_confirmation_email(User.query.get(1), 'token')
+        self.assertEqual(1, len(outbox))
+        self.assertEqual(['admin@test.com'], outbox[0].recipients)
+        self.assertIn('Email Confirmation', outbox[0].subject)
+        self.assertEqual(0, OutgoingMail.query.count())
+
+    def test_deliver_in_batches_over_one_connection(self):
+        smtp = self.start_smtp_server()
+        self.queue(*['user%d@test.com' % i for i in range(5)])
+
+        self.assertEqual((5, 0), deliver_queued_mail(batch_size=2))
+        self.assertEqual(1, smtp.connections)
+        self.assertEqual(['user%d@test.com' % i for i in range(5)],
+                         [envelope.rcpt_tos[0] for envelope in smtp.messages])
+        self.assertEqual(0, OutgoingMail.query.count())
+
+    def test_retry_and_dead_letters(self):
+        smtp = self.start_smtp_server()
+        smtp.refused.add('gone@test.com')
+        smtp.deferred.add('busy@test.com')
+        current_app.config['ALBUM_WALL_MAIL_MAX_ATTEMPTS'] = 2
+        self.queue('gone@test.com', 'busy@test.com', 'ok@test.com')
+
+        self.assertEqual((1, 2), deliver_queued_mail())
+        gone = OutgoingMail.query.filter_by(recipient='gone@test.com').one()
+        busy = OutgoingMail.query.filter_by(recipient='busy@test.com').one()
+        self.assertTrue(gone.dead)  # a permanent failure isn't retried
+        self.assertFalse(busy.dead)
+        self.assertEqual(1, busy.attempts)
+        self.assertIn('451', busy.last_error)
+        self.assertGreater(busy.next_attempt, datetime.utcnow() + timedelta(seconds=50))
+        self.assertIsNone(busy.claimed_by)
+
+        # backing off
+        self.assertEqual((0, 0), deliver_queued_mail())
+        busy.next_attempt = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual((0, 1), deliver_queued_mail())
+        self.assertTrue(busy.dead)
+
+        smtp.refused.clear()
+        smtp.deferred.clear()
+        result = self.runner.invoke(args=['deliver-mail', '--retry-dead'])
+        self.assertIn('Requeued 2 dead letters', result.output)
+        self.assertIn('Sent 2 emails, 0 failed, 0 dead letters', result.output)
+        self.assertEqual(0, OutgoingMail.query.count())
+
+    def test_server_down(self):
+        smtp = self.start_smtp_server()
+        current_app.extensions['mail'].port = 1  # nothing listens there
+        self.queue('a@test.com', 'b@test.com')
+
+        self.assertEqual((0, 1), deliver_queued_mail())
+        self.assertEqual([1, 0], [outgoing.attempts for outgoing in OutgoingMail.query.order_by(OutgoingMail.id)])
+        self.assertEqual(0, OutgoingMail.query.filter(OutgoingMail.claimed_by != None).count())  # noqa: E711
+        self.assertEqual(0, smtp.connections)
+
+    def test_send_digests(self):
+        admin, common = User.query.get(1), User.query.get(2)
+        common.receive_digest_emails = True
+        now = datetime.utcnow()
+        db.session.add_all([
+            Notification(message='<a href="/user/admin/">admin</a> followed you.', receiver=common,
+                         timestamp=now - timedelta(hours=1)),
+            Notification(message='Your photo has a new comment.', receiver=common, timestamp=now - timedelta(hours=2)),
+            Notification(message='Already read.', receiver=common, is_read=True, timestamp=now - timedelta(hours=1)),
+            Notification(message='Too old.', receiver=common, timestamp=now - timedelta(days=2)),
+            Notification(message='Not opted in.', receiver=admin, timestamp=now - timedelta(hours=1)),
+        ])
+        db.session.commit()
+
+        with mail.record_messages() as outbox:
+            self.assertEqual(1, send_digests(chunk_size=1))
+            self.assertEqual(0, send_digests(chunk_size=1))  # nothing new since the last one
+        self.assertEqual(1, len(outbox))
+        self.assertEqual(['common@test.com'], outbox[0].recipients)
+        self.assertIn('You have 2 unread notifications', outbox[0].body)
+        self.assertIn('* admin followed you.', outbox[0].body)
+        self.assertNotIn('Already read', outbox[0].body)
+        self.assertNotIn('Too old', outbox[0].body)
+        self.assertIn('<a href="http://localhost:5000/user/admin/">admin</a> followed you.', outbox[0].html)
+        self.assertIsNotNone(User.query.get(2).last_digest_at)
+
+    def test_send_digests_command(self):
+        result = self.runner.invoke(args=['send-digests', '--hours', '12'])
+        self.assertIn('Queued 0 digests', result.output)
@@ -1,7 +1,15 @@
-from flask import url_for
+import io
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime
+
+from flask import url_for, current_app, render_template_string
+from PIL import Image
 
 from app.extensions import db
-from app.models import User, Photo, Notification, Comment, Tag
+from app.models import User, Photo, Notification, Comment, Tag, FileDeletion, Task, Upload
 from tests.base import BaseTestCase
 
 
@@ -48,6 +56,34 @@ class MainTestCase(BaseTestCase):
         self.assertNotIn("No results", data)
         self.assertIn("Common User", data)
 
+    def test_get_identicon_avatar(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        current_app.config['ALBUM_WALL_IDENTICON_PATH'] = cache_dir
+
+        user = User.query.get(2)
+        self.assertEqual([], os.listdir(cache_dir))
+        res = self.client.get(url_for('main.get_avatar', filename=user.avatar_m))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('image/png', res.mimetype)
+        self.assertIn('immutable', res.headers['Cache-Control'])
+        self.assertEqual([user.avatar_m.split('/')[1]], os.listdir(cache_dir))
+
+        res = self.client.get(url_for('main.get_avatar', filename='identicons/../../config.py'))
+        self.assertEqual(404, res.status_code)
+
+    def test_identicon_cache_eviction(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        current_app.config['ALBUM_WALL_IDENTICON_PATH'] = cache_dir
+        current_app.config['ALBUM_WALL_IDENTICON_CACHE_SIZE'] = 1024
+
+        for user in User.query.all():
+            self.client.get(url_for('main.get_avatar', filename=user.avatar_l))
+        size = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+        self.assertLessEqual(size, 1024)
+        self.assertTrue(os.listdir(cache_dir))
+
     def test_show_notifications(self):
         user = User.query.get(2)
         note1 = Notification(message='test 1', is_read=True, receiver=user)
@@ -169,6 +205,131 @@ class MainTestCase(BaseTestCase):
         data = res.get_data(as_text=True)
         self.assertIn("This is already the first photo", data)
 
+    def test_anonymous_page_cache(self):
+        url = url_for('main.show_photo', photo_id=1)
+
+        def get():
+            res = self.client.get(url)
+            # the requests share the test's session, a request of its own would start afresh
+            db.session.remove()
+            return res
+
+        res = get()
+        self.assertEqual('MISS', res.headers['X-Cache'])
+        self.assertIn('Photo 1', res.get_data(as_text=True))
+        res = get()
+        self.assertEqual('HIT', res.headers['X-Cache'])
+        self.assertNotIn('csrf-token', res.get_data(as_text=True))
+
+        # the page depends on the photo and on its author
+        Photo.query.get(1).description = 'New description'
+        db.session.commit()
+        res = get()
+        self.assertEqual('MISS', res.headers['X-Cache'])
+        self.assertIn('New description', res.get_data(as_text=True))
+        User.query.get(1).name = 'Renamed Admin'
+        db.session.commit()
+        res = get()
+        self.assertEqual('MISS', res.headers['X-Cache'])
+        self.assertIn('Renamed Admin', res.get_data(as_text=True))
+
+        self.login()
+        self.assertNotIn('X-Cache', get().headers)
+
+    def test_fragment_cache(self):
+        template = '{% cache "greeting" %}Hello {{ name }}{% endcache %}'
+        self.assertEqual('Hello &lt;b&gt;', render_template_string(template, name='<b>'))
+        self.assertEqual('Hello &lt;b&gt;', render_template_string(template, name='someone else'))
+
+        # the card is rebuilt when its photo, or a count shown on it, changes
+        card = '{% from "macros.html" import photo_card %}{{ photo_card(photo) }}'
+        self.assertIn('</span> 1', render_template_string(card, photo=Photo.query.get(1)))
+        db.session.add(Comment(body='Another comment', photo_id=1, author=User.query.get(2)))
+        db.session.commit()
+        self.assertIn('</span> 2', render_template_string(card, photo=Photo.query.get(1)))
+        Photo.query.get(1).filename_s = 'renamed_s.jpg'
+        db.session.commit()
+        self.assertIn('renamed_s.jpg', render_template_string(card, photo=Photo.query.get(1)))
+
+    def test_cache_keys(self):
+        photo, admin, tag = Photo.query.get(1), User.query.get(1), Tag.query.get(1)
+        keys = [photo.cache_key(), admin.cache_key(), tag.cache_key()]
+        self.assertEqual('photo:1:1', keys[0])
+
+        # a new comment moves its photo, the row itself and whoever wrote it don't matter
+        db.session.add(Comment(body='Another comment', photo_id=1, author=User.query.get(2)))
+        db.session.commit()
+        self.assertEqual('photo:1:2', photo.cache_key())
+        self.assertEqual(keys[1:], [admin.cache_key(), tag.cache_key()])
+
+        photo.description = 'New description'
+        db.session.commit()
+        self.assertEqual('photo:1:3', photo.cache_key())
+        self.assertEqual(keys[1:], [admin.cache_key(), tag.cache_key()])
+
+        # the tags and the author count their photos
+        photo.tags.remove(tag)
+        db.session.commit()
+        self.assertNotEqual(keys[2], tag.cache_key())
+        User.query.get(2).collect(photo)
+        self.assertEqual('photo:1:5', photo.cache_key())
+        db.session.delete(photo)
+        db.session.commit()
+        self.assertNotEqual(keys[1], admin.cache_key())
+
+    def test_conditional_get(self):
+        self.login()
+        url = url_for('main.show_photo', photo_id=1)
+
+        def get(etag=None):
+            res = self.client.get(url, headers={'If-None-Match': etag} if etag else {})
+            db.session.remove()
+            return res
+
+        etag = get().headers['ETag']
+        res = get(etag)
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.data)
+        self.assertIn('private', res.headers['Cache-Control'])
+
+        # a new comment on the photo, a collect by the viewer and a notification all change the page
+        for change in (lambda: db.session.add(Comment(body='New comment', photo_id=1, author_id=1)),
+                       lambda: User.query.get(2).collect(Photo.query.get(1)),
+                       lambda: db.session.add(Notification(message='Hello', receiver_id=2))):
+            change()
+            db.session.commit()
+            res = get(etag)
+            self.assertEqual(200, res.status_code)
+            etag = res.headers['ETag']
+            self.assertEqual(304, get(etag).status_code)
+
+    def test_photo_neighbours(self):
+        admin = User.query.get(1)
+        # ids don't follow the timestamps, and two photos share one
+        photos = [Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg',
+                        description='Photo %d' % i, author=admin, timestamp=datetime(2019, 1, day))
+                  for i, day in [(3, 5), (4, 2), (5, 5)]]
+        db.session.add_all(photos)
+        Photo.query.get(1).timestamp = datetime(2019, 1, 3)
+        db.session.commit()
+
+        # user.index order is 5, 3, 1, 4
+        self.assertEqual((None, 3), (Photo.query.get(5).previous_id(), Photo.query.get(5).next_id()))
+        self.assertEqual((5, 1), (Photo.query.get(3).previous_id(), Photo.query.get(3).next_id()))
+        self.assertEqual((1, None), (Photo.query.get(4).previous_id(), Photo.query.get(4).next_id()))
+
+        data = self.client.get(url_for('main.show_photo', photo_id=3)).get_data(as_text=True)
+        self.assertIn('href="%s"' % url_for('main.show_photo', photo_id=5), data)
+        self.assertIn('href="%s"' % url_for('main.show_photo', photo_id=1), data)
+        data = self.client.get(url_for('main.show_photo', photo_id=4)).get_data(as_text=True)
+        self.assertIn('This is already the last photo', data)
+
+        self.login('admin@test.com', '123456')
+        res = self.client.post(url_for('main.delete_photo', photo_id=3))
+        self.assertTrue(res.location.endswith(url_for('main.show_photo', photo_id=1)))
+        res = self.client.post(url_for('main.delete_photo', photo_id=4))
+        self.assertTrue(res.location.endswith(url_for('main.show_photo', photo_id=1)))
+
     def test_collect(self):
         photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg',
                       description="Photo 3", author=User.query.get(2))
@@ -293,6 +454,113 @@ class MainTestCase(BaseTestCase):
         self.assertIn("Photo deleted", data)
         self.assertIn("Common User", data)
 
+    def test_upload(self):
+        upload_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_path)
+        current_app.config['ALBUM_WALL_UPLOAD_PATH'] = upload_path
+        image = io.BytesIO()
+        Image.new('RGB', (1000, 600), 'orange').save(image, 'PNG')
+        data = image.getvalue()
+        self.login()
+
+        res = self.client.post(url_for('main.upload'), data=dict(file=(io.BytesIO(data), 'photo.png')))
+        self.assertEqual(200, res.status_code)
+        photo = Photo.query.order_by(Photo.id.desc()).first()
+        self.assertEqual(2, photo.author_id)
+        self.assertTrue(photo.filename.endswith('.png'))
+        self.assertEqual(3, len(set([photo.filename, photo.filename_s, photo.filename_m])))
+        for filename in [photo.filename, photo.filename_s, photo.filename_m]:
+            self.assertTrue(os.path.exists(os.path.join(upload_path, filename)))
+
+        # in three chunks, the second one sent twice as after a failure
+        size = len(data) // 3 + 1
+        chunks = [0, 1, 1, 2]
+        for index in chunks:
+            res = self.client.post(url_for('main.upload'), data=dict(
+                dzuuid='1b4e28ba-2fa1-11d2-883f-0016d3cca427', dzchunkindex=index, dztotalchunkcount=3,
+                dzchunkbyteoffset=index * size, dztotalfilesize=len(data),
+                file=(io.BytesIO(data[index * size:(index + 1) * size]), 'blob')))
+            self.assertEqual(200, res.status_code)
+        self.assertEqual(4, Photo.query.count())
+        with open(os.path.join(upload_path, Photo.query.get(4).filename), 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual([], os.listdir(os.path.join(upload_path, 'chunks')))
+
+        res = self.client.post(url_for('main.upload'), data=dict(file=(io.BytesIO(b'<html>'), 'photo.jpg')))
+        self.assertEqual(400, res.status_code)
+        self.assertEqual('Not an image', res.get_data(as_text=True))
+        self.assertEqual(4, Photo.query.count())
+
+    def test_upload_batch(self):
+        upload_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_path)
+        current_app.config['ALBUM_WALL_UPLOAD_PATH'] = upload_path
+        current_app.config['ALBUM_WALL_UPLOAD_WORKERS'] = 2
+        self.login()
+        res = self.client.get(url_for('main.upload'))
+        batch_id = re.search(r'batch: "([0-9a-f]{32})"', res.get_data(as_text=True)).group(1)
+
+        upload_ids = []
+        for width in [1000, 300, 600]:
+            image = io.BytesIO()
+            Image.new('RGB', (width, 200), 'orange').save(image, 'JPEG')
+            image.seek(0)
+            res = self.client.post(url_for('main.upload'), data=dict(batch=batch_id, file=(image, 'photo.jpg')))
+            self.assertEqual(200, res.status_code)
+            upload_ids.append(res.get_json()['id'])
+        # a file the worker can't read any more
+        os.remove(os.path.join(upload_path, Upload.query.get(upload_ids[2]).filename))
+        self.assertEqual(2, Photo.query.count())
+        db.session.remove()
+
+        res = self.client.post(url_for('ajax.process_uploads', batch_id=batch_id))
+        self.assertEqual(200, res.status_code)
+        db.session.remove()
+        res = self.client.post(url_for('ajax.process_uploads', batch_id=batch_id))
+        self.assertEqual(400, res.status_code)
+
+        uploads = self.client.get(url_for('ajax.upload_status', batch_id=batch_id)).get_json()['uploads']
+        self.assertEqual(upload_ids, [upload['id'] for upload in uploads])
+        self.assertEqual(['done', 'done', 'failed'], [upload['status'] for upload in uploads])
+        self.assertEqual('Could not process the image', uploads[2]['message'])
+        self.assertEqual(4, Photo.query.count())
+        photos = Photo.query.filter(Photo.id > 2).order_by(Photo.id).all()
+        self.assertEqual([url_for('main.show_photo', photo_id=photo.id) for photo in photos],
+                         [upload['url'] for upload in uploads[:2]])
+        self.assertEqual(3, len(set([photos[0].filename, photos[0].filename_s, photos[0].filename_m])))
+        # narrower than the small size, used as it is
+        self.assertEqual(photos[1].filename, photos[1].filename_s)
+        for photo in photos:
+            for filename in [photo.filename, photo.filename_s, photo.filename_m]:
+                self.assertTrue(os.path.exists(os.path.join(upload_path, filename)))
+        task = Task.query.filter_by(name='process_upload_batch').one()
+        self.assertEqual(('finished', 100), (task.status, task.progress))
+
+        self.logout()
+        self.login('unconfirmed@test.com', '123456')
+        res = self.client.post(url_for('ajax.process_uploads', batch_id=batch_id))
+        self.assertEqual(400, res.status_code)
+
+    def test_delete_photo_files(self):
+        upload_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_path)
+        current_app.config['ALBUM_WALL_UPLOAD_PATH'] = upload_path
+        for filename in ['test2.jpg', 'test2_s.jpg', 'test2_m.jpg']:
+            open(os.path.join(upload_path, filename), 'w').close()
+
+        # nothing is removed when the transaction rolls back
+        db.session.delete(Photo.query.get(2))
+        db.session.flush()
+        self.assertEqual(3, FileDeletion.query.count())
+        db.session.rollback()
+        self.assertEqual(0, FileDeletion.query.count())
+        self.assertEqual(3, len(os.listdir(upload_path)))
+
+        self.login()
+        self.client.post(url_for('main.delete_photo', photo_id=2))
+        self.assertEqual([], os.listdir(upload_path))
+        self.assertEqual(0, FileDeletion.query.count())
+
     def test_delete_comment(self):
         self.login('admin@test.com', '123456')
         res = self.client.post(url_for('main.delete_comment', comment_id=1), follow_redirects=True)
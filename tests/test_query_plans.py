@@ -0,0 +1,19 @@
+from tests.base import BaseTestCase
+
+from app.extensions import db
+from app.queryplans import HOT_QUERIES, check_plans, explain, used_indexes
+
+
+class QueryPlanTestCase(BaseTestCase):
+
+    def test_hot_queries_match_snapshot(self):
+        plans, problems = check_plans()
+        self.assertEqual([], problems)
+        self.assertEqual(list(HOT_QUERIES), list(plans))
+
+    def test_missing_index_is_reported(self):
+        db.session.execute('DROP INDEX ix_photo_author_timestamp_id')
+        plan = explain(HOT_QUERIES['user.index photos'].build())
+        self.assertNotIn('ix_photo_author_timestamp_id', used_indexes(plan))
+        plans, problems = check_plans()
+        self.assertIn('user.index photos does not use ix_photo_author_timestamp_id', problems)
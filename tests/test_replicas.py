@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import url_for
+
+from app import create_app, sqlite, replicas
+from app.extensions import db
+from app.models import Role, User, Photo
+
+
+class ReplicaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        app = create_app('testing')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.workdir, 'primary.db')
+        app.config['ALBUM_WALL_REPLICA_URIS'] = ['sqlite:///' + os.path.join(self.workdir, 'replica.db')]
+        sqlite.init_app(app)
+        replicas.init_app(app)
+        # the same anonymous page is asked for repeatedly, it has to be rendered each time
+        app.page_store = None
+        self.app = app
+        self.context = app.test_request_context()
+        self.context.push()
+        self.client = app.test_client()
+
+        db.create_all()
+        Role.init_role()
+        user = User(email='common@test.com', name='Common User', username='common', confirmed=True)
+        user.set_password('123456')
+        db.session.add(Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg',
+                             description='Before', author=user))
+        db.session.commit()
+        self.assertEqual(1, replicas.sync_replicas())
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        for bind in [None, 'replica-0']:
+            db.get_engine(self.app, bind=bind).dispose()
+        self.context.pop()
+        shutil.rmtree(self.workdir)
+
+    def update_description(self, description):
+        Photo.query.get(1).description = description
+        db.session.commit()
+        db.session.remove()
+
+    def get_photo_page(self):
+        data = self.client.get(url_for('main.show_photo', photo_id=1)).get_data(as_text=True)
+        # the requests share the test's app context, and with it the session
+        db.session.remove()
+        return data
+
+    def test_reads_go_to_the_replica(self):
+        self.update_description('After')
+        self.assertIn('Before', self.get_photo_page())
+        # views without replica_read read from the primary
+        self.assertEqual('After', Photo.query.get(1).description)
+        db.session.remove()
+
+        replicas.sync_replicas()
+        self.assertIn('After', self.get_photo_page())
+
+    def test_writer_is_pinned_to_the_primary(self):
+        self.client.post(url_for('auth.login'), data=dict(email='common@test.com', password='123456'))
+        res = self.client.post(url_for('main.edit_description', photo_id=1), data=dict(description='Mine'))
+        self.assertEqual(302, res.status_code)
+        db.session.remove()
+        self.assertIn('Mine', self.get_photo_page())
+
+        # once the pin runs out the replica answers again
+        with self.client.session_transaction() as session:
+            session['primary_until'] = 0
+        self.assertIn('Before', self.get_photo_page())
@@ -1,7 +1,15 @@
-from flask import url_for
+from flask import url_for, current_app
 import io
+import os
+import shutil
+import tempfile
 
-from app.models import User, Photo
+from PIL import Image
+
+from app.extensions import db
+from app.models import User, Photo, Comment, Collect, Follow, Notification, Task
+from app.principals import load_user
+from app.tasks import launch_task
 from app.utils import generate_token
 from app.config import Operations
 
@@ -128,6 +136,9 @@ class UserTestCase(BaseTestCase):
         self.assertIn("Change Avatar", data)
 
     def test_upload_avatar(self):
+        avatar_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, avatar_dir)
+        current_app.config['AVATARS_SAVE_PATH'] = avatar_dir
         self.login()
         data = {'image': (io.BytesIO(b"abcdef"), 'test.jpg')}
         res = self.client.post(url_for('user.upload_avatar'), data=data, follow_redirects=True,
@@ -135,6 +146,43 @@ class UserTestCase(BaseTestCase):
         data = res.get_data(as_text=True)
         self.assertIn("Image upload, please crop", data)
 
+    def test_crop_avatar(self):
+        avatar_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, avatar_dir)
+        current_app.config['AVATARS_SAVE_PATH'] = avatar_dir
+        self.login()
+        image = io.BytesIO()
+        Image.new('RGB', (300, 300), (255, 0, 0)).save(image, 'PNG')
+        image.seek(0)
+        self.client.post(url_for('user.upload_avatar'), data={'image': (image, 'test.png')},
+                         content_type='multipart/form-data')
+        user = User.query.get(2)
+        self.assertIsNotNone(user.avatar_raw)
+
+        res = self.client.post(url_for('user.crop_avatar'), data=dict(x=0, y=0, w=100, h=100), follow_redirects=True)
+        self.assertIn("Avatar is being updated", res.get_data(as_text=True))
+        first = [user.avatar_s, user.avatar_m, user.avatar_l]
+        self.assertTrue(user.avatar_m.endswith('_m.png'))
+        self.assertFalse(user.avatar_m.startswith('identicons/'))
+        for filename in first:
+            self.assertTrue(os.path.exists(os.path.join(avatar_dir, filename)))
+
+        task = user.tasks.first()
+        res = self.client.get(url_for('ajax.task_status', task_id=task.id))
+        self.assertEqual('finished', res.get_json()['status'])
+
+        # cropping again replaces the files
+        self.client.post(url_for('user.crop_avatar'), data=dict(x=10, y=10, w=50, h=50))
+        self.assertNotEqual(first[1], user.avatar_m)
+        for filename in first:
+            self.assertFalse(os.path.exists(os.path.join(avatar_dir, filename)))
+
+        # a crop chosen on an image that has been replaced since is dropped
+        current = user.avatar_m
+        task = launch_task('crop_avatar', 'Cropping avatar', user, user.id, 'replaced_raw.png', 0, 0, 50, 50)
+        self.assertEqual(('finished', 'Skipped, a newer image was uploaded'), (task.status, task.message))
+        self.assertEqual(current, user.avatar_m)
+
     def test_change_password(self):
         self.login()
         user = User.query.get(2)
@@ -217,4 +265,145 @@ class UserTestCase(BaseTestCase):
         ), follow_redirects=True)
         data = res.get_data(as_text=True)
         self.assertIn("Your are kicked out, goodbye", data)
-        self.assertIsNone(User.query.get(2))
\ No newline at end of file
+        self.assertIsNone(User.query.get(2))
+
+    def test_delete_account_purges_content(self):
+        admin = User.query.get(1)
+        common = User.query.get(2)
+        common.follow(admin)
+        admin.follow(common)
+        admin.collect(Photo.query.get(2))
+        common.collect(Photo.query.get(1))
+        reply = Comment(body='reply', photo=Photo.query.get(1), author=admin,
+                        replying_to=Comment.query.get(1))
+        db.session.add_all([reply, Notification(message='hello', receiver=common)])
+        db.session.commit()
+        versions = [admin.version, Photo.query.get(1).version]
+
+        self.login()
+        self.client.post(url_for('user.delete_account'), data=dict(username='common'))
+        db.session.remove()
+        # the follower count of admin, the collector and comment counts of admin's photo
+        self.assertEqual([version + 1 for version in versions],
+                         [User.query.get(1).version, Photo.query.get(1).version])
+        self.assertIsNone(User.query.get(2))
+        self.assertIsNone(Photo.query.get(2))
+        self.assertEqual(1, Photo.query.count())
+        self.assertEqual(0, Comment.query.count())  # common's comment and the reply to it
+        self.assertEqual(0, Collect.query.count())
+        self.assertEqual(0, Follow.query.filter((Follow.follower_id == 2) | (Follow.followed_id == 2)).count())
+        self.assertEqual(0, Notification.query.filter_by(receiver_id=2).count())
+
+        task = Task.query.filter_by(name='delete_account').one()
+        self.assertEqual('finished', task.status)
+        self.assertEqual(100, task.progress)
+
+        # logged out
+        res = self.client.get(url_for('user.edit_profile'), follow_redirects=True)
+        self.assertIn("Please log in to access", res.get_data(as_text=True))
+
+    def test_deleted_account_hidden(self):
+        # marked, waiting for delete_account to purge it
+        admin = User.query.get(1)
+        common = User.query.get(2)
+        common.follow(admin)
+        common.deleted = True
+        db.session.commit()
+        db.session.remove()
+
+        self.assertEqual(404, self.client.get(url_for('main.show_photo', photo_id=2)).status_code)
+        data = self.client.get(url_for('main.show_photo', photo_id=1)).get_data(as_text=True)
+        self.assertNotIn('test comment body', data)
+        data = self.client.get(url_for('main.explore')).get_data(as_text=True)
+        self.assertNotIn(url_for('main.show_photo', photo_id=2), data)
+        data = self.client.get(url_for('main.search', q='Photo')).get_data(as_text=True)
+        self.assertIn(url_for('main.show_photo', photo_id=1), data)
+        self.assertNotIn(url_for('main.show_photo', photo_id=2), data)
+        data = self.client.get(url_for('main.search', q='common', category='user')).get_data(as_text=True)
+        self.assertNotIn('Common User', data)
+        data = self.client.get(url_for('user.show_followers', username='admin')).get_data(as_text=True)
+        self.assertNotIn('Common User', data)
+        self.assertEqual(404, self.client.get(url_for('user.show_following', username='common')).status_code)
+
+    def test_delete_account_reply_chain(self):
+        # a chain of replies going back and forth, one comment per chunk
+        admin = User.query.get(1)
+        common = User.query.get(2)
+        parent = Comment.query.get(1)
+        for author in [admin, common, admin]:
+            parent = Comment(body='reply', photo=parent.photo, author=author, replying_to=parent)
+            db.session.add(parent)
+        db.session.commit()
+        db.session.execute('PRAGMA foreign_keys = ON')
+
+        task = launch_task('delete_account', 'Deleting account common', None, common.id, 1)
+        self.assertEqual('finished', task.status)
+        self.assertEqual(0, Comment.query.count())
+        self.assertIsNone(User.query.get(2))
+
+    def test_relationship_ids(self):
+        admin = User.query.get(1)
+        common = User.query.get(2)
+        self.assertEqual(set(), common.following_ids([1, 3]))
+        self.assertEqual(set(), common.collecting_ids([1, 2]))
+
+        # the cached answers are updated in place by follow/collect
+        common.follow(admin)
+        common.collect(Photo.query.get(1))
+        self.assertEqual({1}, common.following_ids([1, 3]))
+        self.assertEqual({2}, admin.follower_ids([2, 3]))
+        self.assertEqual({1}, common.collecting_ids([1, 2]))
+
+        common.unfollow(admin)
+        common.uncollect(Photo.query.get(1))
+        self.assertFalse(common.is_following(admin))
+        self.assertFalse(common.is_collecting(Photo.query.get(1)))
+
+    def test_user_loader_cache(self):
+        self.login()
+        self.client.get(url_for('main.index'))
+        cache = current_app.principal_cache
+        self.assertEqual('common', cache.get('user:2')['username'])
+
+        # rebuilt from the snapshots without touching the database
+        db.session.remove()
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        user = load_user('2')
+        self.assertEqual('common', user.username)
+        self.assertTrue(user.can('UPLOAD'))
+        self.assertFalse(user.can('MODERATE'))
+        self.assertEqual([], statements)
+        # columns left out of the snapshot load on access
+        self.assertEqual('common@test.com', user.email)
+        self.assertEqual(1, len(statements))
+
+        user.lock()
+        self.assertIsNone(cache.get('user:2'))
+        db.session.remove()
+        user = load_user('2')
+        self.assertFalse(user.can('UPLOAD'))
+        self.assertEqual('Locked', user.role.name)
+
+        user.deleted = True
+        db.session.commit()
+        db.session.remove()
+        self.assertIsNone(load_user('2'))
+
+    def test_create_users(self):
+        from app.accounts import create_users
+        rows = [dict(name='Bulk %d' % i, username='bulk%d' % i, email='bulk%d@test.com' % i) for i in range(5)]
+        self.assertEqual(5, create_users(rows, password='123456', batch_size=2))
+
+        user = User.query.filter_by(username='bulk3').first()
+        self.assertEqual('User', user.role.name)
+        self.assertTrue(user.is_following(user))
+        self.assertTrue(user.validate_password('123456'))
+        self.assertTrue(user.avatar_m.startswith('identicons/'))
+        self.assertEqual([user], User.query.whooshee_search('bulk3').all())
+
+        # indexing was only deferred for the batches
+        self.assertNotIn('defer_search_index', db.session.info)
+        db.session.add(User(name='Single', username='single', email='single@test.com'))
+        db.session.commit()
+        self.assertEqual(1, User.query.whooshee_search('single').count())